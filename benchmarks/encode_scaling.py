@@ -0,0 +1,76 @@
+"""
+Encode throughput of many streams of a video file, encoded by their
+read-ahead threads against an EncodePool of processes. Run from the
+repository root:
+
+    python -m benchmarks.encode_scaling <video file> [--streams N] [--processes N]
+        [--codec NAME] [--frames N] [--target RATIO]
+
+Exits with status 1 when the processes speed encoding up by less than the
+target, by default half the cores they can use.
+"""
+import argparse
+import os
+import sys
+from threading import Thread
+from time import perf_counter
+
+from utils.codecs import CODECS
+from utils.encode_pool import EncodePool
+from utils.video_stream import VideoStream
+
+
+def throughput(path: str, streams: int, codec, frames: int, encode_pool=None) -> float:
+    # frames per second over all the streams, each taking `frames` frames
+    video_streams = [VideoStream(path, encode_pool=encode_pool) for _ in range(streams)]
+    for video_stream in video_streams:
+        video_stream.set_codec(codec)
+
+    def take(video_stream):
+        for _ in range(frames):
+            if video_stream.at_end():
+                break
+            video_stream.get_next_frame()
+
+    start = perf_counter()
+    threads = [Thread(target=take, args=(video_stream,)) for video_stream in video_streams]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    taken = sum(video_stream.current_frame_number + 1 for video_stream in video_streams)
+    for video_stream in video_streams:
+        video_stream.close()
+    return taken / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("--streams", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--codec", type=str, default="WEBP")
+    parser.add_argument("--frames", type=int, default=48)
+    parser.add_argument("--target", type=float, default=None)
+    args = parser.parse_args()
+
+    codec = CODECS[args.codec.upper()]
+    target = args.target
+    if target is None:
+        target = min(args.processes, args.streams, os.cpu_count()) / 2
+
+    threaded = throughput(args.video, args.streams, codec, args.frames)
+    encode_pool = EncodePool(args.processes)
+    try:
+        pooled = throughput(args.video, args.streams, codec, args.frames, encode_pool)
+    finally:
+        encode_pool.close()
+
+    speedup = pooled / threaded
+    print(f"{args.streams} streams in {codec}, {os.cpu_count()} cores")
+    print(f"    threads: {threaded:7.1f} frames/s")
+    print(f"  processes: {pooled:7.1f} frames/s with {args.processes} processes ({speedup:.2f}x)")
+    if speedup < target:
+        print(f"processes encode {speedup:.2f}x faster, below the {target:g}x target")
+        sys.exit(1)
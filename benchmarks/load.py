@@ -0,0 +1,297 @@
+"""
+How many sessions a server sustains: starts main_server.py in a process of
+its own, then a number of headless clients against it over loopback, one
+every ramp-up / sessions seconds, and keeps them all playing for the
+duration. Reports per session the startup latency (TCP connect to first
+frame), the frames received per second and the frames lost, and for the
+whole run the server's CPU (its encode processes included) and the bytes
+it delivered per second. Linux only, the server's CPU is read from /proc.
+Run from the repository root:
+
+    python -m benchmarks.load <video file>... [--sessions N] [--ramp-up SECONDS]
+        [--duration SECONDS] [--transport udp|tcp] [--codec NAME] [--asyncio]
+        [--server-args ARGS] [--json PATH] [--target RATIO]
+
+Sources are assigned to the sessions in turn and should last for the
+ramp-up and the duration. The report is also written as JSON with --json
+("-" for stdout), to compare runs across commits. Exits with status 1 when
+the slowest session receives less than the target share of the server's
+frame rate.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from threading import Thread
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+
+from client.client import Client
+from server.server import Server
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import RTSPStatusError
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid: int) -> float:
+    # user and system CPU of a process and of its children still running
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name may hold spaces, the fields follow its ")"
+            fields = f.read().rpartition(")")[2].split()
+        total = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (FileNotFoundError, ProcessLookupError):
+        return 0.0
+    return total + sum(cpu_seconds(child) for child in children)
+
+
+def wait_for_server(port: int, timeout: float = 10.0):
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.1)
+
+
+class Session:
+    def __init__(self, index: int, source: str, port: int, rtp_port: int, transport: str, codec: Optional[str]):
+        self.index = index
+        self.source = source
+        self.client = Client(
+            source,
+            "127.0.0.1",
+            port,
+            rtp_port,
+            interleaved=transport == "tcp",
+            codecs=None if codec is None else [codec],
+            # counted as they come, never decoded
+            on_frame=self._on_frame,
+        )
+        self.frames = 0
+        self.bytes = 0
+        self.first_sequence_number: Optional[int] = None
+        self.last_sequence_number: Optional[int] = None
+        self.connect_time: Optional[float] = None
+        self.first_frame_time: Optional[float] = None
+        self.last_frame_time: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def _on_frame(self, packet: RTPPacket):
+        now = perf_counter()
+        if self.first_frame_time is None:
+            self.first_frame_time = now
+            self.first_sequence_number = packet.sequence_number
+        self.last_frame_time = now
+        self.last_sequence_number = packet.sequence_number
+        self.frames += 1
+        self.bytes += len(packet.payload)
+
+    def start(self):
+        self.connect_time = perf_counter()
+        try:
+            self.client.establish_rtsp_connection()
+            self.client.send_setup_request(play=True)
+        except (OSError, RTSPStatusError) as e:
+            self.error = str(e) or type(e).__name__
+
+    def stop(self):
+        if self.error is not None or not self.client.is_rtsp_connected:
+            return
+        try:
+            self.client.send_teardown_request()
+        except (OSError, RTSPStatusError) as e:
+            self.error = str(e) or type(e).__name__
+
+    def report(self) -> Dict:
+        report = {"session": self.index, "source": self.source, "error": self.error, "frames": self.frames}
+        if self.first_frame_time is None:
+            return report
+        expected = self.last_sequence_number - self.first_sequence_number + 1
+        elapsed = self.last_frame_time - self.first_frame_time
+        report.update(
+            startup_ms=(self.first_frame_time - self.connect_time) * 1000,
+            fps=(self.frames - 1) / elapsed if elapsed > 0 else None,
+            frames_lost=expected - self.frames,
+            loss=(expected - self.frames) / expected,
+            bytes=self.bytes,
+            bytes_per_second=self.bytes / elapsed if elapsed > 0 else None,
+        )
+        return report
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> Dict:
+    command = [sys.executable, "main_server.py", "-p", str(args.PORT)]
+    if args.asyncio:
+        command.append("-a")
+    command += shlex.split(args.server_args)
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sessions: List[Session] = []
+    cpu_samples: List[float] = []
+    try:
+        wait_for_server(args.PORT)
+        threads = []
+        # the clients are chatty, and so many of them would only slow down
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = perf_counter()
+            for i in range(args.sessions):
+                sleep(max(0.0, start + i * args.ramp_up / args.sessions - perf_counter()))
+                session = Session(
+                    i, args.video[i % len(args.video)], args.PORT,
+                    args.PORT + 10 + 2 * i, args.transport, args.codec,
+                )
+                sessions.append(session)
+                # SETUP and PLAY from their own thread, a slow server
+                # answer must not hold the ramp up
+                thread = Thread(target=session.start)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+            # steady state: every session started
+            steady_start, steady_cpu = perf_counter(), cpu_seconds(server.pid)
+            steady_bytes = sum(session.bytes for session in sessions)
+            last, last_cpu = steady_start, steady_cpu
+            while perf_counter() - steady_start < args.duration:
+                sleep(min(1.0, args.duration - (perf_counter() - steady_start)))
+                now, cpu = perf_counter(), cpu_seconds(server.pid)
+                cpu_samples.append((cpu - last_cpu) / (now - last) * 100)
+                last, last_cpu = now, cpu
+            steady_elapsed = perf_counter() - steady_start
+            steady_cpu = cpu_seconds(server.pid) - steady_cpu
+            steady_bytes = sum(session.bytes for session in sessions) - steady_bytes
+
+            for session in sessions:
+                session.stop()
+    finally:
+        # as Ctrl-C would
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    reports = [session.report() for session in sessions]
+    playing = [report for report in reports if report.get("fps") is not None]
+    startup = sorted(report["startup_ms"] for report in playing)
+    aggregate = {
+        "sessions": len(reports),
+        "playing": len(playing),
+        "failed": sum(1 for report in reports if report["error"] is not None),
+        "server_fps": 1000 / Server.FRAME_PERIOD,
+        "fps_mean": statistics.mean(report["fps"] for report in playing) if playing else None,
+        "fps_min": min(report["fps"] for report in playing) if playing else None,
+        "fps_total": sum(report["fps"] for report in playing),
+        "loss_mean": statistics.mean(report["loss"] for report in playing) if playing else None,
+        "startup_ms_median": statistics.median(startup) if startup else None,
+        "startup_ms_p90": startup[min(len(startup) - 1, int(0.9 * len(startup)))] if startup else None,
+        "server_cpu_percent": steady_cpu / steady_elapsed * 100,
+        "server_cpu_percent_peak": max(cpu_samples, default=None),
+        "egress_bytes_per_second": steady_bytes / steady_elapsed,
+    }
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "sources": args.video,
+            "sessions": args.sessions,
+            "ramp_up": args.ramp_up,
+            "duration": args.duration,
+            "transport": args.transport,
+            "codec": args.codec,
+            "asyncio": args.asyncio,
+            "server_args": args.server_args,
+        },
+        "aggregate": aggregate,
+        "sessions": reports,
+    }
+
+
+def _format(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str, nargs="+")
+    parser.add_argument("-n", "--sessions", type=int, default=8)
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="seconds")
+    parser.add_argument("--duration", type=float, default=6.0, help="seconds, once every session started")
+    parser.add_argument("--transport", choices=("udp", "tcp"), default="udp")
+    parser.add_argument("--codec", type=str, default=None)
+    parser.add_argument("-a", "--asyncio", action="store_true")
+    parser.add_argument("--server-args", type=str, default="", help="further main_server.py options")
+    parser.add_argument("-p", "--PORT", type=int, default=5740)
+    parser.add_argument("--json", type=str, default=None, help="write the report there, - for stdout")
+    parser.add_argument("--target", type=float, default=0.9)
+    args = parser.parse_args()
+
+    result = run(args)
+    aggregate = result["aggregate"]
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2)
+        print("session  startup      fps    lost    kB/s  error")
+        for report in result["sessions"]:
+            print(
+                f"{report['session']:7}  {_format(report.get('startup_ms'), '5.0f')} ms  "
+                f"{_format(report.get('fps'), '6.2f')}  {_format(report.get('loss'), '6.1%')}  "
+                f"{_format(report.get('bytes_per_second') and report['bytes_per_second'] / 1000, '6.0f')}  "
+                f"{report['error'] or ''}"
+            )
+        print(
+            f"{aggregate['playing']}/{aggregate['sessions']} sessions playing, "
+            f"{_format(aggregate['fps_mean'], '.2f')} fps on average "
+            f"(slowest {_format(aggregate['fps_min'], '.2f')}, server {aggregate['server_fps']:.2f}), "
+            f"{_format(aggregate['loss_mean'], '.1%')} lost"
+        )
+        print(
+            f"startup median {_format(aggregate['startup_ms_median'], '.0f')} ms, "
+            f"p90 {_format(aggregate['startup_ms_p90'], '.0f')} ms"
+        )
+        print(
+            f"server CPU {aggregate['server_cpu_percent']:.0f}% "
+            f"(peak {_format(aggregate['server_cpu_percent_peak'], '.0f')}%), "
+            f"egress {aggregate['egress_bytes_per_second'] * 8 / 1e6:.2f} Mbit/s"
+        )
+    out = sys.stderr if args.json == "-" else sys.stdout
+    fps_min = aggregate["fps_min"] or 0.0
+    if aggregate["failed"]:
+        print(f"{aggregate['failed']} of {aggregate['sessions']} sessions failed", file=out)
+        sys.exit(1)
+    if fps_min < args.target * aggregate["server_fps"]:
+        print(
+            f"the slowest session received {fps_min:.2f} fps, below {args.target:g} of the "
+            f"server's {aggregate['server_fps']:.2f} fps",
+            file=out,
+        )
+        sys.exit(1)
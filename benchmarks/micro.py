@@ -0,0 +1,265 @@
+"""
+Microbenchmarks of the hot paths, on fixed inputs: RTP and RTCP packets,
+RTSP parsing, sending a frame as RTP datagrams and reassembling it, reading
+ahead, encoding at each level of the resolution ladder, and object
+detection when TensorFlow is installed. The input frame is the first one
+of a video file. Run from the repository root:
+
+    python -m benchmarks.micro <video file> [-k NAME] [--repeat N] [--json PATH]
+        [--compare BASELINE] [--threshold RATIO]
+
+Each case is timed in blocks of calls long enough to read the clock
+reliably; the median and best time per call over the blocks are reported,
+and written as JSON with --json. --compare reads such a file, taken before
+a change, and exits with status 1 when a case got slower by more than the
+threshold (10% by default).
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+import cv2
+
+from client.client import Client
+from server.server import Server
+from utils.codecs import CODECS, render
+from utils.datagram import SOCKET_BUFFER_SIZE, DatagramSizer, Reassembler, set_socket_buffers
+from utils.rtcp_packet import RTCPPacket
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import RTSPPacket
+from utils.video_stream import VideoStream
+
+BLOCK_TIME = 0.05  # seconds, at least, per block of calls
+
+
+class Case:
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], object],
+        prepare: Optional[Callable[[int], None]] = None,
+        max_number: Optional[int] = None,
+    ) -> None:
+        self.name = name
+        self.run = run
+        # called before each block with its number of calls, untimed
+        self.prepare = prepare
+        # calls per block at most, for cases bounded by a socket buffer
+        self.max_number = max_number
+
+    def _block(self, number: int) -> float:
+        if self.prepare is not None:
+            self.prepare(number)
+        run = self.run
+        start = perf_counter()
+        for _ in range(number):
+            run()
+        return perf_counter() - start
+
+    def measure(self, repeat: int) -> Dict[str, float]:
+        # calls per block doubled until a block lasts BLOCK_TIME, as timeit does
+        number = 1
+        while self._block(number) < BLOCK_TIME and number != self.max_number:
+            number = number * 2 if self.max_number is None else min(number * 2, self.max_number)
+        times = [self._block(number) / number for _ in range(repeat)]
+        return {
+            "median_us": statistics.median(times) * 1e6,
+            "best_us": min(times) * 1e6,
+            "number": number,
+            "repeat": repeat,
+        }
+
+
+def read_frame(path: str):
+    capture = cv2.VideoCapture(path)
+    grabbed, frame = capture.read()
+    capture.release()
+    if not grabbed:
+        raise ValueError(f"no frame in {path}")
+    return frame
+
+
+def packet_cases(payload: bytes) -> List[Case]:
+    height, width = 480, 640
+    extensions = {RTPPacket.EXTENSION_FRAME_SIZE: width.to_bytes(2, "big") + height.to_bytes(2, "big")}
+    rtp = RTPPacket(RTPPacket.TYPE.MJPEG, 1234, 5678, payload, extensions=extensions).get_packet()
+    rtcp = dict(fraction_lost=0.05, cum_lost=12, highest_rcv=3456, ssrc=0x1234, source_ssrc=0x5678)
+    request = RTSPPacket(
+        RTSPPacket.SETUP, "video.avi", 3, 5000, "", blocksize=1400, codecs=["WEBP;quality=70", "JPEG"]
+    ).to_request()
+    response = RTSPPacket.build_response(
+        3, "123456", blocksize=1400, client_port=5000, server_port=19001, ssrc=0x5678,
+        timeout=60, codecs=["WEBP;quality=70", "JPEG"],
+    ).encode()
+    return [
+        Case(
+            "rtp_build",
+            lambda: RTPPacket(RTPPacket.TYPE.MJPEG, 1234, 5678, payload, extensions=extensions).get_packet(),
+        ),
+        Case("rtp_parse", lambda: RTPPacket.from_packet(rtp)),
+        Case("rtcp_roundtrip", lambda: RTCPPacket.from_bitstream(RTCPPacket(**rtcp).get_packet())),
+        Case("rtsp_from_request", lambda: RTSPPacket.from_request(request)),
+        Case("rtsp_from_response", lambda: RTSPPacket.from_response(response)),
+    ]
+
+
+def socket_cases(payload: bytes) -> List[Case]:
+    # a frame sent by Server._send_rtp_packet and received by
+    # Client._recv_rtp_packet, through a pair of UDP sockets on loopback
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    set_socket_buffers(receiver, rcvbuf=SOCKET_BUFFER_SIZE)
+    address = receiver.getsockname()
+
+    server = Server("127.0.0.1", 0, "bench")
+    server._transport = sender
+    server._client_address = address
+    server._datagram_sizer = DatagramSizer(address)
+    client = Client("video.avi", "127.0.0.1", 0, address[1])
+    client._rtp_socket = receiver
+    packet = RTPPacket(RTPPacket.TYPE.MJPEG, 1, 0, payload).get_packet()
+
+    def drain(number: int):
+        receiver.setblocking(False)
+        try:
+            while True:
+                receiver.recv(65536)
+        except BlockingIOError:
+            pass
+        receiver.setblocking(True)
+
+    def fill(number: int):
+        drain(number)
+        client._reassembler = Reassembler()
+        for _ in range(number):
+            server._send_rtp_packet(packet)
+
+    # a block must fit in the receive buffer, datagrams and their overhead
+    max_number = max(1, SOCKET_BUFFER_SIZE // 4 // len(packet))
+    return [
+        Case("send_rtp_packet", lambda: server._send_rtp_packet(packet), drain, max_number),
+        Case("recv_rtp_packet", client._recv_rtp_packet, fill, max_number),
+    ]
+
+
+def stream_cases(path: str) -> List[Case]:
+    streams = [VideoStream(path)]
+
+    def reopen(number: int):
+        # a fresh stream whenever the file could run out within the block
+        stream = streams[0]
+        if stream.frame_count - 1 - stream.current_frame_number < number:
+            stream.close()
+            streams[0] = VideoStream(path)
+
+    return [Case("get_next_frame", lambda: streams[0].get_next_frame(), reopen, streams[0].frame_count)]
+
+
+def ladder_cases(frame) -> List[Case]:
+    # what the read-ahead encodes at each congestion level
+    codec = CODECS["JPEG"]
+    return [
+        Case(f"render_level_{level}", lambda rendition=rendition: render(frame, codec, rendition))
+        for level, rendition in enumerate(Server.ImageTranslator.LADDER)
+    ]
+
+
+def inference_cases(frame) -> List[Case]:
+    try:
+        from utils.inference import inference
+    except ImportError as e:
+        print(f"inference skipped: {e}", file=sys.stderr)
+        return []
+    image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return [Case("inference", lambda: inference(image))]
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    # names of the cases slower than the baseline by more than `threshold`
+    regressions = []
+    print("case                    baseline       now   change")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["median_us"], result["median_us"]
+        change = now / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:22} {before:9.1f} {now:9.1f}  {change:+7.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("-k", "--filter", type=str, default=None, help="only the cases whose name holds it")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--json", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="JSON report of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    frame = read_frame(args.video)
+    payload = CODECS["JPEG"].encode(frame)
+    results = {}
+    # the code under test logs, only the results are printed
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cases = (
+            packet_cases(payload)
+            + socket_cases(payload)
+            + stream_cases(args.video)
+            + ladder_cases(frame)
+            + inference_cases(frame)
+        )
+        for case in cases:
+            if args.filter is None or args.filter in case.name:
+                results[case.name] = case.measure(args.repeat)
+
+    height, width = frame.shape[:2]
+    print(f"{width}x{height} frame, {len(payload)} bytes as JPEG")
+    print("case                      median      best   (us per call)")
+    for name, result in results.items():
+        print(f"{name:22} {result['median_us']:9.1f} {result['best_us']:9.1f}")
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "commit": commit(),
+                    "video": args.video,
+                    "frame": [width, height],
+                    "payload_bytes": len(payload),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} cases slower by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
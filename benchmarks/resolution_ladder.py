@@ -0,0 +1,90 @@
+"""
+Picture quality of the resolution ladder against lowering the quality alone,
+at each congestion level, on the frames of a video file. For every level the
+ladder's bytes per frame are matched by the full-size frame at the highest
+quality that fits in them, and both are compared by their PSNR against the
+source once scaled back to its size, as a client shows them. Run from the
+repository root:
+
+    python -m benchmarks.resolution_ladder <video file> [--codec NAME] [--frames N] [--target DB]
+
+Exits with status 1 when the ladder gains less than the target PSNR at the
+highest level.
+"""
+import argparse
+import sys
+
+import cv2
+import numpy as np
+
+from server.server import Server
+from utils.codecs import CODECS
+
+
+def read_frames(path: str, count: int):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < count:
+        grabbed, frame = capture.read()
+        if not grabbed:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+def encode(frames, codec, downscale: int, quality):
+    # bytes per frame, and PSNR of the frames scaled back to the source size
+    size, psnr = 0, []
+    for frame in frames:
+        height, width = frame.shape[:2]
+        image = frame
+        if downscale > 1:
+            image = cv2.resize(
+                frame, (width // downscale, height // downscale), interpolation=cv2.INTER_AREA
+            )
+        data = codec.encode(image, quality)
+        size += len(data)
+        shown = codec.decode(data)
+        if downscale > 1:
+            shown = cv2.resize(shown, (width, height), interpolation=cv2.INTER_LINEAR)
+        psnr.append(cv2.PSNR(frame, shown))
+    return size / len(frames), float(np.mean(psnr))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("--codec", type=str, default="JPEG")
+    parser.add_argument("--frames", type=int, default=48)
+    parser.add_argument("--target", type=float, default=1.0)
+    args = parser.parse_args()
+
+    codec = CODECS[args.codec.upper()]
+    frames = read_frames(args.video, args.frames)
+    # full-size candidates, from the lowest quality up
+    qualities = range(1, codec.quality + 1, 3)
+    full_size = [(quality, *encode(frames, codec, 1, quality)) for quality in qualities]
+
+    print(f"{len(frames)} frames, {codec}")
+    print("level  ladder                          quality only")
+    gain = 0.0
+    for level, (downscale, quality_share) in enumerate(Server.ImageTranslator.LADDER):
+        quality = None if quality_share is None else codec.quality_at(quality_share)
+        size, psnr = encode(frames, codec, downscale, quality)
+        fitting = [candidate for candidate in full_size if candidate[1] <= size]
+        if fitting:
+            full_quality, full_bytes, full_psnr = fitting[-1]
+            full = f"q{full_quality:<3} {full_bytes:8.0f} B {full_psnr:6.2f} dB"
+        else:
+            full_psnr = None
+            full = "does not fit"
+        print(f"{level:5}  1/{downscale} q{quality or codec.quality:<3} {size:8.0f} B {psnr:6.2f} dB     {full}")
+        if full_psnr is not None:
+            gain = psnr - full_psnr
+        else:
+            gain = float("inf")
+    print(f"gain at the highest level: {gain:.2f} dB")
+    if gain < args.target:
+        print(f"the ladder gains {gain:.2f} dB, below the {args.target:g} dB target")
+        sys.exit(1)
@@ -0,0 +1,349 @@
+"""
+Control-plane parsing benchmark: the incremental parser (utils/rtsp_parser.py)
+behind RTSPPacket against the KMP-based parser it replaced, kept below as the
+reference. Run from the repository root:
+
+    python -m benchmarks.rtsp_parser [-n ITERATIONS]
+
+Besides the time per message, it reports how many messages each parser gets
+right when a pipelined stream is cut into random TCP-like segments, handing
+the old parser one recv() at a time as the old code did.
+"""
+import argparse
+import random
+from time import perf_counter
+
+from utils.interleaved import InterleavedDemuxer
+from utils.rtsp_packet import RTSPPacket
+
+
+# ===========================
+# The replaced parser
+# ===========================
+def KMP_String(pattern, text):
+    a = len(text)
+    b = len(pattern)
+    prefix_arr = get_prefix_arr(pattern, b)
+
+    initial_point = []
+    m = 0
+    n = 0
+
+    while m != a:
+
+        if text[m] == pattern[n]:
+            m += 1
+            n += 1
+
+        else:
+            n = prefix_arr[n-1]
+
+        if n == b:
+            initial_point.append(m-n)
+            n = prefix_arr[n-1]
+        elif n == 0:
+            m += 1
+
+    return initial_point
+def get_prefix_arr(pattern, b):
+    prefix_arr = [0] * b
+    n = 0
+    m = 1
+    while m != b:
+        if pattern[m] == pattern[n]:
+            n += 1
+            prefix_arr[m] = n
+            m += 1
+        elif n != 0:
+                n = prefix_arr[n-1]
+        else:
+            prefix_arr[m] = 0
+            m += 1
+    return prefix_arr
+
+def _param_end(data, start):
+    # a transport parameter ends at the next ';' or at the end of its line
+    line_end = data.find(b"\r\n", start)
+    param_end = data.find(b";", start, line_end)
+    return line_end if param_end == -1 else param_end
+
+def _parse_channels(data, interleaved_index):
+    # "interleaved=<rtp>-<rtcp>", None when the parameter is absent
+    if len(interleaved_index) == 0:
+        return None
+    channels = data[interleaved_index[0]+12 : _param_end(data, interleaved_index[0])]
+    rtp_channel, rtcp_channel = channels.split(b"-")
+    return int(rtp_channel), int(rtcp_channel)
+
+
+class LegacyRTSPPacket(RTSPPacket):
+    @classmethod
+    def from_response(cls, response: bytes):
+        # only response format implemented, taken from server class:
+        # """
+        #   <RTSP_VERSION> <STATUS_CODE> <REASON>\r\n
+        #   CSeq: <SEQUENCE_NUMBER>\r\n
+        #   Session: <SESSION_ID>[;timeout=<SECONDS>]\r\n
+        #   [Blocksize: <DATAGRAM_SIZE>\r\n]
+        #   [Transport: RTP/UDP;client_port=<RTP_PORT>;server_port=<RTCP_PORT>;ssrc=<SSRC>\r\n]
+        #   [Transport: RTP/AVP/TCP;interleaved=<RTP_CHANNEL>-<RTCP_CHANNEL>;ssrc=<SSRC>\r\n]
+        #   [Transport: RTP/AVP;multicast;destination=<GROUP>;port=<RTP_PORT>-<RTCP_PORT>;ttl=<TTL>;ssrc=<SSRC>\r\n]
+        #   \r\n
+        # """
+
+        RTSP_index =  KMP_String(b"RTSP", response)
+        status_index =  KMP_String(f"{cls.RTSP_VERSION} ".encode(), response)
+        CSeq_index =  KMP_String(b"CSeq: ", response)
+        CSeq_end_index = KMP_String(b"\r\nSession: ", response)
+
+        Session_index =  KMP_String(b"Session: ", response)
+        Sessionend_index =  KMP_String(b"\r\n", response)
+        Blocksize_index = KMP_String(b"Blocksize: ", response)
+        server_port_index = KMP_String(b"server_port=", response)
+        ssrc_index = KMP_String(b"ssrc=", response)
+        interleaved_index = KMP_String(b"interleaved=", response)
+        multicast_index = KMP_String(b";multicast", response)
+        destination_index = KMP_String(b"destination=", response)
+        port_index = KMP_String(b";port=", response)
+        ttl_index = KMP_String(b"ttl=", response)
+
+        if (len(RTSP_index) * len(status_index) * len(CSeq_index) * len(Session_index) == 0 ):
+            raise Exception(f"[RTSP response] parsing fail: {response}")
+
+        try:
+            status_code = int(response[status_index[0]+9 : status_index[0]+12])
+        except ValueError:
+            raise Exception(f"[status code] parsing fail: {response}")
+        sequence_number = response[CSeq_index[0]+6 : CSeq_end_index[0]].decode()
+        session_end = min(i for i in Sessionend_index if i > Session_index[0])
+        session_id, _, session_params = response[Session_index[0]+9 : session_end].decode().partition(";")
+        timeout = None
+        if session_params.startswith("timeout="):
+            try:
+                timeout = int(session_params[8:])
+            except ValueError:
+                raise Exception(f"[session timeout] parsing fail: {response}")
+
+        blocksize = None
+        if ( len(Blocksize_index) != 0):
+            blocksize_end = min(i for i in Sessionend_index if i > Blocksize_index[0])
+            blocksize = response[Blocksize_index[0]+11 : blocksize_end].decode()
+            try:
+                blocksize = int(blocksize)
+            except ValueError:
+                raise Exception(f"[blocksize] parsing fail: {response}")
+
+        ssrc = None
+        server_port = None
+        try:
+            if ( len(ssrc_index) != 0):
+                ssrc = int(response[ssrc_index[0]+5 : _param_end(response, ssrc_index[0])], 16)
+            if ( len(server_port_index) != 0):
+                server_port = int(response[server_port_index[0]+12 : _param_end(response, server_port_index[0])])
+            interleaved = _parse_channels(response, interleaved_index)
+            destination = None
+            ttl = None
+            if ( len(multicast_index) * len(destination_index) * len(port_index) != 0):
+                group = response[destination_index[0]+12 : _param_end(response, destination_index[0])].decode()
+                ports = response[port_index[0]+6 : _param_end(response, port_index[0]+1)]
+                destination = group, int(ports.split(b"-")[0])
+            if ( len(ttl_index) != 0):
+                ttl = int(response[ttl_index[0]+4 : _param_end(response, ttl_index[0])])
+        except ValueError:
+            raise Exception(f"[transport] parsing fail: {response}")
+
+        try:
+            sequence_number = int(sequence_number)
+        except (ValueError, TypeError):
+            raise Exception(f"[sequence number] parsing fail: {response}")
+
+        if session_id is None:
+            raise Exception(f"[session id] parsing fail: {response}")
+
+        return cls(
+            request_type=RTSPPacket.RESPONSE,
+            sequence_number=sequence_number,
+            session_id=session_id,
+            blocksize=blocksize,
+            ssrc=ssrc,
+            server_port=server_port,
+            interleaved=interleaved,
+            multicast=len(multicast_index) != 0,
+            destination=destination,
+            ttl=ttl,
+            status_code=status_code,
+            timeout=timeout
+        )
+
+    @classmethod
+    def from_request(cls, request: bytes):
+
+        request_type_endindex =  KMP_String(b" rtsp://", request)
+        RTSP_index =  KMP_String(b"RTSP", request)
+        CSeq_index =  KMP_String(b"CSeq: ", request)
+        endindex = KMP_String(b"\r\n", request)
+
+        if (len(request_type_endindex) * len(RTSP_index) * len(CSeq_index) * len(endindex) == 0 ):
+            raise InvalidRTSPRequest(f"[request] parsing fail: {request}")
+
+        request_type = request[    : request_type_endindex[0] ].decode()
+
+        if request_type not in (RTSPPacket.SETUP,
+                                RTSPPacket.PLAY,
+                                RTSPPacket.PAUSE,
+                                RTSPPacket.TEARDOWN,
+                                RTSPPacket.GET_PARAMETER):
+            raise InvalidRTSPRequest(f"[invalid request type]: {request}")
+
+        video_file_path = request[request_type_endindex[0]+8 : RTSP_index[0] -1 ].decode()
+        sequence_number = request[CSeq_index[0]+6 : endindex[1] ].decode()
+
+        Session_index =  KMP_String(b"Session: ", request)
+        client_port_index = KMP_String(b"client_port", request)
+        Blocksize_index = KMP_String(b"Blocksize: ", request)
+        tcp_index = KMP_String(cls.TRANSPORT_TCP.encode(), request)
+        interleaved_index = KMP_String(b"interleaved=", request)
+        multicast_index = KMP_String(b";multicast", request)
+
+        session_id = None
+        dst_port = None
+        blocksize = None
+
+        if ( len(Session_index) != 0):
+            session_id = request[ Session_index[0]+9 : endindex[2] ].decode()
+        if ( len(client_port_index) != 0):
+            dst_port = request[ client_port_index[0]+12 : endindex[2] ].decode()
+        if ( len(Blocksize_index) != 0):
+            blocksize_end = min(i for i in endindex if i > Blocksize_index[0])
+            blocksize = request[ Blocksize_index[0]+11 : blocksize_end ].decode()
+            try:
+                blocksize = int(blocksize)
+            except ValueError:
+                raise InvalidRTSPRequest(f"[blocksize] parsing fail: {request}")
+        try:
+            interleaved = _parse_channels(request, interleaved_index)
+        except ValueError:
+            raise InvalidRTSPRequest(f"[interleaved channels] parsing fail: {request}")
+
+        if request_type == RTSPPacket.SETUP and len(tcp_index) != 0:
+            if interleaved is None:
+                raise InvalidRTSPRequest(f"[interleaved channels] missing: {request}")
+            dst_port = None
+        elif request_type == RTSPPacket.SETUP and len(multicast_index) != 0:
+            dst_port = None
+        elif request_type == RTSPPacket.SETUP:
+            try:
+                dst_port = int(dst_port)
+            except (ValueError, TypeError):
+                raise InvalidRTSPRequest(f"[RTP port] parsing fail")
+        try:
+            sequence_number = int(sequence_number)
+        except (ValueError, TypeError):
+            raise InvalidRTSPRequest(f"[sequence number] parsing fail: {request}")
+
+        return cls(
+            request_type,
+            video_file_path,
+            sequence_number,
+            dst_port,
+            session_id,
+            blocksize,
+            interleaved=interleaved,
+            multicast=len(multicast_index) != 0
+        )
+
+
+# ===========================
+# Workload
+# ===========================
+def sample_requests():
+    return [
+        RTSPPacket(RTSPPacket.SETUP, "videos/movie.mjpeg", 1, 25000, "", 1400).to_request(),
+        RTSPPacket(RTSPPacket.SETUP, "videos/movie.mjpeg", 1, None, "", 1400, interleaved=(0, 1)).to_request(),
+        RTSPPacket(RTSPPacket.PLAY, "videos/movie.mjpeg", 2, None, "123456-1").to_request(),
+        RTSPPacket(RTSPPacket.PAUSE, "videos/movie.mjpeg", 3, None, "123456-1").to_request(),
+        RTSPPacket(RTSPPacket.GET_PARAMETER, "videos/movie.mjpeg", 4, None, "123456-1").to_request(),
+    ]
+
+
+def sample_responses():
+    return [
+        RTSPPacket.build_response(
+            1, "123456-1", 1400, 25000, 19001, 0x1234ABCD, timeout=60
+        ).encode(),
+        RTSPPacket.build_response(
+            1, "123456-1", 1400, ssrc=0x1234ABCD, interleaved=(0, 1), timeout=60
+        ).encode(),
+        RTSPPacket.build_response(
+            1, "123456-1", 1400, ssrc=0x1234ABCD, destination=("239.255.42.1", 5004), ttl=1
+        ).encode(),
+        RTSPPacket.build_response(2, "123456-1").encode(),
+    ]
+
+
+def time_per_message(parse, messages, iterations) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            parse(message)
+    return (perf_counter() - start) / (iterations * len(messages))
+
+
+def segments(stream: bytes, rng: random.Random):
+    # the stream as recv() could return it: random cuts, small and large
+    i = 0
+    while i < len(stream):
+        size = rng.choice((rng.randint(1, 40), rng.randint(40, 600)))
+        yield stream[i:i + size]
+        i += size
+
+
+def count_legacy(stream, rng) -> int:
+    parsed = 0
+    for segment in segments(stream, rng):
+        try:
+            LegacyRTSPPacket.from_request(segment)
+            parsed += 1
+        except Exception:
+            pass
+    return parsed
+
+
+def count_incremental(stream, rng) -> int:
+    demuxer = InterleavedDemuxer()
+    parsed = 0
+    for segment in segments(stream, rng):
+        demuxer.feed(segment)
+        for message in demuxer:
+            RTSPPacket.from_request(message)
+            parsed += 1
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--ITERATIONS", type=int, default=2000)
+    parser.add_argument("--SEED", type=int, default=1)
+    args = parser.parse_args()
+
+    requests = sample_requests()
+    responses = sample_responses()
+    for name, messages, legacy, current in (
+        ("request", requests, LegacyRTSPPacket.from_request, RTSPPacket.from_request),
+        ("response", responses, LegacyRTSPPacket.from_response, RTSPPacket.from_response),
+    ):
+        legacy_time = time_per_message(legacy, messages, args.ITERATIONS)
+        current_time = time_per_message(current, messages, args.ITERATIONS)
+        print(
+            f"{name:>8}: KMP {legacy_time * 1e6:7.1f} us  "
+            f"incremental {current_time * 1e6:7.1f} us  "
+            f"x{legacy_time / current_time:.1f}"
+        )
+
+    stream = b"".join(requests * 200)
+    total = len(requests) * 200
+    print(
+        f"segmented stream of {total} messages: "
+        f"KMP parsed {count_legacy(stream, random.Random(args.SEED))}, "
+        f"incremental parsed {count_incremental(stream, random.Random(args.SEED))}"
+    )
@@ -0,0 +1,100 @@
+"""
+A session against a simulated network on a virtual clock (see
+utils/simulation.py): how the congestion control reacts to impairments,
+over minutes or hours of the session, in the time it takes to encode its
+frames. Run from the repository root:
+
+    python -m benchmarks.simulate <video file> [--duration SECONDS] [--seed N]
+        [--codec NAME] [--blocksize BYTES] [--uplink] [--json PATH]
+        [impairments, as for main_proxy.py: --loss, --rate, --profile...]
+
+Prints one line per change of congestion level and a summary; --json writes
+the whole timeline, a sample per second ("-" for stdout). Two runs with the
+same seed give the same timeline. The summary compares the packets the
+client counted as lost with the frames that didn't arrive: past 65536
+packets (45 minutes at 24 fps, e.g. --duration 3600) the RTP sequence
+numbers wrap, and the two only agree if the client's statistics follow.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+from collections import Counter
+
+from utils.impairment import add_arguments, schedule_from_arguments
+from utils.simulation import Simulation
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("--duration", type=float, default=300.0, help="seconds of the session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--codec", type=str, default=None)
+    parser.add_argument("--blocksize", type=int, default=None, help="RTP datagram size")
+    parser.add_argument("--uplink", action="store_true", help="impair the RTCP reports the same way")
+    parser.add_argument("--json", type=str, default=None, help="write the timeline there, - for stdout")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    downlink = schedule_from_arguments(args)
+    # the server and the client log every packet
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation = Simulation(
+            args.video,
+            downlink,
+            uplink=downlink if args.uplink else None,
+            seed=args.seed,
+            codecs=None if args.codec is None else [args.codec],
+            blocksize=args.blocksize,
+        )
+        try:
+            timeline = simulation.run(args.duration)
+        finally:
+            simulation.close()
+
+    client = simulation.client
+    summary = {
+        "duration": args.duration,
+        "wall_time": simulation.wall_time,
+        "speedup": args.duration / simulation.wall_time,
+        "frames_sent": simulation.frames_sent,
+        "frames_received": simulation.frames_received,
+        "bytes_received": simulation.bytes_received,
+        "frames_lost": simulation.frames_sent - simulation.frames_received,
+        # as counted by the client from the RTP sequence numbers
+        "packets_lost": client.stat_cumulative_lost,
+        "sequence_wraps": client._seq_cycles // client.SEQ_MOD,
+        "reports_received": simulation.reports,
+        "downlink": simulation.downlink.stats,
+        "uplink": simulation.uplink.stats,
+        # seconds spent at each level
+        "levels": dict(sorted(Counter(sample["compression_level"] for sample in timeline).items())),
+    }
+    if args.json == "-":
+        json.dump({"summary": summary, "timeline": timeline}, sys.stdout, indent=2)
+        print()
+        sys.exit()
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"summary": summary, "timeline": timeline}, f, indent=2)
+
+    print("    time  level  send delay   lost     fps    kB/s")
+    level = None
+    for sample in timeline:
+        if sample["compression_level"] != level:
+            level = sample["compression_level"]
+            print(
+                f"{sample['time']:7.0f}s  {level:5}  {sample['send_delay_ms']:7.1f} ms  "
+                f"{sample['fraction_lost']:5.1%}  {sample['fps']:6.1f}  {sample['bytes_per_second'] / 1000:6.0f}"
+            )
+    print(
+        f"{args.duration:.0f} s simulated in {simulation.wall_time:.1f} s ({summary['speedup']:.0f}x), "
+        f"{simulation.frames_received}/{simulation.frames_sent} frames received, "
+        f"{simulation.reports} reports"
+    )
+    print(
+        f"{summary['packets_lost']} packets counted lost by the client for {summary['frames_lost']} frames lost, "
+        f"{summary['sequence_wraps']} sequence number wraps"
+    )
+    print("seconds per level: " + ", ".join(f"{level}: {seconds}" for level, seconds in summary["levels"].items()))
@@ -0,0 +1,78 @@
+"""
+Time to first frame on loopback: from the TCP connect to the first decoded
+frame, with SETUP and PLAY sent one after the other or pipelined. Run from
+the repository root:
+
+    python -m benchmarks.startup_latency <video file> [-n RUNS] [--target MS]
+
+Exits with status 1 when the pipelined median exceeds the target.
+"""
+import argparse
+import contextlib
+import io
+import statistics
+import sys
+from threading import Thread
+from time import perf_counter, sleep
+
+from client.client import Client
+from server.session_manager import SessionManager
+
+
+def time_to_first_frame(video: str, port: int, rtp_port: int, pipelined: bool, transport: str) -> float:
+    client = Client(
+        video, "127.0.0.1", port, rtp_port,
+        interleaved=transport == "tcp", multicast=transport == "multicast",
+    )
+    start = perf_counter()
+    client.establish_rtsp_connection()
+    if pipelined:
+        client.send_setup_request(play=True)
+    else:
+        client.send_setup_request()
+        client.send_play_request()
+    while client.get_next_frame() is None:
+        sleep(0.0005)
+    elapsed = perf_counter() - start
+    client.send_teardown_request()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("-n", "--RUNS", type=int, default=20)
+    parser.add_argument("-p", "--PORT", type=int, default=5640)
+    parser.add_argument("--transport", choices=("udp", "tcp", "multicast"), default="udp")
+    parser.add_argument("--target", type=float, default=150, help="milliseconds")
+    args = parser.parse_args()
+
+    # the server and client are chatty, only the results are printed
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        manager = SessionManager("127.0.0.1", args.PORT, "bench", rtcp_port=args.PORT + 1)
+        Thread(target=manager.serve_forever, daemon=True).start()
+        sleep(0.2)
+        results = {}
+        for pipelined in (False, True):
+            samples = []
+            for run in range(args.RUNS):
+                rtp_port = args.PORT + 10 + 2 * run + (2 * args.RUNS if pipelined else 0)
+                samples.append(
+                    time_to_first_frame(args.video, args.PORT, rtp_port, pipelined, args.transport)
+                )
+            results[pipelined] = samples
+        manager.close()
+
+    for pipelined, samples in results.items():
+        samples = sorted(s * 1000 for s in samples)
+        print(
+            f"{'pipelined' if pipelined else 'sequential':>10}: "
+            f"median {statistics.median(samples):6.1f} ms  "
+            f"p90 {samples[int(0.9 * (len(samples) - 1))]:6.1f} ms  "
+            f"max {samples[-1]:6.1f} ms"
+        )
+    median = statistics.median(results[True]) * 1000
+    if median > args.target:
+        print(f"pipelined median {median:.1f} ms is above the {args.target:g} ms target")
+        sys.exit(1)
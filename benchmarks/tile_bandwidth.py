@@ -0,0 +1,61 @@
+"""
+Bytes per frame with tiled frames against full frames, on the frames of a
+video file, and what the tiles cost to encode and composite. Run from the
+repository root:
+
+    python -m benchmarks.tile_bandwidth <video file> [--tile-size PIXELS] [--target RATIO]
+
+Exits with status 1 when tiles save less than the target ratio.
+"""
+import argparse
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from utils.tiles import FULL, REPEAT, TILES, TileCompositor, TileEncoder
+from utils.video_stream import VideoStream
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("--tile-size", type=int, default=TileEncoder.DEFAULT_TILE_SIZE)
+    parser.add_argument("--target", type=float, default=10)
+    args = parser.parse_args()
+
+    video_stream = VideoStream(args.video)
+    frames = []
+    while not video_stream.at_end():
+        frames.append(video_stream.get_next_frame())
+    video_stream.close()
+
+    encoder = TileEncoder(args.tile_size)
+    compositor = TileCompositor()
+    full_bytes = tiled_bytes = 0
+    encode_time = composite_time = 0.0
+    errors = []
+    for frame in frames:
+        start = perf_counter()
+        payload = encoder.encode(frame)
+        encode_time += perf_counter() - start
+        start = perf_counter()
+        shown = compositor.apply(payload)
+        composite_time += perf_counter() - start
+        full_bytes += len(frame)
+        tiled_bytes += len(payload)
+        source = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+        errors.append(cv2.absdiff(shown, source).mean())
+
+    ratio = full_bytes / tiled_bytes
+    print(f"{len(frames)} frames, tiles of {encoder.tile_size} px")
+    print(f"      full: {full_bytes / len(frames):9.0f} bytes/frame")
+    print(f"     tiled: {tiled_bytes / len(frames):9.0f} bytes/frame  ({ratio:.1f}x less)")
+    print(f"    frames: {encoder.counts[FULL]} full, {encoder.counts[TILES]} tiles, {encoder.counts[REPEAT]} repeats")
+    print(f"    encode: {encode_time / len(frames) * 1000:6.2f} ms/frame, "
+          f"composite {composite_time / len(frames) * 1000:6.2f} ms/frame")
+    print(f"     error: {max(errors):6.2f} mean absolute difference at worst")
+    if ratio < args.target:
+        print(f"tiles save {ratio:.1f}x, below the {args.target:g}x target")
+        sys.exit(1)
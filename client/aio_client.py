@@ -0,0 +1,344 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from client.client import Client
+from utils.datagram import SOCKET_BUFFER_SIZE, set_socket_buffers
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import NptRange, RTSPPacket, RTSPStatusError
+from utils.rtsp_parser import RTSPParser
+from utils.sdp import MediaDescription
+from utils.session_state import SessionState
+
+
+# ===========================
+# asyncio counterpart of Client: RTSP over a stream, RTP and RTCP over datagram
+# endpoints, RTCP reports paced by loop timers and JPEG decoding offloaded to
+# an executor. Statistics, `get_next_frame()` and `frames()`, iterated with
+# `async for`, behave as in Client.
+# ===========================
+class AsyncClient(Client):
+    def __init__(
+        self,
+        file_path: str,
+        remote_host_address: str,
+        remote_host_port: int,
+        rtp_port: int,
+        executor: Union[None, Executor] = None,
+        **kwargs,
+    ):
+        super().__init__(
+            file_path, remote_host_address, remote_host_port, rtp_port, **kwargs
+        )
+        if self.interleaved is not None or self.multicast:
+            raise ValueError("AsyncClient receives RTP over unicast UDP only")
+        self._executor = executor  # None selects the loop's default executor
+        self._reader: Union[None, asyncio.StreamReader] = None
+        self._writer: Union[None, asyncio.StreamWriter] = None
+        self._rtp_transport: Union[None, asyncio.DatagramTransport] = None
+        self._rtcp_transport: Union[None, asyncio.DatagramTransport] = None
+        self._rtcp_timer: Union[None, asyncio.TimerHandle] = None
+        self._decode_queue: Union[None, asyncio.Queue] = None
+        self._decoder: Union[None, asyncio.Task] = None
+        self._keepalive: Union[None, asyncio.Task] = None
+        self._parser = RTSPParser()
+        # the keep-alive must not read a response meant for another request
+        self._request_lock = asyncio.Lock()
+
+    async def establish_rtsp_connection(self):
+        if self.is_rtsp_connected:
+            print("RTSP is already connected.")
+            return
+        print(f"Connecting to {self.remote_host_address}:{self.remote_host_port}...")
+        self._reader, self._writer = await asyncio.open_connection(
+            self.remote_host_address, self.remote_host_port
+        )
+        self.is_rtsp_connected = True
+
+    def close_rtsp_connection(self):
+        if not self.is_rtsp_connected:
+            print("RTSP is not connected.")
+            return
+        self._writer.close()
+        self.is_rtsp_connected = False
+
+    async def _send_request(self, request_type=RTSPPacket.INVALID) -> RTSPPacket:
+        return (await self._send_requests(request_type))[0]
+
+    async def _send_requests(
+        self, *request_types, npt_range: Optional[NptRange] = None, scale: Optional[float] = None
+    ) -> List[RTSPPacket]:
+        # pipelined as in Client._send_requests()
+        if not self.is_rtsp_connected:
+            raise Exception(
+                "rtsp connection not established. run `establish_rtsp_connection()`"
+            )
+        responses = []
+        async with self._request_lock:
+            for request_type in request_types:
+                self._writer.write(RTSPPacket(
+                    request_type,
+                    self.file_path,
+                    self._current_sequence_number,
+                    self.rtp_port,
+                    self.session_id,
+                    self.blocksize,
+                    npt_range=npt_range,
+                    scale=scale,
+                    tile_size=self.tile_size,
+                    codecs=self.codecs,
+                ).to_request())
+                self._current_sequence_number += 1
+            self._last_request = self.clock.monotonic()
+            for _ in request_types:
+                response = await self._get_response()
+                if response.status_code != RTSPPacket.OK:
+                    raise RTSPStatusError(
+                        response.status_code, RTSPPacket.REASONS.get(response.status_code, "")
+                    )
+                responses.append(response)
+        return responses
+
+    async def send_options_request(self) -> RTSPPacket:
+        return await self._send_request(RTSPPacket.OPTIONS)
+
+    async def send_describe_request(self) -> RTSPPacket:
+        response = await self._send_request(RTSPPacket.DESCRIBE)
+        if response.body is None:
+            raise Exception(f"server did not describe the source: {response}")
+        self.media = MediaDescription.from_sdp(response.body)
+        return response
+
+    async def _get_response(self, size=Client.DEFAULT_CHUNK_SIZE) -> RTSPPacket:
+        message = self._parser.next()
+        while message is None:
+            rcv = await self._reader.read(size)
+            if not rcv:
+                raise ConnectionError("server closed the RTSP connection")
+            self._parser.feed(rcv)
+            message = self._parser.next()
+        return RTSPPacket.from_response(message)
+
+    async def send_setup_request(self, play: bool = False) -> RTSPPacket:
+        loop = asyncio.get_running_loop()
+        self._decode_queue = asyncio.Queue()
+        self._decoder = loop.create_task(self._decode_frames())
+        # bound before asking, so the first packets can't get lost
+        self._rtp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _RtpProtocol(self),
+            local_addr=(self.DEFAULT_LOCAL_HOST, self.rtp_port),
+        )
+        set_socket_buffers(
+            self._rtp_transport.get_extra_info("socket"), rcvbuf=SOCKET_BUFFER_SIZE
+        )
+        if play:
+            # datagrams arriving ahead of the PLAY response are kept
+            self._play_pending = True
+            self.stat_start_time = round(self.clock.time() * 1000)
+            try:
+                response, _ = await self._send_requests(RTSPPacket.SETUP, RTSPPacket.PLAY)
+            except Exception:
+                self._play_pending = False
+                raise
+        else:
+            response = await self._send_request(RTSPPacket.SETUP)
+        self._state.set(SessionState.PAUSED)
+        self.session_id = response.session_id
+        self.session_timeout = response.timeout
+        if response.blocksize is not None:
+            self.blocksize = response.blocksize
+        self.tile_size = response.tile_size
+        self.codecs = response.codecs
+        if response.ssrc is not None:
+            self.remote_ssrc = response.ssrc
+        if response.server_port is not None:
+            self.remote_rtcp_port = response.server_port
+        self._rtcp_transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol,
+            remote_addr=(self.remote_host_address, self.remote_rtcp_port),
+        )
+        self._rtcp_sender = self.RtcpSender(self, self.RTCP_PERIOD / 1000.0)
+        if self.session_timeout:
+            self._keepalive = loop.create_task(self._keep_alive())
+        if play:
+            self._start_playing()
+        return response
+
+    async def _keep_alive(self):
+        period = self.session_timeout / 2
+        while True:
+            await asyncio.sleep(period - (self.clock.monotonic() - self._last_request))
+            if self.clock.monotonic() - self._last_request < period:
+                continue
+            try:
+                await self._send_request(RTSPPacket.GET_PARAMETER)
+            except (ConnectionError, OSError, RTSPStatusError) as e:
+                print(f"Keep-alive failed: {e}")
+                return
+
+    async def send_play_request(
+        self, npt_range: Optional[NptRange] = None, scale: Optional[float] = None
+    ) -> RTSPPacket:
+        self._play_pending = True
+        self.stat_start_time = round(self.clock.time() * 1000)
+        try:
+            response, = await self._send_requests(RTSPPacket.PLAY, npt_range=npt_range, scale=scale)
+        except Exception:
+            self._play_pending = False
+            raise
+        self._repositioned(response)
+        self._start_playing()
+        return response
+
+    def _start_playing(self):
+        super()._start_playing()
+        self._schedule_rtcp_report()
+
+    async def send_pause_request(self) -> RTSPPacket:
+        response = await self._send_request(RTSPPacket.PAUSE)
+        self._state.set(SessionState.PAUSED)
+        self._cancel_rtcp_report()
+        return response
+
+    async def send_teardown_request(self) -> RTSPPacket:
+        response = await self._send_request(RTSPPacket.TEARDOWN)
+        self._state.set(SessionState.TEARDOWN)
+        self.is_rtsp_connected = False
+        self._cancel_rtcp_report()
+        self._rtp_transport.close()
+        self._rtcp_transport.close()
+        self._decoder.cancel()
+        self._end_frames()
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+        self._writer.close()
+        return response
+
+    def _schedule_rtcp_report(self):
+        if self._rtcp_timer is None:
+            loop = asyncio.get_running_loop()
+            self._rtcp_timer = loop.call_later(
+                self._rtcp_sender.interval, self._send_rtcp_report
+            )
+
+    def _cancel_rtcp_report(self):
+        if self._rtcp_timer is not None:
+            self._rtcp_timer.cancel()
+            self._rtcp_timer = None
+
+    def _send_rtcp_report(self):
+        self._rtcp_timer = None
+        if not self.is_receiving_rtp:
+            return
+        self._rtcp_transport.sendto(self._rtcp_sender._build_rtcp_packet().get_packet())
+        self._schedule_rtcp_report()
+
+    def _on_rtp_packet(self, packet: RTPPacket):
+        cur_time = round(self.clock.time() * 1000)  # Get current time in ms
+        self.stat_total_play_time += cur_time - self.stat_start_time
+        self.stat_start_time = cur_time
+        self._update_stats(packet)
+        if self._frame_queue is not None:
+            self._queue_frame(packet)
+        else:
+            self._decode_queue.put_nowait(packet)
+
+    def frames(
+        self,
+        output: str = Client.FRAME_IMAGE,
+        max_pending: int = Client.DEFAULT_MAX_PENDING,
+        drop: bool = False,
+        idle_timeout: Optional[float] = None,
+    ) -> AsyncIterator[Tuple[Union[bytes, np.ndarray, Image.Image], int]]:
+        # as Client.frames(), decoded in the executor; instead of waiting, a
+        # full queue pauses reading from the RTP socket
+        self._check_frames_options(output, drop)
+        queue = asyncio.Queue(max_pending)
+        self._frame_drop = drop
+        self._frame_queue = queue
+        return self._iterate_frames(queue, output, idle_timeout)
+
+    async def _iterate_frames(
+        self, queue: asyncio.Queue, output: str, idle_timeout: Optional[float]
+    ):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if idle_timeout is None:
+                    packet = await queue.get()
+                else:
+                    try:
+                        packet = await asyncio.wait_for(queue.get(), self.QUEUE_POLL)
+                    except asyncio.TimeoutError:
+                        if self._is_idle(idle_timeout):
+                            return
+                        continue
+                if self._rtp_transport is not None:
+                    # does nothing unless paused by `_queue_frame()`
+                    self._rtp_transport.resume_reading()
+                if packet is None:
+                    return
+                frame = await loop.run_in_executor(
+                    self._executor, self._convert_frame, packet, output
+                )
+                if frame is not None:
+                    yield frame, packet.sequence_number
+        finally:
+            if self._frame_queue is queue:
+                self._frame_queue = None
+
+    def _queue_frame(self, packet: RTPPacket):
+        queue = self._frame_queue
+        if self._frame_drop:
+            self._put_dropping(queue, packet)
+            return
+        queue.put_nowait(packet)
+        if queue.full():
+            self._rtp_transport.pause_reading()
+
+    def _flush_frames(self):
+        queue = self._frame_queue
+        if queue is None:
+            return
+        try:
+            while True:
+                if queue.get_nowait() is None:
+                    queue.put_nowait(None)
+                    break
+        except asyncio.QueueEmpty:
+            pass
+        if self._rtp_transport is not None:
+            self._rtp_transport.resume_reading()
+
+    def _put_dropping(self, queue: asyncio.Queue, item: Optional[RTPPacket]):
+        if queue.full():
+            queue.get_nowait()
+            self.stat_frames_dropped += 1
+        queue.put_nowait(item)
+
+    async def _decode_frames(self):
+        # one decoder per client keeps frames in order, while the decodes of
+        # different clients run in parallel in the executor
+        loop = asyncio.get_running_loop()
+        while True:
+            packet = await self._decode_queue.get()
+            frame = await loop.run_in_executor(
+                self._executor, self._get_frame_from_packet, packet
+            )
+            if frame is not None:
+                self._frame_buffer.append(frame)
+
+
+class _RtpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client: AsyncClient) -> None:
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        if not data:
+            return
+        packet = self.client._reassemble(data)
+        if packet is not None and (self.client.is_receiving_rtp or self.client._play_pending):
+            self.client._on_rtp_packet(packet)
@@ -1,30 +1,60 @@
 import socket
-from threading import Thread, Timer
-from typing import Union, Optional, List, Tuple
-from time import sleep, time
+from queue import Empty, Full, Queue
+from threading import Lock, Thread, Timer, current_thread
+from typing import Callable, Dict, Iterator, Set, Union, Optional, List, Tuple
+from time import sleep
 from PIL import Image
 from io import BytesIO
-from utils.rtcp_packet import RTCPPacket
+from utils.rtcp_packet import (
+    RTCP_BANDWIDTH_FRACTION,
+    InvalidRequest,
+    RTCPPacket,
+    rtcp_interval,
+)
+from utils.session_state import SessionState
 
 import struct
 import cv2
 import numpy as np
 
-from utils.rtsp_packet import RTSPPacket
-from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import NptRange, RTSPPacket, RTSPStatusError, SimulcastLayer
+from utils.rtsp_parser import RTSPMessage
+from utils.sdp import MediaDescription
+from utils.clock import SYSTEM_CLOCK, Clock
+from utils.codecs import by_payload_type
+from utils.tiles import TileCompositor
+from utils.rtp_packet import InvalidPacketException, RTPPacket
 from utils.video_stream import VideoStream
+from utils.datagram import (
+    IP_UDP_OVERHEAD,
+    MAX_DGRAM,
+    SOCKET_BUFFER_SIZE,
+    Reassembler,
+    mtu_to_dgram,
+    probe_path_mtu,
+    set_socket_buffers,
+)
+from utils.interleaved import (
+    RTCP_CHANNEL,
+    RTP_CHANNEL,
+    InterleavedDemuxer,
+    send_interleaved,
+)
+from utils.multicast import (
+    join_group,
+    leave_group,
+    open_group_socket,
+    wake_local_listeners,
+)
 
 
 class Client:
     DEFAULT_CHUNK_SIZE = 4096
+    INTERLEAVED_CHUNK_SIZE = 65536  # reads carrying whole frames of video
     DEFAULT_RECV_DELAY = 20  # in milliseconds
 
     DEFAULT_LOCAL_HOST = "127.0.0.1"
 
-    RTP_SOFT_TIMEOUT = 5  # in milliseconds
-    # for allowing simulated non-blocking operations
-    # (useful for keyboard break)
-    RTSP_SOFT_TIMEOUT = 100  # in milliseconds
     # if it's present at the end of chunk, client assumes
     # it's the last chunk for current frame (end of frame)
     PACKET_HEADER_LENGTH = 5
@@ -32,8 +62,30 @@ class Client:
     # =================
     # RTCP variables
     # =================
-    RTCP_RCV_PORT = 19001  # port where server will receive the RTP packets
+    RTCP_RCV_PORT = 19001  # default port where server will receive the RTCP packets
     RTCP_PERIOD = 400  # how often to send RTCP packet
+    # sequence number tracking, RFC 3550 A.1
+    SEQ_MOD = 1 << 16
+    MAX_DROPOUT = 3000  # packets ahead still taken as a gap
+    MAX_MISORDER = 100  # packets behind still taken as reordered
+
+    # =================
+    # Simulcast layer switching
+    # =================
+    LAYER_DOWN_LOSS = 0.1  # fraction lost in a report interval above which to move down a layer
+    LAYER_UP_INTERVALS = 10  # loss-free report intervals before moving back up
+    LAYER_HOLD = 2.0  # seconds after a switch or PLAY before the next move
+
+    # =================
+    # Frame iterator, see `frames()`
+    # =================
+    FRAME_BYTES = "bytes"  # the payload as received, compressed
+    FRAME_ARRAY = "array"  # BGR numpy array at the frame size
+    FRAME_IMAGE = "image"  # RGB PIL image, as `get_next_frame()`
+    FRAME_OUTPUTS = (FRAME_BYTES, FRAME_ARRAY, FRAME_IMAGE)
+    DEFAULT_MAX_PENDING = 8  # frames received but not consumed yet
+    QUEUE_POLL = 0.1  # seconds between two checks of a receiver waiting for room
+    TEARDOWN_JOIN_TIMEOUT = 1.0  # seconds TEARDOWN waits for the RTP receiver
 
     def __init__(
         self,
@@ -41,24 +93,89 @@ class Client:
         remote_host_address: str,
         remote_host_port: int,
         rtp_port: int,
+        blocksize: int = MAX_DGRAM,
+        interleaved: bool = False,
+        multicast: bool = False,
+        tile_size: Optional[int] = None,
+        codecs: Optional[List[str]] = None,
+        on_frame: Optional[Callable[[RTPPacket], None]] = None,
+        clock: Clock = SYSTEM_CLOCK,
     ):
+        if interleaved and multicast:
+            raise ValueError("choose either interleaved or multicast transport")
+        # session time: keep-alive, layer switches, reports and statistics;
+        # the RTCP thread still sleeps on the wall clock, see Server
+        self.clock = clock
         self._rtsp_connection: Union[None, socket.socket] = None
         self._rtp_socket: Union[None, socket.socket] = None
         self._rtp_receive_thread: Union[None, Thread] = None
+        # with interleaved transport, RTP and RTCP share the RTSP connection:
+        # one thread reads it and queues the responses for `_get_response()`
+        self.interleaved = (RTP_CHANNEL, RTCP_CHANNEL) if interleaved else None
+        self._demuxer = InterleavedDemuxer()
+        self._rtsp_receive_thread: Union[None, Thread] = None
+        self._responses: "Queue[Optional[RTSPMessage]]" = Queue()
+        self._rtsp_send_lock = Lock()
+        # one request in flight at a time, the keep-alive shares the connection
+        self._request_lock = Lock()
+        self._keepalive_thread: Union[None, Thread] = None
+        self._last_request = 0.0
+        self.session_timeout: Optional[int] = None  # from SETUP, in seconds
+        # a PLAY is on its way: media may arrive ahead of its response
+        self._play_pending = False
+        self.media: Optional[MediaDescription] = None  # from DESCRIBE
+        # range and scale the server plays, from the last PLAY response
+        self.npt_range: Optional[NptRange] = None
+        self.scale = 1.0
+        # multicast delivery: the group and its TTL are assigned in SETUP
+        self.multicast = multicast
+        self.multicast_destination: Optional[Tuple[str, int]] = None
+        self.multicast_ttl = 1
+        self._group_joined = False
+        # the group the RTP socket receives: the multicast destination, or
+        # the group of the simulcast layer received
+        self._rtp_group: Optional[Tuple[str, int]] = None
+        self._rtp_group_lock = Lock()
+        # simulcast layers of the group from SETUP, the full size one first;
+        # the layer received and the one to move to after the current frame,
+        # picked by the loss reported unless `adaptive_layers` is off
+        self.layers: Optional[List[SimulcastLayer]] = None
+        self.layer = 0
+        self._next_layer = 0
+        self.adaptive_layers = True
+        self._layer_hold_until = 0.0
+        self._loss_free_intervals = 0
+        self._reassembler = Reassembler()
+        # tiled frames are asked for in SETUP, None once the server declined
+        self.tile_size = tile_size
+        self._compositor = TileCompositor()
+        # payload codecs accepted, by preference ("WEBP;quality=70", see
+        # utils/codecs.py), replaced by those the server agreed to in SETUP
+        self.codecs = codecs
         self._frame_buffer: List[Image.Image] = []
+        # called by the receive thread with every complete frame, left
+        # undecoded, instead of buffering it for `get_next_frame()`
+        self.on_frame = on_frame
+        # frames for `frames()`, while it is iterated
+        self._frame_queue: Union[None, Queue] = None
+        self._frame_drop = False
+        self.stat_frames_dropped = 0  # by `frames(drop=True)`, the consumer being late
         self._current_sequence_number = 0
         self.session_id = ""
 
         self.current_frame_number = -1
 
         self.is_rtsp_connected = False
-        self.is_receiving_rtp = False
+        self._state = SessionState()
 
         # ===========================
         # Rtcp variables:
         # ===========================
         self._rtcp_socket: Union[None, socket.socket] = None
         self._rtcp_sender: Union[None, self.RtcpSender()] = None
+        self.ssrc = RTCPPacket.new_ssrc()  # identifies this receiver in its reports
+        self.remote_ssrc = 0  # SSRC of the session's RTP stream, from SETUP
+        self.remote_rtcp_port = self.RTCP_RCV_PORT
 
         # ===========================
         # Statistics variables:
@@ -70,12 +187,26 @@ class Client:
         self.stat_fraction_lost = 0  # Fraction of RTP data packets from sender lost since the prev packet was sent
         self.stat_cumulative_lost = 0  # Number of packets lost
         self.stat_expected_sequence_number = 0  # Expected sequence num in the session
-        self.stat_high_sequence_number = 0  # Highest sequence num received in session
+        self.stat_high_sequence_number = 0  # Highest sequence num received in session, extended
+        # RFC 3550 A.1: the 16-bit sequence numbers wrap every 65536 packets,
+        # the cycles count the wraps so that the highest one keeps growing
+        self._seq_base: Optional[int] = None  # first sequence number received
+        self._seq_max = 0
+        self._seq_cycles = 0
+        self._seq_bad: Optional[int] = None  # after a jump, the one confirming a restart
+        self._seq_received = 0
 
         self.file_path = file_path
         self.remote_host_address = remote_host_address
         self.remote_host_port = remote_host_port
         self.rtp_port = rtp_port
+        # RTP datagram size proposed in SETUP (clamped to the path MTU once
+        # connected), replaced by the server's answer
+        self.blocksize = blocksize
+
+    @property
+    def is_receiving_rtp(self) -> bool:
+        return self._state.state == SessionState.PLAYING
 
     def get_next_frame(self) -> Optional[Tuple[Image.Image, int]]:
         if self._frame_buffer:
@@ -84,30 +215,173 @@ class Client:
             return self._frame_buffer.pop(0), self.current_frame_number
         return None
 
-    @staticmethod
-    def _get_frame_from_packet(packet: RTPPacket) -> Image.Image:
-        # the payload is already the jpeg
-
-        raw = packet.payload
-        img = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), 1)
-        frame = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        return frame
-
-    def _recv_rtp_packet(self, size=DEFAULT_CHUNK_SIZE) -> RTPPacket:
+    def frames(
+        self,
+        output: str = FRAME_IMAGE,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        drop: bool = False,
+        idle_timeout: Optional[float] = None,
+    ) -> Iterator[Tuple[Union[bytes, np.ndarray, Image.Image], int]]:
+        # frames from now until TEARDOWN, as `output` with the sequence number
+        # of their RTP packet, decoded by the thread iterating. Once
+        # `max_pending` frames wait, the receiver waits as well, so that the
+        # stream backs up into the socket buffer (TCP flow control when
+        # interleaved) and the server sees the loss in RTCP; or, with `drop`,
+        # the oldest frame is dropped, for consumers only after the latest.
+        # The server says nothing when its source ends, or when a seek lands
+        # at the end: with `idle_timeout`, the iteration also ends once no
+        # frame came for that many seconds of playing.
+        self._check_frames_options(output, drop)
+        queue = Queue(max_pending)
+        self._frame_drop = drop
+        self._frame_queue = queue
+        return self._iterate_frames(queue, output, idle_timeout)
+
+    def _check_frames_options(self, output: str, drop: bool):
+        if output not in self.FRAME_OUTPUTS:
+            raise ValueError(f"output should be one of {', '.join(self.FRAME_OUTPUTS)}")
+        if self.tile_size is not None and (drop or output == self.FRAME_BYTES):
+            # each payload only holds the tiles changed since the previous one
+            raise ValueError("tiles need every frame decoded, without drop and not as bytes")
+
+    def _iterate_frames(self, queue: Queue, output: str, idle_timeout: Optional[float]):
+        try:
+            while True:
+                try:
+                    packet = queue.get(timeout=None if idle_timeout is None else self.QUEUE_POLL)
+                except Empty:
+                    if self._is_idle(idle_timeout):
+                        return
+                    continue
+                if packet is None:
+                    # torn down
+                    return
+                frame = self._convert_frame(packet, output)
+                if frame is not None:
+                    yield frame, packet.sequence_number
+        finally:
+            if self._frame_queue is queue:
+                self._frame_queue = None
+
+    def _queue_frame(self, packet: RTPPacket):
+        # receive thread
+        queue = self._frame_queue
+        while not self._frame_drop:
+            try:
+                queue.put(packet, timeout=self.QUEUE_POLL)
+                return
+            except Full:
+                if self._state.state == SessionState.TEARDOWN:
+                    return
+        self._put_dropping(queue, packet)
+
+    def _is_idle(self, idle_timeout: float) -> bool:
+        # playing, with no frame since PLAY or the last one for `idle_timeout`
+        if self._state.state != SessionState.PLAYING:
+            return False
+        return self.clock.time() * 1000 - self.stat_start_time >= idle_timeout * 1000
+
+    def _flush_frames(self):
+        # drops the frames queued for `frames()`, but not the end of it
+        queue = self._frame_queue
+        if queue is None:
+            return
+        try:
+            while True:
+                if queue.get_nowait() is None:
+                    queue.put_nowait(None)
+                    return
+        except Empty:
+            pass
 
-        recv = b""
+    def _put_dropping(self, queue: Queue, item: Optional[RTPPacket]):
         while True:
             try:
-                seg, addr = self._rtp_socket.recvfrom(VideoStream.MAX_DGRAM)
-                if struct.unpack("B", seg[0:1])[0] > 1:
-                    recv += seg[1:]
-                else:
-                    recv += seg[1:]
+                queue.put_nowait(item)
+                return
+            except Full:
+                pass
+            try:
+                queue.get_nowait()
+                self.stat_frames_dropped += 1
+            except Empty:
+                pass
+
+    def _end_frames(self):
+        # ends the iteration of `frames()` after the frames queued
+        if self._frame_queue is not None:
+            self._put_dropping(self._frame_queue, None)
+
+    def _convert_frame(
+        self, packet: RTPPacket, output: str
+    ) -> Union[None, bytes, np.ndarray, Image.Image]:
+        if output == self.FRAME_BYTES:
+            return packet.payload
+        img = self._decode_packet(packet)
+        if img is None:
+            return None
+        if output == self.FRAME_ARRAY:
+            if packet.payload_type == RTPPacket.TYPE.JPEG_TILES:
+                # the compositor keeps painting over its frame
+                img = img.copy()
+            return img
+        return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+    def _get_frame_from_packet(self, packet: RTPPacket) -> Optional[Image.Image]:
+        return self._convert_frame(packet, self.FRAME_IMAGE)
+
+    def _decode_packet(self, packet: RTPPacket) -> Optional[np.ndarray]:
+        # the payload is an image in the codec of its payload type, or tiles
+        # painted over the previous frame; None while tiles wait for their
+        # first full frame
 
-                    return RTPPacket.from_packet(recv)
+        raw = packet.payload
+        if packet.payload_type == RTPPacket.TYPE.JPEG_TILES:
+            img = self._compositor.apply(raw)
+        else:
+            codec = by_payload_type(packet.payload_type)
+            if codec is None:
+                print(f"[RTP] Unknown payload type {packet.payload_type}")
+                return None
+            img = codec.decode(raw)
+        if img is None:
+            return None
+        frame_size = packet.extensions.get(RTPPacket.EXTENSION_FRAME_SIZE)
+        if frame_size is not None:
+            # downscaled by the server under congestion
+            width, height = struct.unpack("!HH", frame_size)
+            if img.shape[:2] != (height, width):
+                img = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR)
+        return img
+
+    def _recv_rtp_packet(self, size=DEFAULT_CHUNK_SIZE) -> Optional[RTPPacket]:
 
-            except socket.timeout:
-                continue
+        while True:
+            # the server may resize its datagrams during the session, so
+            # never risk truncating one
+            seg, addr = self._rtp_socket.recvfrom(MAX_DGRAM)
+            if not seg:
+                # wake-up call from `send_teardown_request()`
+                return None
+            packet = self._reassemble(seg)
+            if packet is not None:
+                return packet
+
+    def _reassemble(self, datagram: bytes) -> Optional[RTPPacket]:
+        # the RTP packet once its last fragment arrived; one that isn't a
+        # packet of the stream (a stray datagram, or the previous simulcast
+        # layer) is dropped, its sequence number would throw the loss
+        # statistics off for good
+        recv = self._reassembler.push(datagram)
+        if recv is None:
+            return None
+        try:
+            packet = RTPPacket.from_packet(recv)
+        except InvalidPacketException:
+            return None
+        if self.remote_ssrc and packet.ssrc not in self.stream_ssrcs:
+            return None
+        return packet
 
     def _start_rtp_receive_thread(self):
         self._rtp_receive_thread = Thread(
@@ -123,48 +397,221 @@ class Client:
         self._rtcp_send_thread.setDaemon(True)
         self._rtcp_send_thread.start()
 
-    def _handle_video_receive(self):
-        self._rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._rtp_socket.bind((self.DEFAULT_LOCAL_HOST, self.rtp_port))
-        self._rtp_socket.settimeout(self.RTP_SOFT_TIMEOUT / 1000.0)
+    def _start_keepalive_thread(self):
+        self._keepalive_thread = Thread(target=self._keep_alive, name="rtsp_keepalive")
+        self._keepalive_thread.setDaemon(True)
+        self._keepalive_thread.start()
+
+    def _keep_alive(self):
+        # the server reaps sessions silent for `session_timeout`, and neither
+        # a paused session nor a multicast member sends anything on its own
+        period = self.session_timeout / 2
         while True:
-            if not self.is_receiving_rtp:
-                sleep(self.RTP_SOFT_TIMEOUT / 1000.0)  # diminish cpu hogging
+            idle = self.clock.monotonic() - self._last_request
+            state = self._state.wait_for(SessionState.TEARDOWN, timeout=period - idle)
+            if state == SessionState.TEARDOWN or not self.is_rtsp_connected:
+                return
+            if self.clock.monotonic() - self._last_request < period:
                 continue
+            try:
+                self._send_request(RTSPPacket.GET_PARAMETER)
+            except (ConnectionError, OSError, RTSPStatusError) as e:
+                print(f"Keep-alive failed: {e}")
+                return
+
+    def _start_rtsp_receive_thread(self):
+        self._rtsp_receive_thread = Thread(
+            target=self._handle_interleaved_receive, name="rtsp_rcv"
+        )
+        self._rtsp_receive_thread.setDaemon(True)
+        self._rtsp_receive_thread.start()
+
+    def _setup_rtp_socket(self):
+        if self.multicast_destination is not None:
+            self._rtp_group = self.multicast_destination
+            self._rtp_socket = open_group_socket(
+                *self._rtp_group, self._multicast_interface(), self.multicast_ttl
+            )
+            self._group_joined = True
+        else:
+            self._rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._rtp_socket.bind((self.DEFAULT_LOCAL_HOST, self.rtp_port))
+        set_socket_buffers(self._rtp_socket, rcvbuf=SOCKET_BUFFER_SIZE)
 
-            cur_time = round(time() * 1000)  # Get current time in ms
-            self.stat_total_play_time += cur_time - self.stat_start_time
-            self.stat_start_time = cur_time
+    def _multicast_interface(self) -> str:
+        # join on the interface the server is reached through
+        return self._rtsp_connection.getsockname()[0]
+
+    def _handle_video_receive(self):
+        while True:
+            # blocks without waking up while the session is paused
+            state = self._state.wait_for(SessionState.PLAYING, SessionState.TEARDOWN)
+            if state == SessionState.TEARDOWN:
+                self._rtp_socket.close()
+                return
 
             packet = self._recv_rtp_packet()
+            if packet is None:
+                continue
+            self._handle_rtp_packet(packet)
+            if self._next_layer != self.layer:
+                self._switch_layer()
+
+    @property
+    def stream_ssrcs(self) -> Set[int]:
+        # SSRCs of the stream received, one per simulcast layer
+        if not self.layers:
+            return {self.remote_ssrc}
+        return {ssrc for _, ssrc, _ in self.layers}
+
+    def select_layer(self, layer: int):
+        # moves to another simulcast layer, 0 being the full size, once the
+        # frame being received is complete
+        if self.layers:
+            self._next_layer = min(max(layer, 0), len(self.layers) - 1)
+
+    def _switch_layer(self):
+        # receive thread, between two frames: the group of the next layer is
+        # joined before the current one is left. The layers share sequence
+        # numbers and timestamps, the statistics carry over.
+        with self._rtp_group_lock:
+            if not self._group_joined:
+                # paused, moves once playing again
+                return
+            layer = self._next_layer
+            downscale, ssrc, group = self.layers[layer]
+            rtp_socket = open_group_socket(*group, self._multicast_interface(), self.multicast_ttl)
+            set_socket_buffers(rtp_socket, rcvbuf=SOCKET_BUFFER_SIZE)
+            # closing leaves the group of the previous layer
+            self._rtp_socket.close()
+            self._rtp_socket, self._rtp_group = rtp_socket, group
+            self.layer = layer
+            self.remote_ssrc = ssrc
+            # fragments of the previous layer would never be completed
+            self._reassembler = Reassembler()
+            self._layer_hold_until = self.clock.monotonic() + self.LAYER_HOLD
+        print(f"[RTP] Receiving layer {layer} (1/{downscale} size) from {group[0]}")
+
+    def _adapt_layer(self, fraction_lost: float):
+        # down a layer on loss, back up after a while without any; never
+        # twice in a row before the previous switch shows in the reports
+        if not self.layers or not self.adaptive_layers:
+            return
+        if self.clock.monotonic() < self._layer_hold_until:
+            self._loss_free_intervals = 0
+            return
+        if fraction_lost > self.LAYER_DOWN_LOSS:
+            self._loss_free_intervals = 0
+            self.select_layer(self.layer + 1)
+        elif fraction_lost == 0:
+            self._loss_free_intervals += 1
+            if self._loss_free_intervals >= self.LAYER_UP_INTERVALS:
+                self._loss_free_intervals = 0
+                self.select_layer(self.layer - 1)
+        else:
+            self._loss_free_intervals = 0
+
+    def _handle_interleaved_receive(self):
+        while True:
+            try:
+                item = self._next_rtsp_item(self.INTERLEAVED_CHUNK_SIZE)
+            except OSError:
+                # connection closed, unblock a pending `_get_response()`
+                self._responses.put(None)
+                return
+            if not isinstance(item, tuple):
+                self._responses.put(item)
+                continue
+            self._handle_interleaved_frame(*item)
+
+    def _handle_interleaved_frame(self, channel: int, data: bytes):
+        if channel != self.interleaved[0]:
+            return
+        packet = self._reassemble(data)
+        if packet is not None and (self.is_receiving_rtp or self._play_pending):
+            self._handle_rtp_packet(packet)
+
+    def _handle_rtp_packet(self, packet: RTPPacket):
+        cur_time = round(self.clock.time() * 1000)  # Get current time in ms
+        self.stat_total_play_time += cur_time - self.stat_start_time
+        self.stat_start_time = cur_time
+
+        if self._frame_queue is not None:
+            self._queue_frame(packet)
+        elif self.on_frame is not None:
+            self.on_frame(packet)
+        else:
             frame = self._get_frame_from_packet(packet)
-            self._frame_buffer.append(frame)
-            print(f"[RTP] Receive packet #{packet.sequence_number}")
-
-            if packet.sequence_number > self.stat_high_sequence_number:
-                self.stat_high_sequence_number = packet.sequence_number
-            if packet.sequence_number != self.stat_expected_sequence_number:
-                self.stat_cumulative_lost += 1
-                self.stat_expected_sequence_number = self.stat_high_sequence_number
-            self.stat_expected_sequence_number += 1
-
-            self.stat_data_rate = 0.0
-            if self.stat_total_play_time != 0:
-                self.stat_data_rate = (
-                    self.stat_total_bytes / self.stat_total_play_time * 1000
-                )
-            self.stat_fraction_lost = 0.0
-            if self.stat_high_sequence_number != 0:
-                self.stat_fraction_lost = float(
-                    self.stat_cumulative_lost / self.stat_high_sequence_number
-                )
+            if frame is not None:
+                self._frame_buffer.append(frame)
+        print(f"[RTP] Receive packet #{packet.sequence_number}")
+        self._update_stats(packet)
+
+    def _init_sequence(self, seq: int):
+        self._seq_base = self._seq_max = seq
+        self._seq_cycles = 0
+        self._seq_bad = None
+        self._seq_received = 0
+
+    def _update_sequence(self, seq: int) -> bool:
+        # RFC 3550 A.1, False for a packet not counted: a big jump in the
+        # sequence, until the next packet confirms the sender restarted
+        if self._seq_base is None:
+            self._init_sequence(seq)
+            return True
+        delta = (seq - self._seq_max) % self.SEQ_MOD
+        if delta < self.MAX_DROPOUT:
+            if seq < self._seq_max:
+                self._seq_cycles += self.SEQ_MOD
+            self._seq_max = seq
+        elif delta <= self.SEQ_MOD - self.MAX_MISORDER:
+            if seq != self._seq_bad:
+                self._seq_bad = (seq + 1) % self.SEQ_MOD
+                return False
+            self._init_sequence(seq)
+        # else a duplicate or a late packet, the highest stays
+        return True
+
+    def _expected_packets(self) -> int:
+        # from the first sequence number to the highest, RFC 3550 A.3
+        if self._seq_base is None:
+            return 0
+        return self.stat_high_sequence_number - self._seq_base + 1
+
+    def _update_stats(self, packet: RTPPacket):
+        if self._update_sequence(packet.sequence_number):
+            self._seq_received += 1
+            self.stat_high_sequence_number = self._seq_cycles + self._seq_max
+            self.stat_expected_sequence_number = self.stat_high_sequence_number + 1
+            # duplicates may make up for losses, never below zero
+            self.stat_cumulative_lost = max(0, self._expected_packets() - self._seq_received)
+
+        self.stat_data_rate = 0.0
+        if self.stat_total_play_time != 0:
+            self.stat_data_rate = (
+                self.stat_total_bytes / self.stat_total_play_time * 1000
+            )
+        self.stat_fraction_lost = 0.0
+        if self._seq_base is not None:
+            self.stat_fraction_lost = float(
+                self.stat_cumulative_lost / self._expected_packets()
+            )
 
-            self.stat_total_bytes += len(packet.payload)
+        self.stat_total_bytes += len(packet.payload)
 
     def _setup_rtcp_sender(self):
-        print("[RTCP] Setting up RTCP socket...")
-        self._rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        print(f"[RTCP] UDP client is up")
+        if self.multicast_destination is not None:
+            # reports go to the whole group, and the other members' reports
+            # tell how many receivers share the feedback bandwidth
+            group, port = self.multicast_destination
+            self._rtcp_socket = open_group_socket(
+                group, port + 1, self._multicast_interface(), self.multicast_ttl
+            )
+            self.remote_rtcp_port = port + 1
+        elif self.interleaved is None:
+            print("[RTCP] Setting up RTCP socket...")
+            self._rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            print(f"[RTCP] UDP client is up")
         self._rtcp_sender = self.RtcpSender(self, self.RTCP_PERIOD / 1000.0)
         print(f"[RTCP] Finish setting up")
 
@@ -174,9 +621,13 @@ class Client:
             return
         print(f"Connecting to {self.remote_host_address}:{self.remote_host_port}...")
         self._rtsp_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.interleaved is not None:
+            set_socket_buffers(self._rtsp_connection, rcvbuf=SOCKET_BUFFER_SIZE)
         self._rtsp_connection.connect((self.remote_host_address, self.remote_host_port))
-        self._rtsp_connection.settimeout(self.RTSP_SOFT_TIMEOUT / 1000.0)
         self.is_rtsp_connected = True
+        path_mtu = probe_path_mtu((self.remote_host_address, self.remote_host_port))
+        if path_mtu is not None:
+            self.blocksize = min(self.blocksize, mtu_to_dgram(path_mtu))
 
     def close_rtsp_connection(self):
         if not self.is_rtsp_connected:
@@ -186,55 +637,217 @@ class Client:
         self.is_rtsp_connected = False
 
     def _send_request(self, request_type=RTSPPacket.INVALID) -> RTSPPacket:
+        return self._send_requests(request_type)[0]
+
+    def _send_requests(
+        self, *request_types, npt_range: Optional[NptRange] = None, scale: Optional[float] = None
+    ) -> List[RTSPPacket]:
+        # pipelined: all requests leave in one write, then the responses are
+        # read in order; a failed one raises and the rest are not waited for;
+        # `npt_range` and `scale` go with a PLAY
         if not self.is_rtsp_connected:
             raise Exception(
                 "rtsp connection not established. run `setup_rtsp_connection()`"
             )
-        request = RTSPPacket(
-            request_type,
-            self.file_path,
-            self._current_sequence_number,
-            self.rtp_port,
-            self.session_id,
-        ).to_request()
-        # print(f"Sending request: {repr(request)}")
-        self._rtsp_connection.send(request)
-        self._current_sequence_number += 1
-        return self._get_response()
-
-    def send_setup_request(self) -> RTSPPacket:
-        response = self._send_request(RTSPPacket.SETUP)
-        self._start_rtp_receive_thread()
-        self._setup_rtcp_sender()
-        self.session_id = response.session_id
+        responses = []
+        with self._request_lock:
+            requests = []
+            for request_type in request_types:
+                requests.append(RTSPPacket(
+                    request_type,
+                    self.file_path,
+                    self._current_sequence_number,
+                    self.rtp_port,
+                    self.session_id,
+                    self.blocksize,
+                    interleaved=self.interleaved,
+                    multicast=self.multicast,
+                    npt_range=npt_range,
+                    scale=scale,
+                    tile_size=self.tile_size,
+                    codecs=self.codecs,
+                ).to_request())
+                self._current_sequence_number += 1
+            # print(f"Sending requests: {repr(requests)}")
+            with self._rtsp_send_lock:
+                self._rtsp_connection.sendall(b"".join(requests))
+            self._last_request = self.clock.monotonic()
+            for _ in request_types:
+                response = self._get_response()
+                if response.status_code != RTSPPacket.OK:
+                    raise RTSPStatusError(
+                        response.status_code, RTSPPacket.REASONS.get(response.status_code, "")
+                    )
+                responses.append(response)
+        return responses
+
+    def send_options_request(self) -> RTSPPacket:
+        return self._send_request(RTSPPacket.OPTIONS)
+
+    def send_describe_request(self) -> RTSPPacket:
+        response = self._send_request(RTSPPacket.DESCRIBE)
+        if response.body is None:
+            raise Exception(f"server did not describe the source: {response}")
+        self.media = MediaDescription.from_sdp(response.body)
         return response
 
-    def send_play_request(self) -> RTSPPacket:
-        response = self._send_request(RTSPPacket.PLAY)
+    def send_setup_request(self, play: bool = False) -> RTSPPacket:
+        # with `play`, PLAY follows right behind SETUP instead of waiting for
+        # its response; a multicast member only learns its group from the
+        # response, so it still waits
+        if self.interleaved is None and not self.multicast:
+            # bound before asking, so the first packets can't get lost
+            self._setup_rtp_socket()
+        pipelined = play and not self.multicast
+        if pipelined:
+            self._play_pending = True
+            self.stat_start_time = round(self.clock.time() * 1000)
+            try:
+                response, _ = self._send_requests(RTSPPacket.SETUP, RTSPPacket.PLAY)
+            except Exception:
+                self._play_pending = False
+                raise
+        else:
+            response = self._send_request(RTSPPacket.SETUP)
+        self._state.set(SessionState.PAUSED)
+        self.session_id = response.session_id
+        self.session_timeout = response.timeout
+        if response.blocksize is not None:
+            self.blocksize = response.blocksize
+        self.tile_size = response.tile_size
+        self.codecs = response.codecs
+        if response.ssrc is not None:
+            self.remote_ssrc = response.ssrc
+        if response.server_port is not None:
+            self.remote_rtcp_port = response.server_port
+        if self.multicast:
+            if response.destination is None:
+                raise Exception(f"server did not assign a multicast group: {response}")
+            self.multicast_destination = response.destination
+            if response.ttl is not None:
+                self.multicast_ttl = response.ttl
+            self.layers = response.layers
+            self._setup_rtp_socket()
+        self._setup_rtcp_sender()
+        # worker threads live for the whole session
+        if self.interleaved is None:
+            self._start_rtp_receive_thread()
+        else:
+            self._start_rtsp_receive_thread()
         self._start_rtcp_send_thread()
-        self.is_receiving_rtp = True
-        self.stat_start_time = round(time() * 1000)
+        if self.multicast_destination is not None:
+            self._start_rtcp_receive_thread()
+        if self.session_timeout:
+            self._start_keepalive_thread()
+        if pipelined:
+            self._start_playing()
+        elif play:
+            self.send_play_request()
         return response
 
+    def _start_rtcp_receive_thread(self):
+        self._rtcp_receive_thread = Thread(
+            target=self._rtcp_sender._receive_group_reports, name="rtcp_rcv"
+        )
+        self._rtcp_receive_thread.setDaemon(True)
+        self._rtcp_receive_thread.start()
+
+    def send_play_request(
+        self, npt_range: Optional[NptRange] = None, scale: Optional[float] = None
+    ) -> RTSPPacket:
+        # without arguments, resumes where the stream paused; `npt_range`
+        # seeks, in seconds, and `scale` fast-forwards (> 1) or rewinds (< 0)
+        self._play_pending = True
+        self.stat_start_time = round(self.clock.time() * 1000)
+        try:
+            response, = self._send_requests(RTSPPacket.PLAY, npt_range=npt_range, scale=scale)
+        except Exception:
+            self._play_pending = False
+            raise
+        self._repositioned(response)
+        self._start_playing()
+        return response
+
+    def _repositioned(self, response: RTSPPacket):
+        # frames buffered from before a seek are not shown
+        if response.npt_range is not None:
+            self._frame_buffer.clear()
+            self._flush_frames()
+            self.npt_range = response.npt_range
+        if response.scale is not None:
+            self.scale = response.scale
+
+    def _start_playing(self):
+        with self._rtp_group_lock:
+            if self.multicast_destination is not None and not self._group_joined:
+                join_group(self._rtp_socket, self._rtp_group[0], self._multicast_interface())
+                self._group_joined = True
+                # what the group sent while paused shows as lost
+                self._layer_hold_until = self.clock.monotonic() + self.LAYER_HOLD
+        self._state.set(SessionState.PLAYING)
+        self._play_pending = False
+
     def send_pause_request(self) -> RTSPPacket:
         response = self._send_request(RTSPPacket.PAUSE)
-        self.is_receiving_rtp = False
+        self._state.set(SessionState.PAUSED)
+        with self._rtp_group_lock:
+            if self.multicast_destination is not None and self._group_joined:
+                # the group goes on for the other members: stop receiving it,
+                # once the receiver thread is out of its recvfrom()
+                self._wake_rtp_receiver()
+                leave_group(self._rtp_socket, self._rtp_group[0], self._multicast_interface())
+                self._group_joined = False
         return response
 
     def send_teardown_request(self) -> RTSPPacket:
+        # a receiver waiting for `frames()` to make room must not hold up
+        # the response when interleaved
+        self._frame_drop = True
         response = self._send_request(RTSPPacket.TEARDOWN)
-        self.is_receiving_rtp = False
+        self._state.set(SessionState.TEARDOWN)
         self.is_rtsp_connected = False
+        self._end_frames()
+        if self.interleaved is None:
+            with self._rtp_group_lock:
+                self._wake_rtp_receiver()
+            receiver = self._rtp_receive_thread
+            if receiver is not None and receiver is not current_thread():
+                # a frame may still be decoding, which must not be cut short
+                # by the interpreter exiting right after
+                receiver.join(self.TEARDOWN_JOIN_TIMEOUT)
         return response
 
-    def _get_response(self, size=DEFAULT_CHUNK_SIZE) -> RTSPPacket:
-        rcv = None
+    def _wake_rtp_receiver(self):
+        # closing the socket would not interrupt a blocked recvfrom(), an
+        # empty datagram does, and the thread closes the socket on its way out
+        if self._rtp_group is not None:
+            wake_local_listeners(self._rtp_group, self._multicast_interface())
+            return
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(b"", (self.DEFAULT_LOCAL_HOST, self.rtp_port))
+
+    def _next_rtsp_item(self, size=DEFAULT_CHUNK_SIZE) -> Union[RTSPMessage, Tuple[int, bytes]]:
+        # next RTSP message or interleaved frame on the connection
         while True:
-            try:
-                rcv = self._rtsp_connection.recv(size)
-                break
-            except socket.timeout:
-                continue
+            item = self._demuxer.next()
+            if item is not None:
+                return item
+            rcv = self._rtsp_connection.recv(size)
+            if not rcv:
+                raise ConnectionError("server closed the RTSP connection")
+            self._demuxer.feed(rcv)
+
+    def _get_response(self, size=DEFAULT_CHUNK_SIZE) -> RTSPPacket:
+        if self._rtsp_receive_thread is not None:
+            rcv = self._responses.get()
+            if rcv is None:
+                raise ConnectionError("server closed the RTSP connection")
+        else:
+            rcv = self._next_rtsp_item(size)
+            while isinstance(rcv, tuple):
+                # media of a PLAY pipelined behind SETUP, ahead of the responses
+                self._handle_interleaved_frame(*rcv)
+                rcv = self._next_rtsp_item(size)
         # print(f"Received from server: {repr(rcv)}")
         response = RTSPPacket.from_response(rcv)
         return response
@@ -243,51 +856,132 @@ class Client:
     # Send RTCP control packets for QoS feedback
     # ===========================
     class RtcpSender:
+        BUFFERSIZE = 512
+        MEMBER_TIMEOUT_INTERVALS = 5
+
         def __init__(self, client, interval) -> None:
             self.client: Union[None, Client] = client  # Pass in the client instance
             self.interval = interval  # Interval for receiving packets
 
             self.num_pkts_expected = 0  # Number of RTP pkt expected since last RTCP pkt
             self.num_pkts_lost = 0  # Number of RTP pkt lost since last RTCP pkt
-            self.last_high_sequence_number = 0  # The last highest Seq number received
-            self.last_cumulative_lost = 0  # The last cumulative packets lost
+            self.last_expected = 0  # RTP pkts expected at the last RTCP pkt
+            self.last_received = 0  # RTP pkts received at the last RTCP pkt
             self.last_fraction_lost = 0  # The last fraction lost
 
-        def _send_rtcp_packet(self):
+            # multicast only: SSRC -> time of the last report heard from
+            # each member of the group, this receiver included
+            self.members: Dict[int, float] = {}
+            self.avg_rtcp_size: Optional[float] = None  # with UDP/IP headers
+            self._next_interval = interval
+
+        def _build_rtcp_packet(self) -> RTCPPacket:
+            # Calculate stats for this period, RFC 3550 A.3: late and
+            # duplicate packets make up for losses of an earlier period, the
+            # fraction is never negative
+            expected = self.client._expected_packets()
+            received = self.client._seq_received
+            self.num_pkts_expected = expected - self.last_expected
+            self.num_pkts_lost = self.num_pkts_expected - (received - self.last_received)
+            self.last_fraction_lost = float(0)
+            # none expected after the sender restarted its sequence
+            if self.num_pkts_expected > 0 and self.num_pkts_lost > 0:
+                self.last_fraction_lost = float(
+                    self.num_pkts_lost / self.num_pkts_expected
+                )
+            self.last_expected = expected
+            self.last_received = received
+            if self.num_pkts_expected > 0:
+                self.client._adapt_layer(self.last_fraction_lost)
+
+            return RTCPPacket(
+                self.last_fraction_lost,
+                self.client.stat_cumulative_lost,
+                self.client.stat_high_sequence_number,
+                ssrc=self.client.ssrc,
+                source_ssrc=self.client.remote_ssrc,
+            )
+
+        def _update_avg_rtcp_size(self, size: int):
+            # RFC 3550, section 6.3.3
+            size += IP_UDP_OVERHEAD
+            if self.avg_rtcp_size is None:
+                self.avg_rtcp_size = float(size)
+            else:
+                self.avg_rtcp_size += (size - self.avg_rtcp_size) / 16
+
+        def _receive_group_reports(self):
+            rtcp_socket = self.client._rtcp_socket
             while True:
-                if not self.client.is_receiving_rtp:
-                    sleep(self.interval)
+                try:
+                    datagram = rtcp_socket.recvfrom(self.BUFFERSIZE)[0]
+                except socket.error as e:
+                    print("[RTCP] Error receiving data %s" % e)
+                    return
+                if self.client._state.state == SessionState.TEARDOWN:
+                    rtcp_socket.close()
+                    return
+                try:
+                    report = RTCPPacket.from_bitstream(datagram)
+                except InvalidRequest:
                     continue
-                # Calculate stats for this period
-                self.num_pkts_expected = (
-                    self.client.stat_high_sequence_number
-                    - self.last_high_sequence_number
-                )
-                self.num_pkts_lost = (
-                    self.client.stat_cumulative_lost - self.last_cumulative_lost
-                )
-                self.last_fraction_lost = float(0)
-                if self.num_pkts_expected != 0:
-                    self.last_fraction_lost = float(
-                        self.num_pkts_lost / self.num_pkts_expected
-                    )
-                self.last_high_sequence_number = self.client.stat_high_sequence_number
-                self.last_cumulative_lost = self.client.stat_cumulative_lost
+                if report.source_ssrc in self.client.stream_ssrcs:
+                    self.members[report.ssrc] = self.client.clock.monotonic()
+                    self._update_avg_rtcp_size(len(datagram))
+
+        def _interval(self) -> float:
+            if self.client.multicast_destination is None:
+                return self.interval
+            # members silent for five intervals have left (RFC 3550, 6.3.5)
+            now = self.client.clock.monotonic()
+            timeout = self.MEMBER_TIMEOUT_INTERVALS * max(self._next_interval, self.interval)
+            self.members = {
+                ssrc: seen for ssrc, seen in self.members.items() if now - seen < timeout
+            }
+            members = len(self.members.keys() | {self.client.ssrc}) + 1  # and the sender
+            self._next_interval = rtcp_interval(
+                members,
+                senders=1,
+                rtcp_bw=RTCP_BANDWIDTH_FRACTION * self.client.stat_data_rate,
+                we_sent=False,
+                avg_rtcp_size=self.avg_rtcp_size or 0,
+                min_time=self.interval,
+            )
+            return self._next_interval
 
+        def _send_rtcp_packet(self):
+            state = self.client._state
+            while True:
+                if state.wait_for(state.PLAYING, state.TEARDOWN) == state.TEARDOWN:
+                    if self.client.multicast_destination is not None:
+                        # the group report listener owns the socket
+                        group, port = self.client.multicast_destination
+                        wake_local_listeners((group, port + 1), self.client._multicast_interface())
+                    elif self.client._rtcp_socket is not None:
+                        self.client._rtcp_socket.close()
+                    return
                 try:
-                    rtcp_packet = RTCPPacket(
-                        self.last_fraction_lost,
-                        self.client.stat_cumulative_lost,
-                        self.client.stat_high_sequence_number,
-                    )
-                    datagram = rtcp_packet.get_packet()
-                    self.client._rtcp_socket.sendto(
-                        datagram,
-                        (self.client.remote_host_address, self.client.RTCP_RCV_PORT),
-                    )
+                    datagram = self._build_rtcp_packet().get_packet()
+                    if self.client.interleaved is not None:
+                        send_interleaved(
+                            self.client._rtsp_connection,
+                            self.client.interleaved[1],
+                            [datagram],
+                            self.client._rtsp_send_lock,
+                        )
+                    elif self.client.multicast_destination is not None:
+                        group, port = self.client.multicast_destination
+                        self.client._rtcp_socket.sendto(datagram, (group, port + 1))
+                        self._update_avg_rtcp_size(len(datagram))
+                    else:
+                        self.client._rtcp_socket.sendto(
+                            datagram,
+                            (self.client.remote_host_address, self.client.remote_rtcp_port),
+                        )
                     print(
                         f"[RTCP] Send pkt: {self.last_fraction_lost,self.client.stat_cumulative_lost,self.client.stat_high_sequence_number}"
                     )
                 except socket.error as e:
                     print("[RTCP] Error sending data %s" % e)
-                sleep(self.interval)
+                # returns early when the session is paused or torn down
+                state.wait_while(state.PLAYING, self._interval())
@@ -1,4 +1,5 @@
 from logging import info
+from typing import List, Optional
 from PyQt5.QtWidgets import QHBoxLayout, QLabel, QSizePolicy, QVBoxLayout
 from PyQt5.QtWidgets import QMainWindow, QWidget, QPushButton
 from PyQt5.QtGui import QPixmap, QIcon
@@ -6,6 +7,7 @@ from PyQt5.QtCore import pyqtSignal, QTimer
 from PIL.ImageQt import ImageQt
 
 from client.client import Client
+from utils.rtsp_packet import RTSPStatusError
 from utils.video_stream import VideoStream
 from utils.inference import inference
 
@@ -21,6 +23,10 @@ class ClientWindow(QMainWindow):
         rtp_port: int,
         parent=None,
         add_obj_detect: bool = True,
+        interleaved: bool = False,
+        multicast: bool = False,
+        tile_size: Optional[int] = None,
+        codecs: Optional[List[str]] = None,
     ):
         super(ClientWindow, self).__init__(parent)
 
@@ -50,7 +56,16 @@ class ClientWindow(QMainWindow):
             QLabel()
         )  # Highest sequence num received in session
 
-        self._media_client = Client(file_name, host_address, host_port, rtp_port)
+        self._media_client = Client(
+            file_name,
+            host_address,
+            host_port,
+            rtp_port,
+            interleaved=interleaved,
+            multicast=multicast,
+            tile_size=tile_size,
+            codecs=codecs,
+        )
         self._update_image_signal.connect(self.update_image)
         self._update_image_timer = QTimer()
         self._update_image_timer.timeout.connect(self._update_image_signal.emit)
@@ -196,7 +211,14 @@ class ClientWindow(QMainWindow):
 
     def handle_setup(self):
         self._media_client.establish_rtsp_connection()
-        self._media_client.send_setup_request()
+        try:
+            self._media_client.send_setup_request()
+        except RTSPStatusError as e:
+            # the server turned the session down, Setup may be tried again
+            self._media_client.close_rtsp_connection()
+            self.error_label.setText(f"Error: {e}")
+            return
+        self.error_label.setText("")
         self.setup_button.setEnabled(False)
         self.play_button.setEnabled(True)
         self.tear_button.setEnabled(True)
@@ -0,0 +1,242 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle
+from threading import Event, Lock, Thread
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QGridLayout, QLabel, QMainWindow, QSizePolicy, QWidget
+
+from client.client import Client
+from utils.codecs import by_payload_type
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import RTSPStatusError
+from utils.video_stream import VideoStream
+
+
+# ===========================
+# Several streams in a grid, e.g. the 3x3 cameras of a control room, from a
+# single process: every tile has its session, but they all share one pool of
+# decode threads and one object detector. Frames are decoded at the size of
+# their tile, and tiles that can't be seen (hidden, minimised or covered)
+# neither decode nor, unless asked, detect anything.
+# ===========================
+class MosaicWindow(QMainWindow):
+    DETECT_PERIOD = 0.5  # seconds between two detections on the same tile
+
+    def __init__(
+        self,
+        sources: Sequence[str],
+        host_address: str,
+        host_port: int,
+        rtp_port: int,
+        parent=None,
+        add_obj_detect: bool = False,
+        detect_hidden: bool = False,
+        interleaved: bool = False,
+        codecs: Optional[List[str]] = None,
+        decode_workers: Optional[int] = None,
+    ):
+        super(MosaicWindow, self).__init__(parent)
+        self.setWindowTitle("Real Time Streaming - Mosaic")
+
+        # cv2 decodes without holding the GIL, a few threads serve every tile
+        self._decode_pool = ThreadPoolExecutor(
+            max_workers=decode_workers or min(4, os.cpu_count()), thread_name_prefix="decode"
+        )
+        # a single model for the whole mosaic, not one per tile
+        self._detector = self.Detector(self.DETECT_PERIOD, detect_hidden) if add_obj_detect else None
+
+        columns = math.ceil(math.sqrt(len(sources)))
+        layout = QGridLayout()
+        layout.setSpacing(2)
+        self.tiles: List[MosaicWindow.Tile] = []
+        for i, source in enumerate(sources):
+            client = Client(
+                source,
+                host_address,
+                host_port,
+                rtp_port + 2 * i,
+                interleaved=interleaved,
+                codecs=codecs,
+            )
+            tile = self.Tile(client, self._decode_pool)
+            layout.addWidget(tile, i // columns, i % columns)
+            self.tiles.append(tile)
+        central_widget = QWidget(self)
+        central_widget.setLayout(layout)
+        self.setCentralWidget(central_widget)
+
+        self._update_image_timer = QTimer()
+        self._update_image_timer.timeout.connect(self.update_images)
+
+    def start(self):
+        for tile in self.tiles:
+            tile.start()
+        if self._detector is not None:
+            self._detector.start(self.tiles)
+        self._update_image_timer.start(1000 // VideoStream.DEFAULT_FPS)
+
+    def update_images(self):
+        for tile in self.tiles:
+            tile.update_image()
+
+    def closeEvent(self, event):
+        self._update_image_timer.stop()
+        if self._detector is not None:
+            self._detector.stop()
+        for tile in self.tiles:
+            tile.stop()
+        self._decode_pool.shutdown(wait=False)
+        super().closeEvent(event)
+
+    # ===========================
+    # One stream of the mosaic. Its receive thread hands complete frames to
+    # the decode pool, at most one at a time: a frame arriving while the
+    # previous one is still being decoded is dropped, never queued.
+    # ===========================
+    class Tile(QLabel):
+        def __init__(self, client: Client, decode_pool: ThreadPoolExecutor) -> None:
+            super().__init__()
+            self.client = client
+            self.client.on_frame = self._on_frame
+            self._decode_pool = decode_pool
+            self.setMinimumSize(160, 120)
+            self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+            self.setAlignment(Qt.AlignCenter)
+            self.setStyleSheet("background-color: black; color: white")
+
+            # written by the GUI thread, read by the receive and decode threads
+            self.shown = True
+            self.display_size: Tuple[int, int] = (320, 240)
+            # latest frame, BGR at the tile's size, and the boxes the
+            # detector found on it
+            self.frame: Optional[np.ndarray] = None
+            self.boxes: List[Tuple[int, int, int, int]] = []
+            self._painted: Optional[np.ndarray] = None
+            self._decoding = False
+            self._lock = Lock()
+            # (width, height) of the payloads, once one was decoded
+            self._payload_size: Optional[Tuple[int, int]] = None
+            self.dropped = 0  # frames not decoded, the previous one still was
+
+        def start(self):
+            try:
+                self.client.establish_rtsp_connection()
+                self.client.send_setup_request(play=True)
+            except (OSError, RTSPStatusError) as e:
+                self.setText(f"{self.client.file_path}: {e}")
+
+        def stop(self):
+            if not self.client.is_rtsp_connected:
+                return
+            try:
+                self.client.send_teardown_request()
+            except (OSError, RTSPStatusError) as e:
+                print(f"Teardown of {self.client.file_path} failed: {e}")
+
+        def _on_frame(self, packet: RTPPacket):
+            # receive thread
+            if not self.shown:
+                return
+            with self._lock:
+                if self._decoding:
+                    self.dropped += 1
+                    return
+                self._decoding = True
+            self._decode_pool.submit(self._decode, packet)
+
+        def _reduction(self) -> int:
+            # the largest JPEG reduction still at least as big as the tile
+            if self._payload_size is None:
+                return 1
+            width, height = self._payload_size
+            display_width, display_height = self.display_size
+            for reduction in (8, 4, 2):
+                if width // reduction >= display_width and height // reduction >= display_height:
+                    return reduction
+            return 1
+
+        def _decode(self, packet: RTPPacket):
+            # decode thread
+            try:
+                codec = by_payload_type(packet.payload_type)
+                if codec is None:
+                    print(f"[RTP] Unknown payload type {packet.payload_type}")
+                    return
+                # only JPEG decodes at a reduced size, the others at full size
+                reduction = self._reduction() if codec.name == "JPEG" else 1
+                image = codec.decode(packet.payload, reduction)
+                if image is None:
+                    return
+                height, width = image.shape[:2]
+                self._payload_size = width * reduction, height * reduction
+                display_width, display_height = self.display_size
+                scale = min(display_width / width, display_height / height)
+                size = max(1, round(width * scale)), max(1, round(height * scale))
+                if size != (width, height):
+                    image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                self.frame = image
+            finally:
+                with self._lock:
+                    self._decoding = False
+
+        def update_image(self):
+            # GUI thread: whether the tile can be seen, and its latest frame
+            self.shown = (
+                self.isVisible()
+                and not self.window().isMinimized()
+                and not self.visibleRegion().isEmpty()
+            )
+            self.display_size = max(1, self.width()), max(1, self.height())
+            frame = self.frame
+            if not self.shown or frame is None or frame is self._painted:
+                return
+            self._painted = frame
+            if self.boxes:
+                frame = frame.copy()
+                for xmin, ymin, xmax, ymax in self.boxes:
+                    cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (10, 255, 0), 2)
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            height, width = frame_rgb.shape[:2]
+            image = QImage(frame_rgb.data, width, height, 3 * width, QImage.Format_RGB888)
+            self.setPixmap(QPixmap.fromImage(image))
+
+    # ===========================
+    # Object detection for every tile, in turn, on one thread: the process
+    # loads the model once and the tiles share its interpreter
+    # ===========================
+    class Detector:
+        def __init__(self, period: float, detect_hidden: bool = False) -> None:
+            # loads TensorFlow and the model
+            from utils.inference import detect
+
+            self._detect = detect
+            self.period = period
+            self.detect_hidden = detect_hidden
+            self._stopped = Event()
+            self._thread: Optional[Thread] = None
+
+        def start(self, tiles: Sequence["MosaicWindow.Tile"]):
+            self._thread = Thread(target=self._run, args=(list(tiles),), name="detect")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+        def stop(self):
+            self._stopped.set()
+
+        def _run(self, tiles: List["MosaicWindow.Tile"]):
+            # every tile is detected on once per period
+            for tile in cycle(tiles):
+                if self._stopped.wait(self.period / len(tiles)):
+                    return
+                if not tile.shown and not self.detect_hidden:
+                    continue
+                frame = tile.frame
+                if frame is None:
+                    continue
+                tile.boxes = [box for box, _, _ in self._detect(frame)]
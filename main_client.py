@@ -2,6 +2,8 @@ from PyQt5.QtWidgets import QApplication
 import os
 
 from client.client_gui import ClientWindow
+from utils.codecs import CODECS
+from utils.tiles import TileEncoder
 
 
 if __name__ == "__main__":
@@ -9,11 +11,20 @@ if __name__ == "__main__":
 
     if len(sys.argv) < 5:
         print(
-            f"Usage: {sys.argv[0].split('/')[-1]} <file name> <host address> <host port> <RTP port>"
+            f"Usage: {sys.argv[0].split('/')[-1]} <file name> <host address> <host port> <RTP port> [udp|tcp|multicast] [tiles] [<codec>[;quality=<Q>]...]"
         )
         exit(-1)
 
-    file_name, host_address, host_port, rtp_port = (*sys.argv[1:],)
+    file_name, host_address, host_port, rtp_port = (*sys.argv[1:5],)
+    options = [option.lower() for option in sys.argv[5:]]
+    # "tcp" interleaves RTP and RTCP with RTSP on the same connection,
+    # "multicast" joins the group the server streams this source to
+    interleaved = "tcp" in options
+    multicast = "multicast" in options
+    # "tiles" only receives the parts of the frames that changed
+    tile_size = TileEncoder.DEFAULT_TILE_SIZE if "tiles" in options else None
+    # codecs accepted, by preference, e.g. "webp;quality=70" jpeg
+    codecs = [option for option in options if option.split(";")[0].upper() in CODECS] or None
 
     try:
         host_port = int(host_port)
@@ -25,10 +36,27 @@ if __name__ == "__main__":
 
     app = QApplication(sys.argv)
     if os.path.isfile(file_name):
-        client = ClientWindow(file_name, host_address, host_port, rtp_port)
+        client = ClientWindow(
+            file_name,
+            host_address,
+            host_port,
+            rtp_port,
+            interleaved=interleaved,
+            multicast=multicast,
+            tile_size=tile_size,
+            codecs=codecs,
+        )
     else:
         client = ClientWindow(
-            file_name, host_address, host_port, rtp_port, add_obj_detect=False
+            file_name,
+            host_address,
+            host_port,
+            rtp_port,
+            add_obj_detect=False,
+            interleaved=interleaved,
+            multicast=multicast,
+            tile_size=tile_size,
+            codecs=codecs,
         )
     client.resize(400, 300)
     client.show()
@@ -0,0 +1,48 @@
+from PyQt5.QtWidgets import QApplication
+
+from client.mosaic_gui import MosaicWindow
+from utils.codecs import CODECS
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 5:
+        print(
+            f"Usage: {sys.argv[0].split('/')[-1]} <host address> <host port> <RTP port> <file name>... [tcp] [detect] [<codec>[;quality=<Q>]...]"
+        )
+        exit(-1)
+
+    host_address, host_port, rtp_port = (*sys.argv[1:4],)
+    options = {"tcp", "detect"}
+    arguments = sys.argv[4:]
+    # one tile per file name, the RTP ports following each other from <RTP port>
+    codecs = [argument for argument in arguments if argument.split(";")[0].upper() in CODECS] or None
+    file_names = [
+        argument
+        for argument in arguments
+        if argument.lower() not in options and argument not in (codecs or [])
+    ]
+    interleaved = "tcp" in map(str.lower, arguments)
+    add_obj_detect = "detect" in map(str.lower, arguments)
+
+    try:
+        host_port = int(host_port)
+        rtp_port = int(rtp_port)
+    except ValueError:
+        raise ValueError("port values should be integer")
+
+    app = QApplication(sys.argv)
+    mosaic = MosaicWindow(
+        file_names,
+        host_address,
+        host_port,
+        rtp_port,
+        add_obj_detect=add_obj_detect,
+        interleaved=interleaved,
+        codecs=codecs,
+    )
+    mosaic.resize(960, 720)
+    mosaic.show()
+    mosaic.start()
+    sys.exit(app.exec_())
@@ -0,0 +1,35 @@
+import argparse
+
+from utils.impairment import add_arguments, schedule_from_arguments
+from utils.impairment_proxy import ImpairmentProxy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Relay RTSP to a server, impairing RTP on its way to the client"
+    )
+    parser.add_argument("-i", "--IPADDRESS", type=str, default="127.0.0.1", help="The proxy IP address")
+    parser.add_argument("-p", "--PORT", type=int, default=5550, help="The port clients connect to")
+    parser.add_argument("-s", "--SERVER", type=str, default="127.0.0.1", help="The RTSP server IP address")
+    parser.add_argument("-P", "--SERVERPORT", type=int, default=5540, help="The RTSP server port")
+    add_arguments(parser)
+    parser.add_argument("--uplink", action="store_true", help="Impair RTCP reports the same way")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random impairments")
+    args = parser.parse_args()
+
+    downlink = schedule_from_arguments(args)
+
+    proxy = ImpairmentProxy(
+        args.IPADDRESS,
+        args.PORT,
+        args.SERVER,
+        args.SERVERPORT,
+        downlink,
+        uplink=downlink if args.uplink else None,
+        seed=args.seed,
+    )
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        print("Closing the proxy...")
+        proxy.close()
@@ -1,5 +1,8 @@
 import argparse
-from server.server import Server
+import asyncio
+from server.session_manager import SessionManager
+from server.aio_server import AsyncSessionManager
+from utils.codecs import CODECS
 
 
 if __name__ == "__main__":
@@ -18,7 +21,7 @@ if __name__ == "__main__":
         "--SESSIONID",
         type=str,
         default="123456",
-        help="Session IDServer session ID",
+        help="Prefix of the server session IDs",
     )
     parser.add_argument(
         "-l",
@@ -27,23 +30,122 @@ if __name__ == "__main__":
         default=0,
         help="Probability of rtp packet loss",
     )
+    parser.add_argument(
+        "-a",
+        "--asyncio",
+        action="store_true",
+        help="Serve every session from a single asyncio event loop",
+    )
+    parser.add_argument(
+        "-b",
+        "--BANDWIDTH",
+        type=float,
+        default=None,
+        help="Egress budget shared by all sessions, in kbit/s",
+    )
+    parser.add_argument(
+        "-w",
+        "--PRIORITY",
+        action="append",
+        default=[],
+        metavar="HOST=WEIGHT",
+        help="Weight of a client host in the bandwidth split (default 1)",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--MAXSESSIONS",
+        type=int,
+        default=None,
+        help="Number of sessions served at once, further SETUPs get 503",
+    )
+    parser.add_argument(
+        "-t",
+        "--TIMEOUT",
+        type=int,
+        default=60,
+        help="Seconds without RTSP or RTCP traffic before a session is closed",
+    )
+    parser.add_argument(
+        "-c",
+        "--CODECS",
+        type=str,
+        default=",".join(CODECS),
+        help="Payload codecs clients may ask for, comma-separated",
+    )
+    parser.add_argument(
+        "-r",
+        "--SIMULCAST",
+        type=str,
+        default="",
+        help="Downscale factors multicast groups also send their stream at, comma-separated (e.g. 2,4)",
+    )
+    parser.add_argument(
+        "-e",
+        "--ENCODERS",
+        type=int,
+        default=None,
+        help="Encode frames in that many processes shared by all sessions, instead of threads",
+    )
+    parser.add_argument(
+        "-o",
+        "--roi",
+        action="store_true",
+        help="Under congestion, smooth the background around detected people and vehicles first",
+    )
 
     args = parser.parse_args()
     # print(args.IPADDRESS, args.PORT, args.SESSIONID)
-
-    while True:
-        server = Server(args.IPADDRESS, args.PORT, args.SESSIONID, args.PROBLOST)
+    bandwidth = args.BANDWIDTH * 1000 / 8 if args.BANDWIDTH else None  # bytes/s
+    priorities = {}
+    for priority in args.PRIORITY:
+        host, _, weight = priority.partition("=")
+        priorities[host] = float(weight)
+    codecs = [name.strip() for name in args.CODECS.split(",") if name.strip()]
+    simulcast = [int(factor) for factor in args.SIMULCAST.split(",") if factor.strip()]
+    if args.roi:
+        # sessions load the detector at SETUP, fail now rather than on each
         try:
-            server.setup()
-            server.handle_rtsp_requests()
-        except ConnectionError as e:
-            server.server_state = server.STATE.TEARDOWN
-            print(f"Connection reset: {e}")
-            break
-        except OSError:
-            print("Address already in use...")
-            print("Please try again")
-            break
-        except KeyboardInterrupt:
-            print("Closing the server...")
-            break
+            import utils.inference  # noqa: F401
+        except Exception as e:
+            print(f"--roi needs the object detector (TensorFlow Lite), which failed to load: {e}")
+            exit(-1)
+
+    try:
+        if args.asyncio:
+            server = AsyncSessionManager(
+                args.IPADDRESS,
+                args.PORT,
+                args.SESSIONID,
+                args.PROBLOST,
+                bandwidth=bandwidth,
+                priorities=priorities,
+                max_sessions=args.MAXSESSIONS,
+                session_timeout=args.TIMEOUT,
+                codecs=codecs,
+                simulcast=simulcast,
+                encode_processes=args.ENCODERS,
+                roi=args.roi,
+            )
+            asyncio.run(server.serve_forever())
+        else:
+            server = SessionManager(
+                args.IPADDRESS,
+                args.PORT,
+                args.SESSIONID,
+                args.PROBLOST,
+                bandwidth=bandwidth,
+                priorities=priorities,
+                max_sessions=args.MAXSESSIONS,
+                session_timeout=args.TIMEOUT,
+                codecs=codecs,
+                simulcast=simulcast,
+                encode_processes=args.ENCODERS,
+                roi=args.roi,
+            )
+            server.serve_forever()
+    except OSError:
+        print("Address already in use...")
+        print("Please try again")
+    except KeyboardInterrupt:
+        print("Closing the server...")
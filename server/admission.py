@@ -0,0 +1,72 @@
+import os
+from threading import Lock
+from typing import Callable, Iterable, Set, Union
+
+from server.bandwidth import BandwidthAllocator
+from server.multicast import MulticastRegistry
+from server.server import Server
+from utils.rtsp_packet import RTSPPacket
+
+
+# ===========================
+# Decides on the status answered to a SETUP, so that a load spike degrades
+# the newcomers instead of the sessions already running
+# ===========================
+class AdmissionControl:
+    MAX_ENCODE_LOAD = 0.9  # of the encode capacity
+
+    def __init__(
+        self,
+        sessions: Callable[[], Iterable[Server]],
+        multicast: MulticastRegistry,
+        allocator: Union[None, BandwidthAllocator] = None,
+        max_sessions: Union[None, int] = None,
+        encode_capacity: Union[None, int] = None,
+        lock: Union[None, Lock] = None,
+    ):
+        self._sessions = sessions  # every session of the manager
+        self._multicast = multicast
+        self._allocator = allocator
+        self.max_sessions = max_sessions
+        # CPUs (or encoder workers) available to read and encode frames
+        self.encode_capacity = encode_capacity or os.cpu_count()
+        # sessions holding a slot, from the SETUP admitting them until they
+        # close; taken under the manager's lock, so that SETUPs arriving
+        # together can't all get the last slot
+        self._admitted: Set[Server] = set()
+        self._lock = lock or Lock()
+
+    def encode_load(self) -> float:
+        streams = list(self._sessions()) + self._multicast.groups()
+        return sum(stream.encode_load for stream in streams)
+
+    def __call__(self, session: Server, packet: RTSPPacket) -> int:
+        with self._lock:
+            status_code = self._decide(session, packet)
+            if status_code == RTSPPacket.OK:
+                self._admitted.add(session)
+            return status_code
+
+    def release(self, session: Server):
+        # the session closed, its slot is free
+        with self._lock:
+            self._admitted.discard(session)
+
+    def _decide(self, session: Server, packet: RTSPPacket) -> int:
+        admitted = self._admitted - {session}
+        if self.max_sessions is not None and len(admitted) >= self.max_sessions:
+            print(f"Session {session.sessionID} rejected: {len(admitted)} sessions running")
+            return RTSPPacket.SERVICE_UNAVAILABLE
+        if packet.multicast and self._multicast.has_group(
+            packet.video_file_path, packet.blocksize
+        ):
+            # joining a running group costs neither encoding nor bandwidth
+            return RTSPPacket.OK
+        load = self.encode_load()
+        if load >= self.MAX_ENCODE_LOAD * self.encode_capacity:
+            print(f"Session {session.sessionID} rejected: encode load {load:.2f}")
+            return RTSPPacket.SERVICE_UNAVAILABLE
+        if self._allocator is not None and not self._allocator.can_admit(session.weight):
+            print(f"Session {session.sessionID} rejected: bandwidth budget exhausted")
+            return RTSPPacket.NOT_ENOUGH_BANDWIDTH
+        return RTSPPacket.OK
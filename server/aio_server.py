@@ -0,0 +1,433 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple, Union
+
+from server.admission import AdmissionControl
+from server.bandwidth import BandwidthAllocator
+from server.multicast import MulticastRegistry
+from server.server import Server
+from server.transport import RtpTransport
+from utils.datagram import DatagramSizer, SOCKET_BUFFER_SIZE, fragment, set_socket_buffers
+from utils.encode_pool import EncodePool
+from utils.interleaved import MAX_FRAME_DATA, frame_buffers
+from utils.rtcp_packet import RTCPPacket, InvalidRequest
+from utils.rtsp_packet import RTSPPacket
+from utils.tiles import TileEncoder
+
+
+# ===========================
+# asyncio counterpart of RtpTransport: one datagram endpoint sends RTP for
+# every session, another receives RTCP and routes it by SSRC
+# ===========================
+class AsyncRtpTransport(asyncio.DatagramProtocol):
+    def __init__(self, host: str, rtcp_port: int = RtpTransport.RTCP_RCV_PORT) -> None:
+        self.host = host
+        self.rtcp_port = rtcp_port
+        self._rtp_transport: Union[None, asyncio.DatagramTransport] = None
+        self._rtcp_transport: Union[None, asyncio.DatagramTransport] = None
+        self._sessions: Dict[int, "AsyncSession"] = {}
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._rtp_transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, local_addr=(self.host, 0)
+        )
+        set_socket_buffers(
+            self._rtp_transport.get_extra_info("socket"), sndbuf=SOCKET_BUFFER_SIZE
+        )
+        self._rtcp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.rtcp_port)
+        )
+        print(f"[RTCP] UDP server is up and listening on {self.host}:{self.rtcp_port}")
+
+    def register(self, session) -> int:
+        ssrc = RTCPPacket.new_ssrc()
+        while ssrc in self._sessions:
+            ssrc = RTCPPacket.new_ssrc()
+        self._sessions[ssrc] = session
+        return ssrc
+
+    def unregister(self, ssrc: int):
+        self._sessions.pop(ssrc, None)
+
+    def sendto(self, datagram: bytes, address: Tuple[str, int]):
+        # never blocks, the transport buffers when the socket is full
+        self._rtp_transport.sendto(datagram, address)
+
+    def close(self):
+        for transport in (self._rtp_transport, self._rtcp_transport):
+            if transport is not None:
+                transport.close()
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        try:
+            rtcp_pkt = RTCPPacket.from_bitstream(data)
+        except InvalidRequest as e:
+            print(f"[RTCP] Dropping malformed packet: {e}")
+            return
+        session = self._sessions.get(rtcp_pkt.source_ssrc)
+        if session is None:
+            print(f"[RTCP] Report for unknown SSRC {rtcp_pkt.source_ssrc:08X}")
+            return
+        session._rtcp_receiver.handle_packet(rtcp_pkt)
+
+
+# ===========================
+# One RTSP session driven by the event loop. The RTSP control channel is a
+# stream, frames are paced with loop timers and read/encoded in an executor.
+# ===========================
+class AsyncSession(Server):
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        sessionID: str,
+        transport: AsyncRtpTransport,
+        executor: ThreadPoolExecutor,
+        lost_probability: float = 0,
+        multicast: Union[None, MulticastRegistry] = None,
+        allocator: Union[None, BandwidthAllocator] = None,
+        session_timeout: int = Server.DEFAULT_SESSION_TIMEOUT,
+        admission: Union[None, AdmissionControl] = None,
+        codecs: Union[None, List[str]] = None,
+        encode_pool: Union[None, EncodePool] = None,
+        roi: bool = False,
+    ):
+        super().__init__(
+            transport.host,
+            0,
+            sessionID,
+            lost_probability,
+            transport=transport,
+            multicast=multicast,
+            allocator=allocator,
+            session_timeout=session_timeout,
+            admission=admission,
+            codecs=codecs,
+            encode_pool=encode_pool,
+            roi=roi,
+        )
+        self._reader = reader
+        self._writer = writer
+        self._executor = executor
+        self._client_address = writer.get_extra_info("peername")[:2]
+        self._sender: Union[None, asyncio.Task] = None
+        # set on every state change, lets the sender react without polling
+        self._state_changed = asyncio.Event()
+
+    @property
+    def server_state(self) -> int:
+        return self._state.state
+
+    @server_state.setter
+    def server_state(self, state: int):
+        if self._state.set(state):
+            self._state_changed.set()
+            if self._multicast_group is not None:
+                self._multicast_group.update_state()
+
+    async def run(self):
+        try:
+            await self._wait_setup()
+            await self.handle_rtsp_requests()
+        except ConnectionError as e:
+            print(f"Session {self.sessionID} closed: {e}")
+        except Exception as e:
+            print(f"Session {self.sessionID} failed: {e}")
+        finally:
+            await self.close()
+
+    async def _get_rtsp_packet(self) -> RTSPPacket:
+        while True:
+            item = self._demuxer.next()
+            if item is None:
+                recv = await self._reader.read(self.DEFAULT_CHUNK_SIZE)
+                if not recv:
+                    raise ConnectionError("client closed the RTSP connection")
+                self._demuxer.feed(recv)
+                self.touch()
+            elif isinstance(item, tuple):
+                self._handle_interleaved_frame(*item)
+            else:
+                return RTSPPacket.from_request(item)
+
+    def _rtsp_send(self, data: bytes) -> int:
+        self._writer.write(data)
+        return len(data)
+
+    async def _handle_stateless_request(self, packet: RTSPPacket) -> bool:
+        if packet.request_type == RTSPPacket.DESCRIBE:
+            # may open the capture, keep it off the loop
+            loop = asyncio.get_running_loop()
+            sdp = await loop.run_in_executor(
+                self._executor, self._describe, packet.video_file_path
+            )
+            self._send_rtsp_response(packet.sequence_number, sdp=sdp)
+            return True
+        return super()._handle_stateless_request(packet)
+
+    async def _wait_setup(self):
+        while True:
+            packet = await self._get_rtsp_packet()
+            if await self._handle_stateless_request(packet):
+                continue
+            if packet.request_type == RTSPPacket.SETUP:
+                self._admit(packet)
+                if not packet.multicast:
+                    self._negotiate_codecs(packet)
+                self.server_state = self.STATE.PAUSED
+                print("State set to PAUSED")
+                loop = asyncio.get_running_loop()
+                if packet.multicast:
+                    self._close_source()
+                    # a new group opens its capture and starts its threads
+                    await loop.run_in_executor(
+                        self._executor,
+                        self._join_multicast_group,
+                        packet.video_file_path,
+                        packet.blocksize,
+                    )
+                    self._send_rtsp_response(packet.sequence_number, setup=True)
+                    return
+                if packet.interleaved is not None:
+                    self._interleaved = packet.interleaved
+                else:
+                    self._client_address = self._client_address[0], packet.rtp_dst_port
+                if packet.tile_size is not None:
+                    self._tile_encoder = TileEncoder(packet.tile_size)
+                self._setup_rtcp()
+                # opening a capture can take a while, keep it off the loop
+                await loop.run_in_executor(
+                    self._executor, self._open_source, packet.video_file_path
+                )
+                if self._interleaved is None:
+                    self._datagram_sizer = DatagramSizer(self._client_address, packet.blocksize)
+                if self._allocator is not None:
+                    self._allocator.register(self)
+                self._sender = loop.create_task(self._handle_video_send())
+                self._send_rtsp_response(packet.sequence_number, setup=True)
+                return
+
+    async def handle_rtsp_requests(self):
+        while True:
+            packet = await self._get_rtsp_packet()
+            if packet.request_type == RTSPPacket.PLAY:
+                npt_range, scale = self._reposition(packet)
+                if self.server_state != self.STATE.PLAYING:
+                    self.server_state = self.STATE.PLAYING
+                    print("State set to PLAYING.")
+                self._send_rtsp_response(packet.sequence_number, npt_range=npt_range, scale=scale)
+                continue
+            elif packet.request_type == RTSPPacket.PAUSE:
+                if self.server_state != self.STATE.PAUSED:
+                    self.server_state = self.STATE.PAUSED
+                    print("State set to PAUSED.")
+            elif packet.request_type == RTSPPacket.TEARDOWN:
+                print("Received TEARDOWN request, shutting down...")
+                self._send_rtsp_response(packet.sequence_number)
+                raise ConnectionError("teardown requested")
+            elif await self._handle_stateless_request(packet):
+                continue
+            self._send_rtsp_response(packet.sequence_number)
+
+    async def close(self):
+        if self.server_state != self.STATE.TEARDOWN:
+            self.server_state = self.STATE.TEARDOWN
+        if self._sender is not None:
+            # let an encode still running in the executor finish before the
+            # capture is released under it
+            await self._sender
+        self._writer.close()
+        if self._multicast_group is not None:
+            group, self._multicast_group = self._multicast_group, None
+            self._multicast.leave(self, group)
+        if self._allocator is not None:
+            self._allocator.unregister(self)
+        if self._video_stream is not None:
+            self._video_stream.close()
+        self._transport.unregister(self.ssrc)
+
+    async def _sleep_until(self, deadline: float):
+        # returns early when the session state changes
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                self._state_changed.wait(), max(0.0, deadline - loop.time())
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    async def _handle_video_send(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            self._state_changed.clear()
+            state = self.server_state
+            if state == self.STATE.TEARDOWN:
+                return
+            if state != self.STATE.PLAYING:
+                await self._state_changed.wait()
+                continue
+            # waits for the read-ahead when it falls behind, off the loop
+            if await loop.run_in_executor(self._executor, self._is_end_of_stream):
+                if self._video_stream.error is not None:
+                    # closing the connection ends `run()`, which closes the
+                    # session once this sender has returned
+                    print(f"Session {self.sessionID} closed: its source failed ({self._video_stream.error})")
+                    self._writer.close()
+                    return
+                print(f"Reached end of file ({self._video_stream.stalls} read-ahead stalls).")
+                self.server_state = self.STATE.FINISHED
+                continue
+            if deadline < loop.time() - self.send_delay / 1000.0:
+                # resuming after a pause, don't burst to catch up
+                deadline = loop.time()
+            packet = await loop.run_in_executor(self._executor, self._next_rtp_packet)
+            if packet is not None and self._interleaved is not None:
+                # one buffered write per packet, and no reading ahead of a
+                # client that can't keep up
+                self._writer.writelines(
+                    frame_buffers(self._interleaved[0], fragment(packet, MAX_FRAME_DATA))
+                )
+                try:
+                    await self._writer.drain()
+                except ConnectionError:
+                    return
+            elif packet is not None:
+                for datagram in fragment(packet, self._datagram_sizer.size):
+                    self._transport.sendto(datagram, self._client_address)
+            deadline += self.send_delay / 1000.0
+            await self._sleep_until(deadline)
+
+
+# ===========================
+# asyncio counterpart of SessionManager: a single event loop carries the RTSP
+# connections, RTP/RTCP endpoints and pacing of every session
+# ===========================
+class AsyncSessionManager:
+    REAP_PERIOD = 5  # seconds between two looks for expired sessions
+
+    def __init__(
+        self,
+        rtsp_ip: str,
+        rtsp_port: int,
+        session_prefix: str,
+        lost_probability: float = 0,
+        rtcp_port: int = RtpTransport.RTCP_RCV_PORT,
+        encode_workers: Union[None, int] = None,
+        bandwidth: Union[None, float] = None,
+        priorities: Union[None, Dict[str, float]] = None,
+        max_sessions: Union[None, int] = None,
+        session_timeout: int = Server.DEFAULT_SESSION_TIMEOUT,
+        codecs: Union[None, List[str]] = None,
+        simulcast: Sequence[int] = (),
+        encode_processes: Union[None, int] = None,
+        roi: bool = False,
+    ):
+        self.rtsp_host = rtsp_ip
+        self.rtsp_port = rtsp_port
+        self.session_prefix = session_prefix
+        self.lost_probability = lost_probability
+        self.priorities = priorities or {}
+        # payload codecs sessions may agree on, all of them if None
+        self.codecs = codecs
+        # sessions degrade the background around detected objects first
+        self.roi = roi
+
+        self.allocator = BandwidthAllocator(bandwidth) if bandwidth else None
+        self.transport = AsyncRtpTransport(rtsp_ip, rtcp_port)
+        # frames are encoded by that many processes, shared by all sessions,
+        # instead of the read-ahead threads
+        self.encode_pool = EncodePool(encode_processes) if encode_processes else None
+        # groups run on their own threads, they never touch the event loop;
+        # they also send their stream downscaled by `simulcast`
+        self.multicast = MulticastRegistry(
+            rtsp_ip,
+            lost_probability,
+            allocator=self.allocator,
+            layers=simulcast,
+            encode_pool=self.encode_pool,
+        )
+        encode_workers = encode_workers or os.cpu_count()
+        self._executor = ThreadPoolExecutor(
+            max_workers=encode_workers, thread_name_prefix="encode"
+        )
+        self._sessions: Dict[str, AsyncSession] = {}
+        self._session_count = 0
+        self.session_timeout = session_timeout
+        # every session shares the executor, or the encoder processes:
+        # that's the encode capacity
+        self.admission = AdmissionControl(
+            lambda: list(self._sessions.values()),
+            self.multicast,
+            self.allocator,
+            max_sessions,
+            self.encode_pool.processes if self.encode_pool else encode_workers,
+        )
+
+    def _new_session_id(self) -> str:
+        self._session_count += 1
+        return f"{self.session_prefix}-{self._session_count}"
+
+    async def serve_forever(self):
+        await self.transport.start()
+        server = await asyncio.start_server(
+            self._handle_connection, self.rtsp_host, self.rtsp_port, reuse_address=True
+        )
+        print(f"Listening on {self.rtsp_host}:{self.rtsp_port}...")
+        reaper = asyncio.get_running_loop().create_task(self._reap_sessions())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reaper.cancel()
+            await self.close()
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        session = AsyncSession(
+            reader,
+            writer,
+            self._new_session_id(),
+            self.transport,
+            self._executor,
+            self.lost_probability,
+            self.multicast,
+            self.allocator,
+            self.session_timeout,
+            self.admission,
+            self.codecs,
+            self.encode_pool,
+            self.roi,
+        )
+        client_address = writer.get_extra_info("peername")
+        session.weight = self.priorities.get(client_address[0], 1.0)
+        print(
+            f"Accepted connection from {client_address[0]}:{client_address[1]}, "
+            f"session {session.sessionID}"
+        )
+        self._sessions[session.sessionID] = session
+        try:
+            await session.run()
+        finally:
+            self.admission.release(session)
+            self._sessions.pop(session.sessionID, None)
+
+    async def _reap_sessions(self):
+        while True:
+            await asyncio.sleep(min(self.REAP_PERIOD, self.session_timeout / 2))
+            for session in list(self._sessions.values()):
+                if session.is_expired():
+                    print(f"Session {session.sessionID} timed out")
+                    await session.close()
+
+    async def close(self):
+        for session in list(self._sessions.values()):
+            await session.close()
+        self.multicast.close()
+        self.transport.close()
+        self._executor.shutdown(wait=False)
+        if self.encode_pool is not None:
+            self.encode_pool.close()
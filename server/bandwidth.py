@@ -0,0 +1,95 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, Hashable, Optional, Tuple
+
+
+def max_min_shares(
+    budget: float, demands: Dict[Hashable, Tuple[Optional[float], float]]
+) -> Dict[Hashable, float]:
+    # weighted max-min fair split of `budget` between `demands`, given as
+    # key -> (demand, weight) with None for a demand not known yet. Whoever
+    # asks for less than its weighted share gets what it asks for, the rest
+    # is split again between the others; what nobody needs is handed back to
+    # everyone as headroom.
+    shares: Dict[Hashable, float] = {}
+    remaining = budget
+    total_weight = sum(weight for _, weight in demands.values())
+    if total_weight <= 0:
+        return {key: 0.0 for key in demands}
+    by_demand = sorted(
+        demands.items(),
+        key=lambda item: float("inf") if item[1][0] is None else item[1][0] / item[1][1],
+    )
+    weight_left = total_weight
+    for key, (demand, weight) in by_demand:
+        fair = remaining * weight / weight_left
+        share = fair if demand is None else min(demand, fair)
+        shares[key] = share
+        remaining -= share
+        weight_left -= weight
+    if remaining > 0:
+        for key, (_, weight) in demands.items():
+            shares[key] += remaining * weight / total_weight
+    return shares
+
+
+# ===========================
+# Server-wide egress budget: the playing sessions get a weighted max-min fair
+# share of it, which their congestion controller takes as a rate ceiling
+# ===========================
+class BandwidthAllocator:
+    REALLOCATION_PERIOD = 0.5  # seconds
+    # below this fraction of its demand a session is at the lowest quality
+    # level and starts losing frame rate
+    MIN_SHARE_RATIO = 0.2
+
+    def __init__(self, budget: float) -> None:
+        self.budget = budget  # bytes/s
+        self._sessions = []
+        self._lock = Lock()
+        self._last_allocation = 0.0
+
+    def register(self, session):
+        with self._lock:
+            self._sessions.append(session)
+        self.reallocate()
+
+    def unregister(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        session.rate_ceiling = None
+        self.reallocate()
+
+    def can_admit(self, weight: float = 1.0) -> bool:
+        # whether one more session, expected to need as much as the average
+        # one, leaves every session at least MIN_SHARE_RATIO of its demand
+        new_session = object()
+        with self._lock:
+            demands = {s: (s.demand, s.weight) for s in self._sessions}
+        known = [demand for demand, _ in demands.values() if demand is not None]
+        if not known:
+            return True
+        demands[new_session] = sum(known) / len(known), weight
+        shares = max_min_shares(self.budget, demands)
+        return all(
+            demand is None or shares[key] >= self.MIN_SHARE_RATIO * demand
+            for key, (demand, _) in demands.items()
+        )
+
+    def refresh(self):
+        # cheap enough to call for every frame, reallocates now and then
+        if monotonic() - self._last_allocation >= self.REALLOCATION_PERIOD:
+            self.reallocate()
+
+    def reallocate(self):
+        with self._lock:
+            self._last_allocation = monotonic()
+            active = [
+                s for s in self._sessions if s.server_state == s.STATE.PLAYING
+            ]
+            shares = max_min_shares(
+                self.budget, {s: (s.demand, s.weight) for s in active}
+            )
+            for session in self._sessions:
+                session.rate_ceiling = shares.get(session)
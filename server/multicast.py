@@ -0,0 +1,300 @@
+import socket
+import struct
+from statistics import median
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Sequence, Tuple, Union
+
+from server.bandwidth import BandwidthAllocator
+from server.server import Server
+from server.transport import RtpTransport
+from utils.datagram import fragment
+from utils.encode_pool import EncodePool
+from utils.multicast import (
+    DEFAULT_TTL,
+    GROUP_BASE_PORT,
+    GROUP_NETWORK,
+    group_addresses,
+    open_group_socket,
+    set_multicast_sender,
+    wake_local_listeners,
+)
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_packet import SimulcastLayer
+from utils.video_stream import VideoStream
+
+
+# ===========================
+# RtpTransport of a multicast group: RTP is sent to the group address and the
+# members' RTCP reports are received from the group
+# ===========================
+class MulticastTransport(RtpTransport):
+    def __init__(self, interface: str, destination: Tuple[str, int], ttl: int = DEFAULT_TTL) -> None:
+        self.group, self.rtp_port = destination
+        self.ttl = ttl
+        super().__init__(interface, self.rtp_port + 1)
+
+    def _open_rtp_socket(self) -> socket.socket:
+        rtp_socket = super()._open_rtp_socket()
+        set_multicast_sender(rtp_socket, self.host, self.ttl)
+        return rtp_socket
+
+    def _open_rtcp_socket(self) -> socket.socket:
+        return open_group_socket(self.group, self.rtcp_port, self.host, self.ttl)
+
+    def _wake_rtcp_receiver(self):
+        wake_local_listeners((self.group, self.rtcp_port), self.host)
+
+
+# ===========================
+# A stream sent once to every member of a multicast group. The group plays
+# while at least one of its member sessions does.
+#
+# Simulcast: the group may also send the stream downscaled, as layers each on
+# their own group address with their own SSRC. Every rendition of a frame is
+# encoded in the same pass, and members move between layers themselves by
+# joining another group, so what the server spends on adaptation doesn't
+# grow with the number of viewers.
+# ===========================
+class MulticastGroup(Server):
+    def __init__(
+        self,
+        key: Tuple[str, int],
+        destination: Tuple[str, int],
+        interface: str,
+        ttl: int = DEFAULT_TTL,
+        lost_probability: float = 0,
+        allocator: Union[None, BandwidthAllocator] = None,
+        layers: Sequence[Tuple[int, Tuple[str, int]]] = (),
+        encode_pool: Union[None, EncodePool] = None,
+    ):
+        super().__init__(
+            interface,
+            0,
+            f"group-{destination[0]}",
+            lost_probability,
+            transport=MulticastTransport(interface, destination, ttl),
+            allocator=allocator,
+            encode_pool=encode_pool,
+        )
+        self._owns_transport = True
+        self.key = key
+        self.destination = destination
+        self.ttl = ttl
+        self._client_address = destination
+        self._members: List[Server] = []
+        self._members_lock = Lock()
+        # (downscale, destination) of the simulcast layers, SSRCs are
+        # given on start
+        self._layer_destinations = list(layers)
+        self.layers: List[MulticastGroup.Layer] = []
+
+    # ===========================
+    # A simulcast layer: the group stream downscaled
+    # ===========================
+    class Layer:
+        def __init__(self, downscale: int, destination: Tuple[str, int], ssrc: int) -> None:
+            self.downscale = downscale
+            self.destination = destination
+            self.ssrc = ssrc
+
+    @property
+    def weight(self) -> float:
+        # the stream is worth as much bandwidth as all its viewers together
+        with self._members_lock:
+            return sum(m.weight for m in self._members) or self._weight
+
+    @weight.setter
+    def weight(self, weight: float):
+        self._weight = weight
+
+    def start(self):
+        video_file_path, blocksize = self.key
+        self._transport.start()
+        self._setup_rtcp()
+        # members on a layer report with its SSRC, the group hears them all
+        self.layers = [
+            self.Layer(downscale, destination, self._transport.register(self))
+            for downscale, destination in self._layer_destinations
+        ]
+        self.server_state = self.STATE.PAUSED
+        self._setup_rtp(video_file_path, blocksize)
+
+    @property
+    def simulcast(self) -> Union[None, List[SimulcastLayer]]:
+        # every layer as announced in SETUP, the group stream first
+        if not self.layers:
+            return None
+        return [(1, self.ssrc, self.destination)] + [
+            (layer.downscale, layer.ssrc, layer.destination) for layer in self.layers
+        ]
+
+    def _open_source(self, video_file_path: str) -> VideoStream:
+        if self.layers:
+            self._video_stream = VideoStream(video_file_path, encode_pool=self._encode_pool)
+            self._video_stream.set_layers([(layer.downscale, None) for layer in self.layers])
+        return super()._open_source(video_file_path)
+
+    def _send_rtp_packet(self, packet: bytes):
+        super()._send_rtp_packet(packet)
+        if not self.layers:
+            return
+        # the layers take the sequence number and timestamp of the group
+        # stream: a member switching layers sees a single sequence
+        sequence_number, timestamp = struct.unpack_from("!HI", packet, 2)
+        video_stream = self._video_stream
+        frame_size = struct.pack("!HH", video_stream.width, video_stream.height)
+        for layer, payload in zip(self.layers, video_stream.current_layers):
+            rtp_packet = RTPPacket(
+                payload_type=video_stream.current_codec.payload_type,
+                sequence_number=sequence_number,
+                timestamp=timestamp,
+                payload=payload,
+                ssrc=layer.ssrc,
+                extensions={RTPPacket.EXTENSION_FRAME_SIZE: frame_size},
+            )
+            for datagram in fragment(rtp_packet.get_packet(), self._datagram_sizer.size):
+                try:
+                    self._transport.sendto(datagram, layer.destination)
+                except socket.error as e:
+                    print(f"failed to send rtp packet: {e}")
+                    return
+
+    def join(self, session: Server):
+        with self._members_lock:
+            self._members.append(session)
+
+    def leave(self, session: Server) -> bool:
+        # True once the last member is gone
+        with self._members_lock:
+            if session in self._members:
+                self._members.remove(session)
+            empty = not self._members
+        self.update_state()
+        return empty
+
+    def _source_failed(self):
+        # ends the sessions of every member, the last one to leave closes
+        # the group
+        print(f"Multicast group {self.destination[0]} closed: its source failed ({self._video_stream.error})")
+        with self._members_lock:
+            members = list(self._members)
+        for member in members:
+            member.close()
+        self.close()
+
+    def update_state(self):
+        # called by the members whenever their state changes
+        with self._members_lock:
+            playing = any(m.server_state == self.STATE.PLAYING for m in self._members)
+            if playing and self.server_state == self.STATE.PAUSED:
+                self.server_state = self.STATE.PLAYING
+                print(f"Multicast group {self.destination[0]} set to PLAYING.")
+            elif not playing and self.server_state == self.STATE.PLAYING:
+                self.server_state = self.STATE.PAUSED
+                print(f"Multicast group {self.destination[0]} set to PAUSED.")
+
+    # ===========================
+    # Every member reports on the group stream: the median loss drives the
+    # group, one receiver on a bad link doesn't degrade it for everyone. A
+    # simulcast group isn't degraded at all, its members change layers.
+    # ===========================
+    class RtcpReceiver(Server.RtcpReceiver):
+        REPORT_TIMEOUT = 5.0  # seconds before a silent member is forgotten
+
+        def __init__(self, server) -> None:
+            super().__init__(server)
+            self._reports: Dict[int, Tuple[float, float]] = {}
+
+        def handle_packet(self, rtcp_pkt):
+            now = monotonic()
+            self._reports[rtcp_pkt.ssrc] = rtcp_pkt.fraction_lost, now
+            self._reports = {
+                ssrc: report
+                for ssrc, report in self._reports.items()
+                if now - report[1] < self.REPORT_TIMEOUT
+            }
+            if self.server.layers:
+                return
+            self.on_fraction_lost(median(lost for lost, _ in self._reports.values()))
+
+
+# ===========================
+# Hands out multicast groups: sessions asking for the same source with the
+# same datagram size share one group
+# ===========================
+class MulticastRegistry:
+    def __init__(
+        self,
+        interface: str,
+        lost_probability: float = 0,
+        ttl: int = DEFAULT_TTL,
+        network: str = GROUP_NETWORK,
+        base_port: int = GROUP_BASE_PORT,
+        allocator: Union[None, BandwidthAllocator] = None,
+        layers: Sequence[int] = (),
+        encode_pool: Union[None, EncodePool] = None,
+    ):
+        self.interface = interface
+        self.encode_pool = encode_pool
+        # downscale factors of the simulcast layers sent by every group
+        self.layers = [downscale for downscale in layers if downscale > 1]
+        self.allocator = allocator
+        self.lost_probability = lost_probability
+        self.ttl = ttl
+        self._addresses = group_addresses(network, base_port)
+        self._released: List[Tuple[str, int]] = []
+        self._groups: Dict[Tuple[str, int], MulticastGroup] = {}
+        self._lock = Lock()
+
+    def join(self, session: Server, video_file_path: str, blocksize: int) -> MulticastGroup:
+        key = video_file_path, blocksize
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                destination = self._next_destination()
+                layers = [(downscale, self._next_destination()) for downscale in self.layers]
+                group = MulticastGroup(
+                    key,
+                    destination,
+                    self.interface,
+                    self.ttl,
+                    self.lost_probability,
+                    self.allocator,
+                    layers,
+                    self.encode_pool,
+                )
+                group.start()
+                self._groups[key] = group
+                print(f"Multicast group {destination[0]}:{destination[1]} streams {video_file_path}")
+            group.join(session)
+        return group
+
+    def _next_destination(self) -> Tuple[str, int]:
+        # holding the lock
+        return self._released.pop() if self._released else next(self._addresses)
+
+    def has_group(self, video_file_path: str, blocksize: int) -> bool:
+        with self._lock:
+            return (video_file_path, blocksize) in self._groups
+
+    def groups(self) -> List[MulticastGroup]:
+        with self._lock:
+            return list(self._groups.values())
+
+    def leave(self, session: Server, group: MulticastGroup):
+        with self._lock:
+            if not group.leave(session) or self._groups.get(group.key) is not group:
+                return
+            del self._groups[group.key]
+            self._released.append(group.destination)
+            self._released.extend(layer.destination for layer in group.layers)
+        group.close()
+        print(f"Multicast group {group.destination[0]} closed")
+
+    def close(self):
+        with self._lock:
+            groups = list(self._groups.values())
+            self._groups.clear()
+        for group in groups:
+            group.close()
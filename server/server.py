@@ -2,63 +2,128 @@ import os
 from pickletools import optimize
 from random import random
 import socket
-from io import BytesIO
 
-from PIL import Image
-from time import sleep
-from threading import Thread
-from typing import Union, Tuple
+from time import monotonic
+from threading import Lock, Thread, current_thread
+from typing import Callable, List, Union, Tuple
 
 import cv2
 import numpy as np
 import math
 import struct
 
+from utils.clock import SYSTEM_CLOCK, Clock
+from utils.codecs import CODECS, DEFAULT_CODEC, Codec, negotiate
+from utils.encode_pool import EncodePool
 from utils.video_stream import VideoStream
-from utils.rtsp_packet import RTSPPacket
+from utils.datagram import DatagramSizer, fragment
+from utils.interleaved import InterleavedDemuxer, MAX_FRAME_DATA, send_interleaved
+from server.bandwidth import BandwidthAllocator
+from server.transport import RtpTransport
+from utils.rtsp_packet import NptRange, RTSPPacket
 from utils.rtp_packet import RTPPacket
-from utils.rtcp_packet import RTCPPacket
+from utils.rtcp_packet import RTCPPacket, InvalidRequest
+from utils.sdp import MediaDescription
+from utils.roi import RoiFilter
+from utils.tiles import TileEncoder
+from utils.session_state import SessionState
 
 
 class Server:
     FRAME_PERIOD = 1000 // VideoStream.DEFAULT_FPS  # in milliseconds
     DEFAULT_CHUNK_SIZE = 4096
-
-    # for allowing simulated non-blocking operations
-    # (useful for keyboard break)
-    RTSP_SOFT_TIMEOUT = 100  # in milliseconds
+    # seconds a session lives without a request or an RTCP report, announced
+    # in SETUP (RFC 2326, 12.37)
+    DEFAULT_SESSION_TIMEOUT = 60
 
     # =================
     # RTCP variables
     # =================
-    RTCP_RCV_PORT = 19001  # port where the client will receive the RTP packets
-    RTCP_PERIOD = 400  # how often to check for control events
-    CONGESTION_PERIOD = 600
+    RTCP_RCV_PORT = RtpTransport.RTCP_RCV_PORT  # port where the server will receive the RTCP packets
 
-    class STATE:
-        INIT = 0
-        PAUSED = 1
-        PLAYING = 2
-        FINISHED = 3
-        TEARDOWN = 4
+    STATE = SessionState
 
     def __init__(
-        self, rtsp_ip: str, rtsp_port: int, sessionID: str, lost_probability: float = 0
+        self,
+        rtsp_ip: str,
+        rtsp_port: int,
+        sessionID: str,
+        lost_probability: float = 0,
+        transport: Union[None, RtpTransport] = None,
+        multicast: Union[None, "MulticastRegistry"] = None,
+        allocator: Union[None, BandwidthAllocator] = None,
+        session_timeout: int = DEFAULT_SESSION_TIMEOUT,
+        admission: Union[None, Callable[["Server", RTSPPacket], int]] = None,
+        codecs: Union[None, List[str]] = None,
+        encode_pool: Union[None, EncodePool] = None,
+        roi: bool = False,
+        clock: Clock = SYSTEM_CLOCK,
     ):
+        # session time: keep-alive, pacing and codec switches; the send
+        # thread still sleeps on the wall clock, only a Simulation, driving
+        # the session without it, runs on virtual time
+        self.clock = clock
         self._video_stream: Union[None, VideoStream] = None
+        # encoder processes of the SessionManager, frames are encoded by the
+        # read-ahead thread if None
+        self._encode_pool = encode_pool
+        # under congestion, smooth the background around the objects the
+        # detector finds rather than degrading the whole frame
+        self.roi = roi
         self._rtp_send_thread: Union[None, Thread] = None
         self._rtsp_connection: Union[None, socket.socket] = None
-        self._rtp_socket: Union[None, socket.socket] = None
+        # RTP/RTCP sockets shared with the other sessions of a SessionManager,
+        # a standalone server opens its own pair in `_setup_rtcp()`
+        self._transport: Union[None, RtpTransport] = transport
+        self._owns_transport = transport is None
+        self.ssrc: int = 0
+        self._datagram_sizer: Union[None, DatagramSizer] = None
         self._client_address: Tuple[str, int] = None
-        self.server_state: int = self.STATE.INIT
+        # RTP and RTCP channels when the client asked for media on the RTSP
+        # connection instead of UDP
+        self._interleaved: Union[None, Tuple[int, int]] = None
+        self._demuxer = InterleavedDemuxer()
+        self._rtsp_send_lock = Lock()
+        # groups of the SessionManager, joined when the client asks for
+        # multicast delivery
+        self._multicast = multicast
+        self._multicast_group: Union[None, "MulticastGroup"] = None
+        self._state = SessionState()
 
-        self._rtcp_rcv_thread: Union[None, Thread] = None
-        self._congestion_control_thread: Union[None, Thread] = None
-        self._rtcp_socket: Union[None, socket.socket] = None
         self._rtcp_receiver: Union[None, self.RtcpReceiver()] = None
         self._image_translator: Union[None, self.ImageTranslator()] = None
+        # sends only the tiles that changed, when the client asked for it
+        self._tile_encoder: Union[None, TileEncoder] = None
+        # payload codecs the server allows, by name, and those agreed on in
+        # SETUP in the client's order of preference, None when it asked for
+        # none: JPEG then
+        self.allowed_codecs: List[str] = [name.upper() for name in codecs or CODECS]
+        self.codecs: Union[None, List[Codec]] = None
         self._congestion_controller: Union[None, self.CongestionController()] = None
-        self.congestion_level: int = 0
+        self.congestion_level: int = 0  # from the RTCP reports
+        # level actually applied, raised further when the bandwidth share
+        # is below what the source needs
+        self.compression_level: int = 0
+
+        # share of the server-wide bandwidth budget, in bytes/s
+        self._allocator = allocator
+        self.weight: float = 1.0
+        self.rate_ceiling: Union[None, float] = None
+        # moving averages of the frame sizes, as read and as sent
+        self.source_frame_size: Union[None, float] = None
+        self.sent_frame_size: Union[None, float] = None
+        # seconds spent reading and encoding a frame, moving average
+        self.encode_time: Union[None, float] = None
+
+        # keep-alive: any request or RTCP report refreshes the session
+        self.session_timeout = session_timeout
+        self.last_activity = self.clock.monotonic()
+        # decides on the status answered to SETUP, admits everyone if None
+        self._admission = admission
+
+        # RTP sequence numbers follow the packets sent, not the frame
+        # numbers, which jump on seeks and in trick play
+        self._rtp_sequence_number = 0
 
         self.lost_probability = lost_probability
         self.send_delay = self.FRAME_PERIOD
@@ -66,23 +131,75 @@ class Server:
         self.rtsp_port = rtsp_port
         self.sessionID = sessionID
 
+    @property
+    def server_state(self) -> int:
+        return self._state.state
+
+    @property
+    def encode_load(self) -> float:
+        # fraction of a CPU the session keeps busy reading and encoding
+        if self.server_state != self.STATE.PLAYING or self.encode_time is None:
+            return 0.0
+        return self.encode_time * 1000 / self.send_delay
+
+    @property
+    def _tile_size(self) -> Union[None, int]:
+        return None if self._tile_encoder is None else self._tile_encoder.tile_size
+
+    def touch(self):
+        self.last_activity = self.clock.monotonic()
+
+    def is_expired(self) -> bool:
+        return self.clock.monotonic() - self.last_activity > self.session_timeout
+
+    @property
+    def demand(self) -> Union[None, float]:
+        # bytes/s the source needs at full quality and frame rate
+        if self.source_frame_size is None:
+            return None
+        return self.source_frame_size * 1000 / self.FRAME_PERIOD
+
+    @server_state.setter
+    def server_state(self, state: int):
+        # wakes up every worker waiting on the session state
+        if self._state.set(state) and self._multicast_group is not None:
+            self._multicast_group.update_state()
+
     def _rtsp_recv(self, size=DEFAULT_CHUNK_SIZE) -> bytes:
-        recv = None
-        while True:
-            try:
-                recv = self._rtsp_connection.recv(size)
-                break
-            except socket.timeout:
-                continue
+        recv = self._rtsp_connection.recv(size)
+        if not recv:
+            raise ConnectionError("client closed the RTSP connection")
         # print(f"Received from client: {repr(recv)}")
         return recv
 
     def _rtsp_send(self, data: bytes) -> int:
         # print(f"Sending to client: {repr(data)}")
-        return self._rtsp_connection.send(data)  # might be the number of bytes sent
+        with self._rtsp_send_lock:
+            self._rtsp_connection.sendall(data)
+        return len(data)
 
     def _get_rtsp_packet(self) -> RTSPPacket:
-        return RTSPPacket.from_request(self._rtsp_recv())
+        while True:
+            item = self._demuxer.next()
+            if item is None:
+                self._demuxer.feed(self._rtsp_recv())
+            elif isinstance(item, tuple):
+                self._handle_interleaved_frame(*item)
+            else:
+                packet = RTSPPacket.from_request(item)
+                self.touch()
+                return packet
+
+    def _handle_interleaved_frame(self, channel: int, data: bytes):
+        # RTCP reports of an interleaved session arrive between its requests
+        if self._interleaved is None or channel != self._interleaved[1]:
+            return
+        try:
+            rtcp_pkt = RTCPPacket.from_bitstream(data)
+        except InvalidRequest as e:
+            print(f"[RTCP] Dropping malformed packet: {e}")
+            return
+        self._rtcp_receiver.handle_packet(rtcp_pkt)
 
     def _wait_connection(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -92,25 +209,141 @@ class Server:
         s.listen(1)
         print("Waiting for connection...")
         self._rtsp_connection, self._client_address = s.accept()
-        self._rtsp_connection.settimeout(self.RTSP_SOFT_TIMEOUT / 1000.0)
         print(
             f"Accepted connection from {self._client_address[0]}:{self._client_address[1]}"
         )
 
+    def accept(self, connection: socket.socket, client_address: Tuple[str, int]):
+        # hand over a connection accepted by a SessionManager
+        self._rtsp_connection, self._client_address = connection, client_address
+
     def _wait_setup(self):
         if self.server_state != self.STATE.INIT:
             raise Exception("server is already setup")
         while True:
             packet = self._get_rtsp_packet()
+            if self._handle_stateless_request(packet):
+                continue
             if packet.request_type == RTSPPacket.SETUP:
+                self._admit(packet)
+                if not packet.multicast:
+                    # a group streams JPEG to all its members
+                    self._negotiate_codecs(packet)
                 self.server_state = self.STATE.PAUSED
                 print("State set to PAUSED")
-                self._client_address = self._client_address[0], packet.rtp_dst_port
-                self._setup_rtp(packet.video_file_path)
+                if packet.multicast:
+                    # the group has its own capture, drop one left by DESCRIBE
+                    self._close_source()
+                    self._join_multicast_group(packet.video_file_path, packet.blocksize)
+                    self._send_rtsp_response(packet.sequence_number, setup=True)
+                    break
+                if packet.interleaved is not None:
+                    self._interleaved = packet.interleaved
+                else:
+                    self._client_address = self._client_address[0], packet.rtp_dst_port
+                if packet.tile_size is not None:
+                    self._tile_encoder = TileEncoder(packet.tile_size)
                 self._setup_rtcp()
-                self._send_rtsp_response(packet.sequence_number)
+                self._setup_rtp(packet.video_file_path, packet.blocksize)
+                self._send_rtsp_response(packet.sequence_number, setup=True)
                 break
 
+    def _handle_stateless_request(self, packet: RTSPPacket) -> bool:
+        # OPTIONS, DESCRIBE and GET_PARAMETER are answered in any state
+        if packet.request_type == RTSPPacket.OPTIONS:
+            self._send_rtsp_response(packet.sequence_number, public=RTSPPacket.METHODS)
+        elif packet.request_type == RTSPPacket.DESCRIBE:
+            self._send_rtsp_response(
+                packet.sequence_number, sdp=self._describe(packet.video_file_path)
+            )
+        elif packet.request_type == RTSPPacket.GET_PARAMETER:
+            # a keep-alive: answering is all there is to do
+            self._send_rtsp_response(packet.sequence_number)
+        else:
+            return False
+        return True
+
+    def _describe(self, video_file_path: str) -> str:
+        # opening the source to describe it also warms it up for the SETUP
+        # that usually follows, a session already streaming keeps its own
+        if self.server_state == self.STATE.INIT:
+            video_stream = self._open_source(video_file_path)
+        elif self._video_stream is not None and self._video_stream.file_path == video_file_path:
+            video_stream = self._video_stream
+        else:
+            video_stream = VideoStream(video_file_path)
+        fps = 1000 / self.FRAME_PERIOD
+        default_codec = CODECS[DEFAULT_CODEC]
+        description = MediaDescription(
+            codec=default_codec.name,
+            payload_type=default_codec.payload_type,
+            # RTP timestamps are in milliseconds
+            clock_rate=1000,
+            width=video_stream.width,
+            height=video_stream.height,
+            fps=round(fps, 3),
+            duration=None if video_stream.index is None else video_stream.index.duration,
+            title=video_file_path,
+            formats={
+                codec.payload_type: codec.name
+                for codec in map(CODECS.get, self.allowed_codecs) if codec is not None
+            },
+        )
+        if video_stream is not self._video_stream:
+            video_stream.close()
+        return description.to_sdp(self.sessionID, self.rtsp_host)
+
+    def _open_source(self, video_file_path: str) -> VideoStream:
+        # opens the capture unless DESCRIBE already did, and encodes the
+        # first frame so that PLAY gets it out right away
+        if self._video_stream is not None and self._video_stream.file_path != video_file_path:
+            self._close_source()
+        if self._video_stream is None:
+            print(f"Opening up video stream for file {video_file_path}")
+            self._video_stream = VideoStream(video_file_path, encode_pool=self._encode_pool)
+        if self.codecs:
+            self._video_stream.set_codec(self.codecs[0])
+        if self.roi and self._video_stream.roi is None:
+            self._video_stream.set_roi(RoiFilter())
+        self._video_stream.prefetch()
+        return self._video_stream
+
+    def _close_source(self):
+        if self._video_stream is not None:
+            self._video_stream.close()
+            self._video_stream = None
+
+    def _admit(self, packet: RTSPPacket):
+        # answers a rejected SETUP with its status and ends the session
+        status_code = RTSPPacket.OK
+        if self._admission is not None:
+            status_code = self._admission(self, packet)
+        if status_code != RTSPPacket.OK:
+            self._send_rtsp_response(packet.sequence_number, status_code=status_code)
+            raise ConnectionError(
+                f"SETUP rejected: {status_code} {RTSPPacket.REASONS[status_code]}"
+            )
+
+    def _negotiate_codecs(self, packet: RTSPPacket):
+        # the codecs offered that this server allows; a SETUP offering none
+        # of them is answered 415 and ends the session
+        if packet.codecs is None:
+            return
+        codecs = negotiate(packet.codecs, self.allowed_codecs)
+        if not codecs:
+            self._send_rtsp_response(
+                packet.sequence_number, status_code=RTSPPacket.UNSUPPORTED_MEDIA_TYPE
+            )
+            raise ConnectionError(
+                f"SETUP rejected: none of the codecs {', '.join(packet.codecs)} is allowed"
+            )
+        self.codecs = codecs
+        print(f"Codecs agreed on: {', '.join(map(str, codecs))}")
+
+    @property
+    def _codec_offers(self) -> Union[None, List[str]]:
+        return None if self.codecs is None else [codec.offer() for codec in self.codecs]
+
     def setup(self):
         self._wait_connection()
         self._wait_setup()
@@ -122,41 +355,44 @@ class Server:
         )  # this thread will be killed when the main thread ended
         self._rtp_send_thread.start()
 
-    def _start_rtcp_rcv_thread(self):
-        self._rtcp_rcv_thread = Thread(
-            target=self._rtcp_receiver._receive_rtcp_packet, name="rtcp_rcv"
-        )
-        self._rtcp_rcv_thread.setDaemon(True)
-        self._rtcp_rcv_thread.start()
-
-    def _start_congestion_control_thread(self):
-        self._congestion_control_thread = Thread(
-            target=self._congestion_controller._congestion_control,
-            name="congestion_control",
-        )
-        self._congestion_control_thread.setDaemon(True)
-        self._congestion_control_thread.start()
-
-    def _setup_rtp(self, video_file_path: str):
-        print(f"Opening up video stream for file {video_file_path}")
-        self._video_stream = VideoStream(video_file_path)
-        print("Setting up RTP socket...")
-        self._rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def _setup_rtp(self, video_file_path: str, blocksize: Union[None, int] = None):
+        self._prepare_rtp(video_file_path, blocksize)
         self._start_rtp_send_thread()
 
+    def _prepare_rtp(self, video_file_path: str, blocksize: Union[None, int] = None):
+        # everything but the send thread, which a simulation replaces
+        self._open_source(video_file_path)
+        if self._interleaved is not None:
+            print(f"RTP interleaved on channels {self._interleaved[0]}-{self._interleaved[1]}")
+        else:
+            self._datagram_sizer = DatagramSizer(self._client_address, blocksize)
+            print(
+                f"RTP datagram size: {self._datagram_sizer.size} "
+                f"(requested {blocksize}, path MTU {self._datagram_sizer.path_mtu})"
+            )
+        if self._allocator is not None:
+            self._allocator.register(self)
+
     def _setup_rtcp(self):
-        print("[RTCP] Setting up RTCP socket...")
-        self._rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        address = self.rtsp_host, self.RTCP_RCV_PORT
-        self._rtcp_socket.bind(address)
-        print(f"[RTCP] UDP server is up and listening on {address[0]}:{address[1]}")
-
-        self._rtcp_receiver = self.RtcpReceiver(self, self.RTCP_PERIOD / 1000.0)
-        self._congestion_controller = self.CongestionController(
-            self, self.CONGESTION_PERIOD / 1000.0
-        )
-        self._image_translator = self.ImageTranslator(self, 80)
-        # print("[RTCP] Finish setting up")
+        if self._transport is None:
+            self._transport = RtpTransport(self.rtsp_host, self.RTCP_RCV_PORT)
+            self._transport.start()
+
+        self._rtcp_receiver = self.RtcpReceiver(self)
+        self._congestion_controller = self.CongestionController(self)
+        self._image_translator = self.ImageTranslator(self)
+        # reports only reach this session once it is registered
+        self.ssrc = self._transport.register(self)
+        print(f"[RTCP] Session {self.sessionID} uses SSRC {self.ssrc:08X}")
+
+    def _join_multicast_group(self, video_file_path: str, blocksize: Union[None, int]):
+        # the group streams and takes the RTCP reports, this session only
+        # relays the client's PLAY and PAUSE to it
+        if self._multicast is None:
+            raise Exception("multicast delivery is only available through a SessionManager")
+        self._multicast_group = self._multicast.join(self, video_file_path, blocksize)
+        destination = self._multicast_group.destination
+        print(f"Session {self.sessionID} joined multicast group {destination[0]}:{destination[1]}")
 
     def handle_rtsp_requests(self):
         print("Waiting for RTSP requests...")
@@ -165,198 +401,418 @@ class Server:
             packet = self._get_rtsp_packet()
             # assuming state will only ever be PAUSED or PLAYING at this point
             if packet.request_type == RTSPPacket.PLAY:
+                npt_range, scale = self._reposition(packet)
                 if self.server_state == self.STATE.PLAYING:
                     print("Current state is already PLAYING.")
-                    continue
-                self.server_state = self.STATE.PLAYING
-                self._start_rtcp_rcv_thread()
-                self._start_congestion_control_thread()
-                print("State set to PLAYING.")
+                else:
+                    self.server_state = self.STATE.PLAYING
+                    print("State set to PLAYING.")
+                self._send_rtsp_response(packet.sequence_number, npt_range=npt_range, scale=scale)
+                continue
             elif packet.request_type == RTSPPacket.PAUSE:
                 if self.server_state == self.STATE.PAUSED:
                     print("Current state is already PAUSED.")
-                    continue
-                self.server_state = self.STATE.PAUSED
-                print("State set to PAUSED.")
+                else:
+                    self.server_state = self.STATE.PAUSED
+                    print("State set to PAUSED.")
             elif packet.request_type == RTSPPacket.TEARDOWN:
                 print("Received TEARDOWN request, shutting down...")
                 self._send_rtsp_response(packet.sequence_number)
-                self._rtsp_connection.close()
-                self._video_stream.close()
-                self._rtp_socket.close()
-                self._rtcp_socket.close()
-                self.server_state = self.STATE.TEARDOWN
+                self.close()
                 # for simplicity's sake, caught on main_server
                 raise ConnectionError("teardown requested")
-            else:
-                # will never happen, since exception is raised inside `parse_rtsp_request()`
-                # raise InvalidRTSPRequest()
-                pass
+            elif self._handle_stateless_request(packet):
+                continue
             self._send_rtsp_response(packet.sequence_number)
 
-    def _send_rtp_packet(self, packet: bytes):
-
-        to_send = packet[:]
-        size = len(to_send)
-        count = math.ceil(size / (VideoStream.MAX_IMAGE_DGRAM))
-        array_pos_start = 0
-
-        while count:
+    def _reposition(self, packet: RTSPPacket) -> Tuple[Union[None, NptRange], Union[None, float]]:
+        # seeks to the Range of a PLAY and applies its Scale, returns the
+        # range and scale actually played; None when PLAY just resumes
+        video_stream = self._video_stream
+        if packet.npt_range is None and packet.scale is None:
+            return None, None
+        if self._multicast_group is not None or video_stream.is_live:
+            # a group plays one timeline for all its members
+            print("Range and Scale ignored, the source can't be seeked.")
+            return None, None
+        index = video_stream.index
+        scale = 1.0 if packet.scale is None else packet.scale
+        start, end = packet.npt_range or (None, None)
+        first = video_stream.resume_point if start is None else index.frame_at(start)
+        first = min(max(first, 0), len(index) - 1)
+        stop = None
+        if end is not None:
+            stop = index.frames_before(end) if scale > 0 else index.frame_at(end) - 1
+        scale = video_stream.seek(first, stop, scale)
+        print(f"Playing from frame #{first} at scale {scale:g}.")
+        return (index.timestamp(first), end), scale
+
+    def close(self):
+        if self.server_state != self.STATE.TEARDOWN:
+            self.server_state = self.STATE.TEARDOWN
+        if self._rtsp_connection is not None:
+            try:
+                # unblocks the RTSP thread when the session is reaped
+                self._rtsp_connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._rtsp_connection.close()
+        if self._multicast_group is not None:
+            group, self._multicast_group = self._multicast_group, None
+            self._multicast.leave(self, group)
+        if self._allocator is not None:
+            self._allocator.unregister(self)
+        if self._rtp_send_thread is not None and self._rtp_send_thread is not current_thread():
+            # let a frame still being read finish before the capture is
+            # released under it
+            self._rtp_send_thread.join()
+        if self._video_stream is not None:
+            self._video_stream.close()
+        if self._transport is not None:
+            self._transport.unregister(self.ssrc)
+            if self._owns_transport:
+                self._transport.close()
 
-            array_pos_end = min(size, array_pos_start + VideoStream.MAX_IMAGE_DGRAM)
+    def _send_rtp_packet(self, packet: bytes):
+        if self._interleaved is not None:
             try:
-                self._rtp_socket.sendto(
-                    struct.pack("B", count) + to_send[array_pos_start:array_pos_end],
-                    self._client_address,
+                send_interleaved(
+                    self._rtsp_connection,
+                    self._interleaved[0],
+                    fragment(packet, MAX_FRAME_DATA),
+                    self._rtsp_send_lock,
                 )
-                array_pos_start = array_pos_end
-                count -= 1
+            except OSError as e:
+                print(f"failed to send rtp packet: {e}")
+            return
+        for datagram in fragment(packet, self._datagram_sizer.size):
+            try:
+                self._transport.sendto(datagram, self._client_address)
             except socket.error as e:
                 print(f"failed to send rtp packet: {e}")
                 return
 
+    def _pace(self, deadline: float) -> float:
+        # sleep until `deadline` unless the session leaves PLAYING first,
+        # and return the deadline of the following frame
+        self._state.wait_while(self.STATE.PLAYING, max(0.0, deadline - self.clock.monotonic()))
+        return deadline + self.send_delay / 1000.0
+
     def _handle_video_send(self):
-        print(f"Sending video to {self._client_address[0]}:{self._client_address[1]}")
+        if self._interleaved is not None:
+            print(f"Sending video to {self._client_address[0]} over RTSP")
+        else:
+            print(f"Sending video to {self._client_address[0]}:{self._client_address[1]}")
+        deadline = self.clock.monotonic()
         while True:
-            if self.server_state == self.STATE.TEARDOWN:
+            # blocks without waking up while the session is paused or finished
+            state = self._state.wait_for(self.STATE.PLAYING, self.STATE.TEARDOWN)
+            if state == self.STATE.TEARDOWN:
                 return
-            if self.server_state != self.STATE.PLAYING:
-                sleep(0.5)  # diminish cpu hogging
-                continue
-            if (
-                self._video_stream.current_frame_number >= VideoStream.VIDEO_LENGTH - 1
-            ):  # frames are 0-indexed
-                print("Reached end of file.")
+            if self._is_end_of_stream():
+                if self._video_stream.error is not None:
+                    self._source_failed()
+                    return
+                print(f"Reached end of file ({self._video_stream.stalls} read-ahead stalls).")
                 self.server_state = self.STATE.FINISHED
-                return
-            frame = self._video_stream.get_next_frame()
-            if random() < self.lost_probability:
-                print(f"[RTP] Packet lost")
-                sleep(self.send_delay / 1000.0)
                 continue
-            if self.congestion_level > 0:
-                print(f"[RTCP] Congestion control: {self.congestion_level}")
-                self._image_translator.set_compression_quality(
-                    int(100 - self.congestion_level * 20)
-                )
-                frame = self._image_translator.compress(frame)
-            frame_number = self._video_stream.current_frame_number
-            rtp_packet = RTPPacket(
-                payload_type=RTPPacket.TYPE.MJPEG,
-                sequence_number=frame_number,
-                timestamp=frame_number * self.FRAME_PERIOD,
-                payload=frame,
+            if deadline < self.clock.monotonic() - self.send_delay / 1000.0:
+                # resuming after a pause, don't burst to catch up
+                deadline = self.clock.monotonic()
+            packet = self._next_rtp_packet()
+            if packet is not None:
+                self._send_rtp_packet(packet)
+            deadline = self._pace(deadline)
+
+    def _source_failed(self):
+        # the read-ahead died on an error, nothing more can be played
+        print(f"Session {self.sessionID} closed: its source failed ({self._video_stream.error})")
+        self.close()
+
+    def _is_end_of_stream(self) -> bool:
+        # may wait for the read-ahead to catch up
+        return self._video_stream.at_end()
+
+    def _next_rtp_packet(self) -> Union[None, bytes]:
+        # reads and encodes the next frame, returns None when the simulated
+        # loss drops it
+        frame = self._video_stream.get_next_frame()
+        # CPU time, on the wall clock whatever the session's clock
+        start = monotonic()
+        codec = self._video_stream.current_codec
+        # a dropped packet leaves its gap in the sequence
+        sequence_number = self._rtp_sequence_number
+        self._rtp_sequence_number = (sequence_number + 1) & 0xFFFF
+        rendition = self._video_stream.current_rendition
+        if rendition == VideoStream.FULL_RENDITION and not self._video_stream.current_roi_level:
+            # what the source needs, measured on frames nothing was taken from
+            self.source_frame_size = _moving_average(self.source_frame_size, len(frame))
+        if random() < self.lost_probability:
+            print(f"[RTP] Packet lost")
+            return None
+        payload_type = codec.payload_type
+        extensions = None
+        if self._tile_encoder is not None:
+            quality = codec.quality_for_level(
+                self.compression_level, self.CongestionController.MAX_LEVEL
+            )
+            frame = self._tile_encoder.encode(frame, codec, quality)
+            payload_type = RTPPacket.TYPE.JPEG_TILES
+        elif rendition[0] > 1:
+            # downscaled by the read-ahead, see ImageTranslator
+            frame_size = struct.pack("!HH", self._video_stream.width, self._video_stream.height)
+            extensions = {RTPPacket.EXTENSION_FRAME_SIZE: frame_size}
+        self.sent_frame_size = _moving_average(self.sent_frame_size, len(frame))
+        # the frame was read and encoded ahead, by the read-ahead thread
+        encode_time = (self._video_stream.encode_time or 0.0) + monotonic() - start
+        self.encode_time = _moving_average(self.encode_time, encode_time)
+        if self._allocator is not None:
+            self._allocator.refresh()
+            self._congestion_controller.update()
+        frame_number = self._video_stream.current_frame_number
+        index = self._video_stream.index
+        if index is not None:
+            # media time of the frame, in milliseconds
+            timestamp = round(index.timestamp(frame_number) * 1000)
+        else:
+            timestamp = frame_number * self.FRAME_PERIOD
+        rtp_packet = RTPPacket(
+            payload_type=payload_type,
+            sequence_number=sequence_number,
+            timestamp=timestamp,
+            payload=frame,
+            ssrc=self.ssrc,
+            extensions=extensions,
+        )
+        print(f"Sending packet #{frame_number}")
+        print("Packet header:")
+        # rtp_packet.print_header()
+        return rtp_packet.get_packet()
+
+    def _send_rtsp_response(
+        self,
+        sequence_number: int,
+        setup: bool = False,
+        status_code: int = RTSPPacket.OK,
+        public: Union[None, list] = None,
+        sdp: Union[None, str] = None,
+        npt_range: Union[None, NptRange] = None,
+        scale: Union[None, float] = None,
+    ):
+        if status_code != RTSPPacket.OK:
+            response = RTSPPacket.build_response(
+                sequence_number, self.sessionID, status_code=status_code
+            )
+        elif setup and self._multicast_group is not None:
+            group = self._multicast_group
+            response = RTSPPacket.build_response(
+                sequence_number,
+                self.sessionID,
+                blocksize=group._datagram_sizer.negotiated,
+                ssrc=group.ssrc,
+                destination=group.destination,
+                ttl=group.ttl,
+                timeout=self.session_timeout,
+                layers=group.simulcast,
+            )
+        elif setup and self._interleaved is not None:
+            response = RTSPPacket.build_response(
+                sequence_number,
+                self.sessionID,
+                ssrc=self.ssrc,
+                interleaved=self._interleaved,
+                timeout=self.session_timeout,
+                tile_size=self._tile_size,
+                codecs=self._codec_offers,
             )
-            print(f"Sending packet #{frame_number}")
-            print("Packet header:")
-            # rtp_packet.print_header()
-            packet = rtp_packet.get_packet()
-            self._send_rtp_packet(packet)
-            sleep(self.send_delay / 1000.0)
-
-    def _send_rtsp_response(self, sequence_number: int):
-        response = RTSPPacket.build_response(sequence_number, self.sessionID)
+        elif setup:
+            response = RTSPPacket.build_response(
+                sequence_number,
+                self.sessionID,
+                blocksize=self._datagram_sizer.negotiated,
+                client_port=self._client_address[1],
+                server_port=self._transport.rtcp_port,
+                ssrc=self.ssrc,
+                timeout=self.session_timeout,
+                tile_size=self._tile_size,
+                codecs=self._codec_offers,
+            )
+        elif sdp is not None:
+            response = RTSPPacket.build_response(
+                sequence_number,
+                self.sessionID,
+                content_type=MediaDescription.CONTENT_TYPE,
+                body=sdp,
+            )
+        elif npt_range is not None or scale is not None:
+            response = RTSPPacket.build_response(
+                sequence_number, self.sessionID, npt_range=npt_range, scale=scale
+            )
+        else:
+            response = RTSPPacket.build_response(sequence_number, self.sessionID, public=public)
         self._rtsp_send(response.encode())
         print("Sent response to client.")
 
     # ===========================
-    # Controls RTP sending rate based on traffic
+    # Controls RTP sending rate based on traffic, within the session's share
+    # of the bandwidth budget, and picks among the codecs agreed on: the
+    # cheapest when encoding can't keep up, the most compact the CPU allows
+    # when bandwidth is short
     # ===========================
     class CongestionController:
-        def __init__(self, server, interval) -> None:
+        MAX_LEVEL = 4
+        # encoding is the bottleneck past this share of the frame period
+        CPU_BOUND_SHARE = 0.5
+        CODEC_SWITCH_INTERVAL = 5.0  # seconds at least between two switches
+
+        def __init__(self, server) -> None:
             # pass in the server instance
             self.server: Union[None, Server] = server
-
-            # set timer with interval for congestion control
-            self.interval = interval
             self.prelevel = -1
+            # measurements of the first codec come in before any switch
+            self._codec_switched = server.clock.monotonic()
             print("[RTCP] Congestion controller instance is created")
 
-        def _congestion_control(self):
-            # adjust the send rate
-            while True:
-                if self.server.server_state == self.server.STATE.TEARDOWN:
-                    return
-                if self.server.server_state != self.server.STATE.PLAYING:
-                    sleep(self.interval)  # diminish cpu hogging
-                    continue
-                if self.prelevel != self.server.congestion_level:
-                    self.server.send_delay = (
-                        self.server.FRAME_PERIOD
-                        + self.server.congestion_level * self.server.FRAME_PERIOD * 0.1
-                    )
-                    self.prelevel = self.server.congestion_level
-                    print(f"Send delay changed to: {self.server.send_delay}")
-                sleep(self.interval)
+        def _budget_level(self) -> int:
+            # one level per 20% of the demand the share falls short of
+            ceiling, demand = self.server.rate_ceiling, self.server.demand
+            if ceiling is None or demand is None or ceiling >= demand:
+                return 0
+            return min(self.MAX_LEVEL, math.ceil((1 - ceiling / demand) * 5))
+
+        def update(self):
+            # adjust the send rate, called whenever a report has been processed
+            # and, under a bandwidth budget, for every frame
+            server = self.server
+            level = max(server.congestion_level, self._budget_level())
+            server.compression_level = level
+            send_delay = server.FRAME_PERIOD + level * server.FRAME_PERIOD * 0.1
+            if server.rate_ceiling and server.sent_frame_size:
+                # whatever the level, never go past the share
+                send_delay = max(
+                    send_delay, 1000 * server.sent_frame_size / server.rate_ceiling
+                )
+            server.send_delay = send_delay
+            if self.prelevel != level:
+                self.prelevel = level
+                print(f"Send delay changed to: {server.send_delay}")
+                if server._tile_encoder is None and server._video_stream is not None:
+                    # tiles keep the full size, their quality follows the level
+                    server._image_translator.translate(level)
+            if server.codecs and len(server.codecs) > 1 and server._video_stream is not None:
+                self._update_codec()
+
+        def _update_codec(self):
+            if self.server.clock.monotonic() - self._codec_switched < self.CODEC_SWITCH_INTERVAL:
+                return
+            stream = self.server._video_stream
+            codec = self._choose_codec()
+            if codec != stream.codec:
+                print(f"[RTCP] Codec switched from {stream.codec} to {codec}")
+                stream.set_codec(codec)
+                self._codec_switched = self.server.clock.monotonic()
+
+        def _choose_codec(self) -> Codec:
+            server = self.server
+            stream = server._video_stream
+            budget = self.CPU_BOUND_SHARE * server.send_delay / 1000
+            if server.encode_time is not None and server.encode_time > budget:
+                # CPU-bound: fewer bytes are no use if frames come out late
+                return min(server.codecs, key=lambda codec: codec.encode_cost)
+
+            def affordable(codec: Codec) -> bool:
+                # measured for the codec in use, estimated for the others
+                if codec == stream.codec and server.encode_time is not None:
+                    return True
+                return codec.estimate(stream.width, stream.height) <= budget
+
+            codecs = [codec for codec in server.codecs if affordable(codec)]
+            if not codecs:
+                return stream.codec
+            if server.compression_level > 0:
+                # bandwidth-bound with CPU to spare
+                return min(codecs, key=lambda codec: codec.size_ratio)
+            # neither: the client's preference
+            return codecs[0]
 
     # ===========================
-    # Listener for RTCP packets sent from client
+    # Handler for the RTCP packets the shared transport routes to this session
     # ===========================
     class RtcpReceiver:
-        BUFFERSIZE = 512
-
-        def __init__(self, server, interval) -> None:
+        def __init__(self, server) -> None:
             # pass in the server instance
             self.server: Union[None, Server] = server
-
-            # set timer with interval for receiving packets
-            self.interval = interval
             print("[RTCP] RTCP receiver instance is created")
 
-        def _receive_rtcp_packet(self):
-            while True:
-                if self.server.server_state == self.server.STATE.TEARDOWN:
-                    return
-                if self.server.server_state != self.server.STATE.PLAYING:
-                    sleep(self.interval)  # diminish cpu hogging
-                    continue
-                try:
-                    datagram = self.server._rtcp_socket.recvfrom(self.BUFFERSIZE)[0]
-                    rtcp_pkt = RTCPPacket.from_bitstream(datagram)
-                    # print(
-                    #     f"[RTCP] Receive pkt: {rtcp_pkt.fraction_lost, rtcp_pkt.cum_lost, rtcp_pkt.highest_rcv}"
-                    # )
-                    fraction_lost = rtcp_pkt.fraction_lost
-                    if fraction_lost >= 0 and fraction_lost <= 0.01:
-                        self.server.congestion_level = 0
-                    elif fraction_lost > 0.01 and fraction_lost <= 0.25:
-                        self.server.congestion_level = 1
-                    elif fraction_lost > 0.25 and fraction_lost <= 0.5:
-                        self.server.congestion_level = 2
-                    elif fraction_lost > 0.5 and fraction_lost <= 0.75:
-                        self.server.congestion_level = 3
-                    else:
-                        self.server.congestion_level = 4
-                except socket.error as e:
-                    print("[RTCP] Error receiving data %s" % e)
-                sleep(self.interval)
+        def handle_packet(self, rtcp_pkt: RTCPPacket):
+            # reports prove the client is still there
+            self.server.touch()
+            # print(
+            #     f"[RTCP] Receive pkt: {rtcp_pkt.fraction_lost, rtcp_pkt.cum_lost, rtcp_pkt.highest_rcv}"
+            # )
+            self.on_fraction_lost(rtcp_pkt.fraction_lost)
+            if rtcp_pkt.fraction_lost > 0 and self.server._tile_encoder is not None:
+                # lost tiles stay wrong on the client until a full frame
+                self.server._tile_encoder.refresh()
+
+        def on_fraction_lost(self, fraction_lost: float):
+            if self.server.server_state != self.server.STATE.PLAYING:
+                return
+            if fraction_lost <= 0.01:
+                self.server.congestion_level = 0
+            elif fraction_lost > 0.01 and fraction_lost <= 0.25:
+                self.server.congestion_level = 1
+            elif fraction_lost > 0.25 and fraction_lost <= 0.5:
+                self.server.congestion_level = 2
+            elif fraction_lost > 0.5 and fraction_lost <= 0.75:
+                self.server.congestion_level = 3
+            else:
+                self.server.congestion_level = 4
+            self.server._congestion_controller.update()
+            if self.server._datagram_sizer is not None:
+                self.server._datagram_sizer.on_report(fraction_lost)
 
     # ===========================
-    # Translate an image to different encoding or quality
+    # Translate an image to a lower resolution or quality: the rendition the
+    # read-ahead encodes frames at, by congestion level, or with regions of
+    # interest, how much their background is smoothed
     # ===========================
     class ImageTranslator:
-        def __init__(self, server, cp) -> None:
+        # (downscale, share of the codec's quality range) by congestion level;
+        # each resolution has a range of its own, from the top down: for the
+        # same bytes, half the size at a high quality looks much better than
+        # the full size at a low one (benchmarks/resolution_ladder.py)
+        LADDER = (
+            VideoStream.FULL_RENDITION,
+            (1, 0.5),
+            (2, 1.0),
+            (2, 0.4),
+            (4, 0.8),
+        )
+
+        def __init__(self, server) -> None:
             # pass in the server instance
             self.server: Union[None, Server] = server
-
-            # assign video quality
-            self.compression_quailty = cp
             print("[RTCP] Image translator instance is created")
 
-        def compress(self, image_byte):
+        def rendition(self, level: int) -> Tuple[int, Union[None, float]]:
+            return self.LADDER[min(max(level, 0), len(self.LADDER) - 1)]
+
+        def translate(self, level: int):
+            # what the read-ahead encodes the next frames at
+            stream = self.server._video_stream
+            if stream.roi is not None:
+                # the objects keep their size and quality, only the
+                # background gives way
+                stream.set_roi_level(level)
+                print(f"[RTCP] Congestion level {level}: background at 1/{2 ** level} of the resolution")
+                return
+            rendition = self.rendition(level)
+            stream.set_rendition(*rendition)
+            print(f"[RTCP] Congestion level {level}: 1/{rendition[0]} of the frame size")
 
-            img = cv2.imdecode(np.frombuffer(image_byte, dtype=np.uint8), 1)
-            image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-            image.save(
-                "output.jpeg",
-                format="JPEG",
-                optiimize=True,
-                quality=self.compression_quality,
-            )
-            with open("output.jpeg", "rb") as image:
-                f = image.read()
-            os.remove("output.jpeg")
-            return f
 
-        def set_compression_quality(self, cp):
-            self.compression_quality = cp
+def _moving_average(average: Union[None, float], sample: int, weight: float = 1 / 8) -> float:
+    if average is None:
+        return float(sample)
+    return average + (sample - average) * weight
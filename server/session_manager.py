@@ -0,0 +1,178 @@
+import socket
+from threading import Event, RLock, Thread, current_thread
+from typing import Dict, List, Sequence, Tuple, Union
+
+from server.admission import AdmissionControl
+from server.bandwidth import BandwidthAllocator
+from server.multicast import MulticastRegistry
+from server.server import Server
+from server.transport import RtpTransport
+from utils.encode_pool import EncodePool
+
+
+# ===========================
+# Accepts RTSP connections and runs one Server session per client, all of
+# them sending and receiving through the same RtpTransport, or through a
+# multicast group shared with the sessions watching the same source
+# ===========================
+class SessionManager:
+    REAP_PERIOD = 5  # seconds between two looks for expired sessions
+    CLOSE_TIMEOUT = 5  # seconds close() waits for each session thread
+
+    def __init__(
+        self,
+        rtsp_ip: str,
+        rtsp_port: int,
+        session_prefix: str,
+        lost_probability: float = 0,
+        rtcp_port: int = RtpTransport.RTCP_RCV_PORT,
+        bandwidth: Union[None, float] = None,
+        priorities: Union[None, Dict[str, float]] = None,
+        max_sessions: Union[None, int] = None,
+        session_timeout: int = Server.DEFAULT_SESSION_TIMEOUT,
+        codecs: Union[None, List[str]] = None,
+        simulcast: Sequence[int] = (),
+        encode_processes: Union[None, int] = None,
+        roi: bool = False,
+    ):
+        self.rtsp_host = rtsp_ip
+        self.rtsp_port = rtsp_port
+        self.session_prefix = session_prefix
+        self.lost_probability = lost_probability
+        # client host -> weight of its sessions in the bandwidth split
+        self.priorities = priorities or {}
+        # payload codecs sessions may agree on, all of them if None
+        self.codecs = codecs
+        # sessions degrade the background around detected objects first
+        self.roi = roi
+
+        # egress budget in bytes/s shared by all sessions, unlimited if None
+        self.allocator = BandwidthAllocator(bandwidth) if bandwidth else None
+        self.transport = RtpTransport(rtsp_ip, rtcp_port)
+        # frames are encoded by that many processes, shared by all sessions,
+        # instead of the read-ahead threads
+        self.encode_pool = EncodePool(encode_processes) if encode_processes else None
+        # multicast groups also send their stream downscaled by `simulcast`
+        self.multicast = MulticastRegistry(
+            rtsp_ip,
+            lost_probability,
+            allocator=self.allocator,
+            layers=simulcast,
+            encode_pool=self.encode_pool,
+        )
+        self._listen_socket: socket.socket = None
+        self._sessions: Dict[str, Server] = {}
+        # RTSP thread of each session, until it is done cleaning up
+        self._threads: Dict[str, Thread] = {}
+        # reentrant: admission decides under it and lists the sessions
+        self._lock = RLock()
+        self._session_count = 0
+        self.session_timeout = session_timeout
+        self.admission = AdmissionControl(
+            self._list_sessions,
+            self.multicast,
+            self.allocator,
+            max_sessions,
+            self.encode_pool.processes if self.encode_pool else None,
+            lock=self._lock,
+        )
+        self._closed = Event()
+
+    def _list_sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def _new_session_id(self) -> str:
+        with self._lock:
+            self._session_count += 1
+            return f"{self.session_prefix}-{self._session_count}"
+
+    def serve_forever(self):
+        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        address = self.rtsp_host, self.rtsp_port
+        self._listen_socket.bind(address)
+        self._listen_socket.listen()
+        print(f"Listening on {address[0]}:{address[1]}...")
+        self.transport.start()
+        reaper = Thread(target=self._reap_sessions, name="reaper")
+        reaper.setDaemon(True)
+        reaper.start()
+        try:
+            while True:
+                connection, client_address = self._listen_socket.accept()
+                self._start_session(connection, client_address)
+        finally:
+            self.close()
+
+    def _start_session(self, connection: socket.socket, client_address: Tuple[str, int]):
+        session = Server(
+            self.rtsp_host,
+            self.rtsp_port,
+            self._new_session_id(),
+            self.lost_probability,
+            transport=self.transport,
+            multicast=self.multicast,
+            allocator=self.allocator,
+            session_timeout=self.session_timeout,
+            admission=self.admission,
+            codecs=self.codecs,
+            encode_pool=self.encode_pool,
+            roi=self.roi,
+        )
+        session.weight = self.priorities.get(client_address[0], 1.0)
+        session.accept(connection, client_address)
+        print(
+            f"Accepted connection from {client_address[0]}:{client_address[1]}, "
+            f"session {session.sessionID}"
+        )
+        thread = Thread(
+            target=self._run_session, args=(session,), name=f"rtsp_{session.sessionID}"
+        )
+        thread.setDaemon(True)
+        with self._lock:
+            self._sessions[session.sessionID] = session
+            self._threads[session.sessionID] = thread
+        thread.start()
+
+    def _run_session(self, session: Server):
+        try:
+            session._wait_setup()
+            session.handle_rtsp_requests()
+        except ConnectionError as e:
+            print(f"Session {session.sessionID} closed: {e}")
+        except Exception as e:
+            print(f"Session {session.sessionID} failed: {e}")
+        finally:
+            session.close()
+            self.admission.release(session)
+            with self._lock:
+                self._sessions.pop(session.sessionID, None)
+                self._threads.pop(session.sessionID, None)
+
+    def _reap_sessions(self):
+        # sessions whose client went silent without a TEARDOWN; closing them
+        # ends their RTSP thread, which does the rest of the cleanup
+        while not self._closed.wait(min(self.REAP_PERIOD, self.session_timeout / 2)):
+            for session in self._list_sessions():
+                if session.is_expired():
+                    print(f"Session {session.sessionID} timed out")
+                    session.close()
+
+    def close(self):
+        self._closed.set()
+        for session in self._list_sessions():
+            session.close()
+        if self._listen_socket is not None:
+            self._listen_socket.close()
+        # the session threads release their captures on the way out, which
+        # must not happen under the interpreter shutting down
+        with self._lock:
+            threads = list(self._threads.values())
+        for thread in threads:
+            if thread is not current_thread():
+                thread.join(self.CLOSE_TIMEOUT)
+        self.multicast.close()
+        self.transport.close()
+        if self.encode_pool is not None:
+            self.encode_pool.close()
@@ -0,0 +1,100 @@
+import socket
+from threading import Lock, Thread
+from typing import Dict, Tuple, Union
+
+from utils.rtcp_packet import RTCPPacket, InvalidRequest
+from utils.datagram import SOCKET_BUFFER_SIZE, set_socket_buffers
+
+
+# ===========================
+# Server-wide RTP/RTCP socket pair shared by every session
+# ===========================
+class RtpTransport:
+    RTCP_RCV_PORT = 19001  # port where the server will receive the RTCP packets
+    BUFFERSIZE = 512
+
+    def __init__(self, host: str, rtcp_port: int = RTCP_RCV_PORT) -> None:
+        self.host = host
+        self.rtcp_port = rtcp_port
+
+        self._rtp_socket = self._open_rtp_socket()
+        set_socket_buffers(self._rtp_socket, sndbuf=SOCKET_BUFFER_SIZE)
+
+        print("[RTCP] Setting up RTCP socket...")
+        self._rtcp_socket = self._open_rtcp_socket()
+        print(f"[RTCP] UDP server is up and listening on {host}:{rtcp_port}")
+
+        # SSRC -> session receiving the reports about its RTP stream
+        self._sessions: Dict[int, "Server"] = {}
+        self._lock = Lock()
+        self._rtcp_rcv_thread: Union[None, Thread] = None
+        self._closed = False
+
+    def _open_rtp_socket(self) -> socket.socket:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _open_rtcp_socket(self) -> socket.socket:
+        rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtcp_socket.bind((self.host, self.rtcp_port))
+        return rtcp_socket
+
+    def _wake_rtcp_receiver(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(b"", (self.host, self.rtcp_port))
+
+    def start(self):
+        self._rtcp_rcv_thread = Thread(
+            target=self._receive_rtcp_packets, name="rtcp_rcv"
+        )
+        self._rtcp_rcv_thread.setDaemon(True)
+        self._rtcp_rcv_thread.start()
+
+    def register(self, session) -> int:
+        with self._lock:
+            ssrc = RTCPPacket.new_ssrc()
+            while ssrc in self._sessions:
+                ssrc = RTCPPacket.new_ssrc()
+            self._sessions[ssrc] = session
+        return ssrc
+
+    def unregister(self, ssrc: int):
+        with self._lock:
+            self._sessions.pop(ssrc, None)
+
+    def sendto(self, datagram: bytes, address: Tuple[str, int]) -> int:
+        return self._rtp_socket.sendto(datagram, address)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._rtp_socket.close()
+        if self._rtcp_rcv_thread is None:
+            self._rtcp_socket.close()
+            return
+        # closing the socket would not interrupt a blocked recvfrom(), an
+        # empty datagram does, and the thread closes the socket on its way out
+        self._wake_rtcp_receiver()
+
+    def _receive_rtcp_packets(self):
+        while True:
+            try:
+                datagram = self._rtcp_socket.recvfrom(self.BUFFERSIZE)[0]
+                if self._closed:
+                    self._rtcp_socket.close()
+                    return
+                if not datagram:
+                    continue
+                rtcp_pkt = RTCPPacket.from_bitstream(datagram)
+            except InvalidRequest as e:
+                print(f"[RTCP] Dropping malformed packet: {e}")
+                continue
+            except socket.error as e:
+                print("[RTCP] Error receiving data %s" % e)
+                continue
+            with self._lock:
+                session = self._sessions.get(rtcp_pkt.source_ssrc)
+            if session is None:
+                print(f"[RTCP] Report for unknown SSRC {rtcp_pkt.source_ssrc:08X}")
+                continue
+            session._rtcp_receiver.handle_packet(rtcp_pkt)
@@ -0,0 +1,89 @@
+"""
+Where the server and the client read the time from. Both take the system
+clock unless handed another one: a `VirtualClock` is simulated time that
+only moves forward as the events scheduled on it run, so that a session of
+hours plays out in seconds and the same way every time (see
+utils/simulation.py).
+
+Only a `Simulation` runs on virtual time: it drives the session through
+events on the clock, without the send and RTCP threads. Those threads read
+their deadlines from the clock but sleep towards them on the wall clock, so
+a threaded session handed a `VirtualClock` does not run on it.
+
+CPU time, such as how long a frame took to encode, is measured on the wall
+clock whatever the clock: the work is done for real.
+"""
+import heapq
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+class Clock:
+    # the system clock
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def time(self) -> float:
+        return time.time()
+
+
+SYSTEM_CLOCK = Clock()
+
+
+class EventQueue:
+    # items by the time they are due, those due at the same time in the
+    # order they were pushed
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, object]] = []
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, at: float, item: object):
+        heapq.heappush(self._heap, (at, self._count, item))
+        self._count += 1
+
+    def next_time(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> Sequence[object]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+
+class VirtualClock(Clock):
+    def __init__(self, start: float = 0.0, epoch: float = 1.6e9) -> None:
+        self.now = start
+        self.epoch = epoch  # wall-clock time at 0
+        self._events = EventQueue()
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.epoch + self.now
+
+    def call_at(self, when: float, callback: Callable, *args):
+        self._events.push(max(when, self.now), (callback, args))
+
+    def call_later(self, delay: float, callback: Callable, *args):
+        self.call_at(self.now + delay, callback, *args)
+
+    def run(self, until: Optional[float] = None) -> int:
+        # runs the events in time order, jumping from one to the next, until
+        # none is left or the next is past `until`; returns how many ran
+        ran = 0
+        while True:
+            when = self._events.next_time()
+            if when is None or (until is not None and when > until):
+                break
+            self.now = when
+            for callback, args in self._events.pop_due(when):
+                callback(*args)
+                ran += 1
+        if until is not None:
+            self.now = max(self.now, until)
+        return ran
@@ -0,0 +1,216 @@
+"""
+Payload codecs: how a frame is compressed in the RTP payload. Each has its
+RTP payload type and SDP encoding name, a quality knob, and rough costs so
+that a server can trade CPU for bandwidth:
+
+    codec   payload type   encode, decode (ms per megapixel)   bytes   lossless
+    JPEG    26             5, 7                                 1       no
+    WEBP    97             115, 13                              0.6     no
+    PNG     98             85, 40                               8       yes
+
+Costs were measured with cv2 on 640x480 camera-like frames at the default
+quality; bytes are relative to JPEG and vary a lot with the content.
+
+The client lists the codecs it accepts in SETUP, in order of preference,
+each with its parameters:
+
+    X-Codecs: WEBP;quality=70, JPEG
+
+and the server answers with the ones it agreed to, streaming the first.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+from utils.rtp_packet import RTPPacket
+from utils.rtsp_parser import transport_params
+
+
+class Codec:
+    name = ""
+    payload_type = 0
+    extension = ""
+    lossless = False
+    min_quality = max_quality = default_quality = 100
+    # estimates, see the table above
+    encode_cost = 0.0  # ms per megapixel
+    decode_cost = 0.0
+    size_ratio = 1.0
+
+    def __init__(self, quality: Optional[int] = None) -> None:
+        self.quality = self.default_quality if quality is None else self.clamp_quality(quality)
+
+    def __str__(self):
+        return self.offer()
+
+    def __eq__(self, other):
+        return isinstance(other, Codec) and self.offer() == other.offer()
+
+    def __hash__(self):
+        return hash(self.offer())
+
+    def clamp_quality(self, quality: int) -> int:
+        return min(max(int(quality), self.min_quality), self.max_quality)
+
+    def offer(self) -> str:
+        # as listed in X-Codecs
+        if self.lossless:
+            return self.name
+        return f"{self.name};quality={self.quality}"
+
+    def configure(self, params: Dict[str, Optional[str]]) -> "Codec":
+        # a codec of the same kind with the parameters of an offer
+        quality = params.get("quality")
+        return type(self)(None if quality is None else int(quality))
+
+    def quality_at(self, share: float) -> Optional[int]:
+        # the quality at `share` of the way from the lowest quality up to the
+        # codec's own, None for a lossless codec
+        if self.lossless:
+            return None
+        span = self.quality - self.min_quality
+        return self.clamp_quality(round(self.min_quality + span * share))
+
+    def quality_for_level(self, level: int, max_level: int) -> Optional[int]:
+        # quality at a congestion level, None for the codec's own quality;
+        # the range is spread evenly over the levels
+        if level <= 0:
+            return None
+        return self.quality_at(1 - level / max_level)
+
+    def estimate(self, width: int, height: int) -> float:
+        # seconds to encode a frame
+        return self.encode_cost * width * height / 1e9
+
+    def _params(self, quality: int) -> List[int]:
+        return []
+
+    def encode(self, image: np.ndarray, quality: Optional[int] = None) -> bytes:
+        params = self._params(self.quality if quality is None else quality)
+        return cv2.imencode(self.extension, image, params)[1].tobytes()
+
+    def decode(self, data: bytes, reduction: int = 1) -> Optional[np.ndarray]:
+        # BGR, None when the data is not an image; codecs able to decode at
+        # 1/`reduction` of the size do, the others ignore it
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+# (downscale, quality share): the frame divided in size by downscale, encoded
+# at that share of the codec's quality range, None for the codec's own quality
+Rendition = Tuple[int, Optional[float]]
+
+
+def render(image: np.ndarray, codec: Codec, rendition: Rendition) -> bytes:
+    downscale, quality_share = rendition
+    if downscale > 1:
+        height, width = image.shape[:2]
+        size = max(1, width // downscale), max(1, height // downscale)
+        # area averaging: no aliasing, unlike nearest or linear
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    quality = None if quality_share is None else codec.quality_at(quality_share)
+    return codec.encode(image, quality)
+
+
+def encode_renditions(
+    source: Union[np.ndarray, bytes], codec: Codec, renditions: Sequence[Rendition]
+) -> List[bytes]:
+    # `source` is a BGR image or a JPEG image, decoded once for them all
+    if isinstance(source, bytes):
+        source = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return [render(source, codec, rendition) for rendition in renditions]
+
+
+class JpegCodec(Codec):
+    name = "JPEG"
+    payload_type = RTPPacket.TYPE.MJPEG
+    extension = ".jpg"
+    min_quality, max_quality, default_quality = 20, 100, 80
+    encode_cost, decode_cost = 5.0, 7.0
+    # libjpeg scales while decoding, skipping most of the IDCT work
+    REDUCED = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+    def decode(self, data: bytes, reduction: int = 1) -> Optional[np.ndarray]:
+        flags = self.REDUCED.get(reduction, cv2.IMREAD_COLOR)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+    def _params(self, quality: int) -> List[int]:
+        return [
+            cv2.IMWRITE_JPEG_QUALITY, quality,
+            # Huffman tables fitted to the frame: 10 to 45% smaller for a
+            # fraction of a millisecond
+            cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+            # baseline 4:2:0, what every decoder takes fastest
+            cv2.IMWRITE_JPEG_PROGRESSIVE, 0,
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+        ]
+
+
+class WebpCodec(Codec):
+    name = "WEBP"
+    payload_type = RTPPacket.TYPE.WEBP
+    extension = ".webp"
+    min_quality, max_quality, default_quality = 10, 100, 80
+    encode_cost, decode_cost = 115.0, 13.0
+    size_ratio = 0.6
+
+    def _params(self, quality: int) -> List[int]:
+        # 100 would switch libwebp to lossless
+        return [cv2.IMWRITE_WEBP_QUALITY, min(quality, 99)]
+
+
+class PngCodec(Codec):
+    name = "PNG"
+    payload_type = RTPPacket.TYPE.PNG
+    extension = ".png"
+    lossless = True
+    encode_cost, decode_cost = 85.0, 40.0
+    size_ratio = 8.0
+
+    def _params(self, quality: int) -> List[int]:
+        # the fastest zlib level, higher ones save little on camera frames
+        return [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+# ===========================
+# Registry
+# ===========================
+DEFAULT_CODEC = "JPEG"
+CODECS: Dict[str, Codec] = {}  # by name, with their default settings
+_BY_PAYLOAD_TYPE: Dict[int, Codec] = {}
+
+
+def register(codec: Codec):
+    CODECS[codec.name] = codec
+    _BY_PAYLOAD_TYPE[codec.payload_type] = codec
+
+
+for _codec in (JpegCodec(), WebpCodec(), PngCodec()):
+    register(_codec)
+
+
+def by_payload_type(payload_type: int) -> Optional[Codec]:
+    return _BY_PAYLOAD_TYPE.get(payload_type)
+
+
+def parse_offer(offer: str) -> Optional[Codec]:
+    # "WEBP;quality=70", None for a codec unknown here
+    name, params = transport_params(offer)
+    codec = CODECS.get(name.upper())
+    if codec is None:
+        return None
+    return codec.configure(params)
+
+
+def negotiate(offers: List[str], allowed: List[str]) -> List[Codec]:
+    # the codecs offered that are also allowed, in the order offered
+    allowed = {name.upper() for name in allowed}
+    codecs = []
+    for offer in offers:
+        try:
+            codec = parse_offer(offer)
+        except ValueError:
+            continue
+        if codec is not None and codec.name in allowed and codec not in codecs:
+            codecs.append(codec)
+    return codecs
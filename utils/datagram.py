@@ -0,0 +1,173 @@
+"""
+RTP frames are split into UDP datagrams of at most `size` bytes, each one
+prefixed by the packet it belongs to (the RTP sequence number of the packet),
+its index among the fragments of the packet and their count:
+
+        0                   1                   2
+        0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+       |           packet id           |             index             |
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+       |             count             |    RTP packet slice ...       |
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+so that a packet missing any fragment is never completed with the fragments
+of another.
+
+The datagram size is negotiated in SETUP through the `Blocksize` header,
+clamped to the path MTU and lowered at runtime when the loss rate suggests
+the datagrams are being fragmented at the IP level.
+"""
+import ipaddress
+import math
+import socket
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+
+FRAGMENT_HEADER = struct.Struct("!HHH")  # packet id, index, count
+FRAGMENT_HEADER_SIZE = FRAGMENT_HEADER.size
+MAX_FRAGMENTS = 0xFFFF
+
+IP_UDP_OVERHEAD = 28  # 20 bytes IPv4 header + 8 bytes UDP header
+ETHERNET_MTU = 1500
+MIN_MTU = 576  # every IPv4 host must accept datagrams of this size
+
+MIN_DGRAM = MIN_MTU - IP_UDP_OVERHEAD
+ETHERNET_DGRAM = ETHERNET_MTU - IP_UDP_OVERHEAD
+MAX_DGRAM = 0xFFFF - IP_UDP_OVERHEAD
+DEFAULT_DGRAM = 2**12
+
+SOCKET_BUFFER_SIZE = 2**22  # the kernel silently caps this at {w,r}mem_max
+
+# linux/in.h, not exported by the socket module
+_IP_MTU_DISCOVER = 10
+_IP_PMTUDISC_DO = 2
+_IP_MTU = 14
+
+
+def probe_path_mtu(address: Tuple[str, int]) -> Optional[int]:
+    # the kernel reports the MTU of the route to `address` (updated by ICMP
+    # "fragmentation needed" once path MTU discovery has kicked in)
+    if not sys.platform.startswith("linux"):
+        return None
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.setsockopt(socket.IPPROTO_IP, _IP_MTU_DISCOVER, _IP_PMTUDISC_DO)
+        probe.connect(address)
+        return probe.getsockopt(socket.IPPROTO_IP, _IP_MTU)
+    except OSError:
+        return None
+    finally:
+        probe.close()
+
+
+def mtu_to_dgram(mtu: int) -> int:
+    return max(MIN_DGRAM, min(MAX_DGRAM, mtu - IP_UDP_OVERHEAD))
+
+
+def set_socket_buffers(
+    sock: socket.socket, sndbuf: Optional[int] = None, rcvbuf: Optional[int] = None
+):
+    try:
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError as e:
+        print(f"failed to resize socket buffers: {e}")
+
+
+def fragment(packet: bytes, dgram_size: int) -> List[bytes]:
+    # `packet` is an RTP packet, its sequence number identifies the fragments
+    size = len(packet)
+    chunk = dgram_size - FRAGMENT_HEADER_SIZE
+    count = max(1, math.ceil(size / chunk))
+    if count > MAX_FRAGMENTS:
+        # larger datagrams would be fragmented by IP again
+        print(f"[RTP] Packet of {size} bytes dropped, more than {MAX_FRAGMENTS} datagrams of {dgram_size} bytes")
+        return []
+    packet_id = packet[2] << 8 | packet[3]
+    view = memoryview(packet)
+    return [
+        FRAGMENT_HEADER.pack(packet_id, i, count) + view[i * chunk : (i + 1) * chunk]
+        for i in range(count)
+    ]
+
+
+class DatagramSizer:
+    # a report above this loss rate while sending datagrams larger than the
+    # path can carry unfragmented makes the sizer step down
+    FRAGMENT_LOSS_THRESHOLD = 0.05
+    # clean reports needed before probing a larger size again
+    RECOVERY_REPORTS = 10
+
+    def __init__(
+        self, address: Tuple[str, int], requested: Optional[int] = None
+    ) -> None:
+        self.address = address
+        self.path_mtu = probe_path_mtu(address)
+        requested = requested or DEFAULT_DGRAM
+        self.negotiated = max(MIN_DGRAM, min(MAX_DGRAM, requested))
+        if self.path_mtu is not None:
+            self.negotiated = min(self.negotiated, mtu_to_dgram(self.path_mtu))
+        self.size = self.negotiated
+        self._clean_reports = 0
+        # loopback traffic never gets fragmented on the way
+        self._is_local = ipaddress.ip_address(address[0]).is_loopback
+
+    def on_report(self, fraction_lost: float):
+        if fraction_lost > self.FRAGMENT_LOSS_THRESHOLD:
+            self._clean_reports = 0
+            self._step_down()
+            return
+        self._clean_reports += 1
+        if self._clean_reports >= self.RECOVERY_REPORTS and self.size < self.negotiated:
+            self._clean_reports = 0
+            self.size = min(self.negotiated, self.size * 2)
+            print(f"[RTP] Datagram size raised to {self.size}")
+
+    def _step_down(self):
+        if self._is_local:
+            return
+        # the kernel may have learned a smaller path MTU in the meantime
+        self.path_mtu = probe_path_mtu(self.address) or self.path_mtu
+        safe = ETHERNET_DGRAM
+        if self.path_mtu is not None:
+            safe = min(safe, mtu_to_dgram(self.path_mtu))
+        if self.size <= safe:
+            # losses are not caused by IP fragmentation
+            return
+        self.size = max(safe, self.size // 2)
+        print(f"[RTP] Datagram size lowered to {self.size}")
+
+
+class Reassembler:
+    # collects the fragments of one RTP packet, fed one datagram at a time,
+    # in any order. A packet still missing fragments is dropped once the
+    # next one starts; fragments of an older packet than the one collected
+    # arrived too late
+    def __init__(self) -> None:
+        self._packet_id: Optional[int] = None
+        # index -> slice of the packet collected, None once it is complete
+        self._chunks: Optional[Dict[int, bytes]] = None
+
+    def push(self, datagram: bytes) -> Optional[bytes]:
+        # returns the whole packet once all its fragments arrived
+        if len(datagram) < FRAGMENT_HEADER_SIZE:
+            return None
+        packet_id, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        if packet_id != self._packet_id:
+            if self._packet_id is not None and (packet_id - self._packet_id) % 0x10000 >= 0x8000:
+                return None
+            self._packet_id = packet_id
+            self._chunks = {}
+        if self._chunks is None or index >= count:
+            return None
+        self._chunks[index] = datagram[FRAGMENT_HEADER_SIZE:]
+        if len(self._chunks) < count:
+            return None
+        packet = b"".join(self._chunks[i] for i in range(count))
+        self._chunks = None
+        return packet
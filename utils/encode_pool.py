@@ -0,0 +1,140 @@
+"""
+Encoding in worker processes. A server with many sources and sessions is
+bound by the interpreter: the Python around every cv2 call holds the GIL, so
+read-ahead threads encode one at a time however many cores there are. With
+an EncodePool, the read-ahead threads still capture, but hand their raw
+frames to a pool of processes through a ring of shared memory slots and only
+get the encoded payloads back:
+
+    read-ahead thread --frame--> FrameRing slot --> encoder process
+            ^                                             |
+            +------------- payloads, one per rendition ---+
+
+A slot is held until its frame is encoded, the ring bounds the frames in
+flight. Frames larger than a slot, and undecoded JPEG frames, are pickled
+with the job instead.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from utils.codecs import Codec, Rendition, encode_renditions
+
+
+# ===========================
+# Raw frames in shared memory: fixed-size slots, handed out and given back
+# ===========================
+class FrameRing:
+    def __init__(self, slots: int, slot_size: int) -> None:
+        self.slots = slots
+        self.slot_size = slot_size
+        self._memory = SharedMemory(create=True, size=slots * slot_size)
+        self.name = self._memory.name
+        self._free: "Queue[int]" = Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+
+    def put(self, frame: np.ndarray) -> Optional[int]:
+        # copies the frame into a free slot, waiting for one; None when the
+        # frame doesn't fit
+        if frame.nbytes > self.slot_size:
+            return None
+        slot = self._free.get()
+        view = np.ndarray(frame.shape, frame.dtype, self._memory.buf, slot * self.slot_size)
+        view[...] = frame
+        return slot
+
+    def release(self, slot: int):
+        self._free.put(slot)
+
+    def close(self):
+        self._memory.close()
+        self._memory.unlink()
+
+
+# the ring as attached by an encoder process, and the barrier its warm-up
+# jobs meet at
+_ring: Optional[SharedMemory] = None
+_slot_size = 0
+_started = None
+
+
+def _attach(name: str, slot_size: int, started):
+    global _ring, _slot_size, _started
+    _ring, _slot_size, _started = SharedMemory(name), slot_size, started
+
+
+def _warm_up(timeout: float):
+    # holds its process until every process took one, so that no process
+    # takes two and the pool spawns them all
+    _started.wait(timeout)
+
+
+def _encode(
+    slot: Optional[int],
+    shape: Tuple[int, ...],
+    dtype: str,
+    source: Union[None, np.ndarray, bytes],
+    codec: Codec,
+    renditions: Sequence[Rendition],
+) -> List[bytes]:
+    # in an encoder process: the frame is in `slot`, or `source` otherwise
+    if slot is not None:
+        source = np.ndarray(shape, np.dtype(dtype), _ring.buf, slot * _slot_size)
+    return encode_renditions(source, codec, renditions)
+
+
+# ===========================
+# Encoder processes shared by every stream of a server
+# ===========================
+class EncodePool:
+    DEFAULT_SLOT_SIZE = 1920 * 1080 * 3  # a 1080p BGR frame
+    SLOTS_PER_PROCESS = 2  # one frame encoding, the next one being copied in
+    START_TIMEOUT = 60  # seconds for every process to spawn and import cv2
+
+    def __init__(self, processes: Optional[int] = None, slot_size: int = DEFAULT_SLOT_SIZE) -> None:
+        self.processes = processes or os.cpu_count()
+        self._ring = FrameRing(self.SLOTS_PER_PROCESS * self.processes, slot_size)
+        # spawned: forking a process full of threads and sockets is unsafe
+        context = get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            self.processes,
+            mp_context=context,
+            initializer=_attach,
+            initargs=(self._ring.name, slot_size, context.Barrier(self.processes)),
+        )
+        # start the processes now, not with the first frames of the first
+        # sessions: the pool only spawns one when no process is idle
+        warm_ups = [
+            self._executor.submit(_warm_up, self.START_TIMEOUT) for _ in range(self.processes)
+        ]
+        for warm_up in warm_ups:
+            warm_up.result()
+        print(f"Encoding in {self.processes} processes")
+
+    def encode(
+        self, source: Union[np.ndarray, bytes], codec: Codec, renditions: Sequence[Rendition]
+    ) -> List[bytes]:
+        # the payloads of a BGR or JPEG frame in `renditions`, blocks the
+        # calling thread while an encoder process works on it
+        slot = self._ring.put(source) if isinstance(source, np.ndarray) else None
+        try:
+            if slot is None:
+                future = self._executor.submit(_encode, None, (), "", source, codec, renditions)
+            else:
+                future = self._executor.submit(
+                    _encode, slot, source.shape, source.dtype.str, None, codec, renditions
+                )
+            return future.result()
+        finally:
+            if slot is not None:
+                self._ring.release(slot)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._ring.close()
@@ -0,0 +1,153 @@
+"""
+Frame index of a video file: the timestamp and keyframe flag of every frame,
+built once by a scan of the container and cached on disk, so that a seek or
+trick play (RTSP Range and Scale) lands on the right frame without decoding
+the file from its beginning.
+
+Cache file, one per video (named after the hash of its absolute path):
+
+    header:   "FIDX" | version (u32) | video size (u64) | video mtime (f64) | frames (u32)
+    records:  timestamp in seconds (f64) | keyframe (u8)      x frames
+
+The cache is rebuilt whenever the size or modification time of the video
+changes.
+"""
+import hashlib
+import os
+import struct
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+class FrameIndex:
+    CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rtsp-frame-index")
+    VERSION = 1
+
+    _HEADER = struct.Struct("!4sIQdI")
+    _MAGIC = b"FIDX"
+    _RECORD = np.dtype([("timestamp", ">f8"), ("keyframe", "u1")])
+
+    def __init__(self, timestamps: np.ndarray, keyframes: np.ndarray) -> None:
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.keyframes = np.asarray(keyframes, dtype=bool)
+        if len(self.keyframes):
+            # decoding can always start at the first frame
+            self.keyframes[0] = True
+        self._keyframe_numbers = np.flatnonzero(self.keyframes)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def frame_duration(self) -> float:
+        if len(self) < 2:
+            return 0.0
+        return float(np.median(np.diff(self.timestamps)))
+
+    @property
+    def duration(self) -> float:
+        # seconds, up to the end of the last frame
+        if not len(self):
+            return 0.0
+        return float(self.timestamps[-1]) + self.frame_duration
+
+    def timestamp(self, frame_number: int) -> float:
+        return float(self.timestamps[frame_number])
+
+    def frame_at(self, seconds: float) -> int:
+        # the frame showing at `seconds`
+        frame_number = int(np.searchsorted(self.timestamps, seconds, side="right")) - 1
+        return min(max(frame_number, 0), len(self) - 1)
+
+    def frames_before(self, seconds: float) -> int:
+        # frames starting before `seconds`, the end of a forward range
+        return int(np.searchsorted(self.timestamps, seconds, side="left"))
+
+    def keyframe_at_or_before(self, frame_number: int) -> int:
+        i = int(np.searchsorted(self._keyframe_numbers, frame_number, side="right")) - 1
+        return int(self._keyframe_numbers[max(i, 0)])
+
+    def next_keyframe(self, frame_number: int, step: int) -> Optional[int]:
+        # trick play: the keyframe `step` frames away or beyond, None past
+        # either end of the file
+        target = frame_number + step
+        if step > 0:
+            i = int(np.searchsorted(self._keyframe_numbers, target, side="left"))
+            if i == len(self._keyframe_numbers):
+                return None
+        else:
+            i = int(np.searchsorted(self._keyframe_numbers, target, side="right")) - 1
+            if i < 0 or target < 0:
+                return None
+        return int(self._keyframe_numbers[i])
+
+    # ===========================
+    # Building and caching
+    # ===========================
+    @classmethod
+    def load(cls, file_path: str):
+        # from the cache, or built and cached
+        stat = os.stat(file_path)
+        cache_path = cls._cache_path(file_path)
+        index = cls._read_cache(cache_path, stat.st_size, stat.st_mtime)
+        if index is None:
+            index = cls.build(file_path)
+            try:
+                index._write_cache(cache_path, stat.st_size, stat.st_mtime)
+            except OSError as e:
+                print(f"Frame index of {file_path} not cached: {e}")
+        return index
+
+    @classmethod
+    def build(cls, file_path: str):
+        stream = cv2.VideoCapture(file_path)
+        fps = stream.get(cv2.CAP_PROP_FPS) or 0.0
+        # undecoded packets where the backend allows: the scan then costs
+        # a read of the file, and tells keyframes apart
+        raw = stream.set(cv2.CAP_PROP_FORMAT, -1)
+        timestamps, keyframes = [], []
+        while stream.grab():
+            timestamps.append(stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+            # without packet flags every frame counts as a seek target, the
+            # backend then decodes forward from the preceding keyframe itself
+            keyframes.append(not raw or stream.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) > 0)
+        stream.release()
+        if len(timestamps) > 1 and not any(timestamps[1:]) and fps > 0:
+            # no timestamps from the backend
+            timestamps = [n / fps for n in range(len(timestamps))]
+        print(f"Indexed {len(timestamps)} frames of {file_path}")
+        return cls(np.array(timestamps), np.array(keyframes))
+
+    @classmethod
+    def _cache_path(cls, file_path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+        return os.path.join(cls.CACHE_DIR, f"{name}.idx")
+
+    @classmethod
+    def _read_cache(cls, cache_path: str, size: int, mtime: float):
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < cls._HEADER.size:
+            return None
+        magic, version, cached_size, cached_mtime, frames = cls._HEADER.unpack_from(data)
+        if (magic, version, cached_size, cached_mtime) != (cls._MAGIC, cls.VERSION, size, mtime):
+            return None
+        records = np.frombuffer(data, dtype=cls._RECORD, count=frames, offset=cls._HEADER.size)
+        return cls(records["timestamp"], records["keyframe"])
+
+    def _write_cache(self, cache_path: str, size: int, mtime: float):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        records = np.empty(len(self), dtype=self._RECORD)
+        records["timestamp"] = self.timestamps
+        records["keyframe"] = self.keyframes
+        # written aside and renamed, concurrent sessions never read half a file
+        temp_path = f"{cache_path}.{os.getpid()}"
+        with open(temp_path, "wb") as f:
+            f.write(self._HEADER.pack(self._MAGIC, self.VERSION, size, mtime, len(self)))
+            f.write(records.tobytes())
+        os.replace(temp_path, cache_path)
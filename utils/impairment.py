@@ -0,0 +1,227 @@
+"""
+Network impairments applied to datagrams, as a router or a lossy radio link
+would: loss, independent (Bernoulli) or in bursts (Gilbert-Elliott), delay
+with jitter, reordering, duplication and a token-bucket bandwidth cap with a
+bounded queue. A `Link` only computes when each datagram it is handed is
+delivered, if at all, from the time it was sent; it holds no socket and no
+clock, so the same seed and datagrams sent at the same times always give the
+same deliveries.
+
+Profiles can change over time, e.g. from a JSON script:
+
+    [
+        {"at": 0, "delay": 20, "jitter": 5},
+        {"at": 10, "loss": 0.05, "rate": 800},
+        {"at": 20, "gilbert_elliott": [0.01, 0.3], "rate": 300, "queue": 100},
+        {"at": 30}
+    ]
+
+where "at" is in seconds from the start, delays in milliseconds and rates in
+kbit/s, as on the command line of main_proxy.py.
+"""
+import argparse
+import json
+import random
+from typing import Dict, List, Optional, Tuple, Union
+
+
+# Loss models are shared by every link built from the same profile: the
+# state they need (the bad state of Gilbert-Elliott) is kept by each `Link`,
+# handed to `lost()` and returned with whether the datagram is lost.
+
+
+class Bernoulli:
+    # every datagram lost with the same probability
+    def __init__(self, loss: float) -> None:
+        self.loss = loss
+
+    def lost(self, rng: random.Random, bad: bool) -> Tuple[bool, bool]:
+        return rng.random() < self.loss, False
+
+
+class GilbertElliott:
+    # a good and a bad state, each losing datagrams with its own probability;
+    # p moves from good to bad, r back, per datagram: bursts of 1/r datagrams
+    # in the bad state on average
+    def __init__(self, p: float, r: float, good_loss: float = 0.0, bad_loss: float = 1.0) -> None:
+        self.p = p
+        self.r = r
+        self.good_loss = good_loss
+        self.bad_loss = bad_loss
+
+    def lost(self, rng: random.Random, bad: bool) -> Tuple[bool, bool]:
+        if bad:
+            bad = rng.random() >= self.r
+        else:
+            bad = rng.random() < self.p
+        return rng.random() < (self.bad_loss if bad else self.good_loss), bad
+
+
+class Profile:
+    # one setting of the link, times in seconds and rates in bytes/s
+    def __init__(
+        self,
+        loss: Union[None, Bernoulli, GilbertElliott] = None,
+        delay: float = 0.0,
+        jitter: float = 0.0,
+        reorder: float = 0.0,
+        reorder_delay: float = 0.01,
+        duplicate: float = 0.0,
+        rate: Optional[float] = None,
+        burst: int = 15000,
+        queue: float = 0.2,
+    ) -> None:
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter  # delay varies by up to this much either way
+        self.reorder = reorder  # probability a datagram is held back...
+        self.reorder_delay = reorder_delay  # ...that much longer than the others
+        self.duplicate = duplicate  # probability a datagram is delivered twice
+        self.rate = rate  # None for no cap
+        self.burst = burst  # bytes that may leave at once after idling
+        self.queue = queue  # longest wait for the bandwidth, longer is dropped
+
+    @classmethod
+    def from_dict(cls, values: Dict) -> "Profile":
+        # from the units of the command line and of profile scripts
+        loss = None
+        if values.get("gilbert_elliott") is not None:
+            loss = GilbertElliott(*values["gilbert_elliott"])
+        elif values.get("loss"):
+            loss = Bernoulli(values["loss"])
+        rate = values.get("rate")
+        return cls(
+            loss=loss,
+            delay=values.get("delay", 0) / 1000,
+            jitter=values.get("jitter", 0) / 1000,
+            reorder=values.get("reorder", 0),
+            reorder_delay=values.get("reorder_delay", 10) / 1000,
+            duplicate=values.get("duplicate", 0),
+            rate=None if rate is None else rate * 1000 / 8,
+            burst=values.get("burst", 15000),
+            queue=values.get("queue", 200) / 1000,
+        )
+
+
+Schedule = List[Tuple[float, Profile]]  # (seconds from the start, profile), in order
+
+
+def load_schedule(path: str) -> Schedule:
+    with open(path) as f:
+        steps = json.load(f)
+    return [(float(step.get("at", 0)), Profile.from_dict(step)) for step in steps]
+
+
+class Link:
+    def __init__(self, schedule: Union[Profile, Schedule], seed: Optional[int] = None) -> None:
+        self.schedule: Schedule = [(0.0, schedule)] if isinstance(schedule, Profile) else list(schedule)
+        self._rng = random.Random(seed)
+        self.start: Optional[float] = None  # time of the first datagram
+        # token bucket
+        self._tokens = 0.0
+        self._token_time = 0.0
+        self._last_departure = 0.0
+        # deliveries keep the order datagrams were sent in, unless reordered
+        self._last_delivery = 0.0
+        # state of the loss model of each step, the link starting good
+        self._bad: Dict[int, bool] = {}
+        self.stats = {"sent": 0, "lost": 0, "dropped": 0, "duplicated": 0, "reordered": 0}
+
+    def profile_at(self, now: float) -> Profile:
+        return self.schedule[self._step_at(now)][1]
+
+    def _step_at(self, now: float) -> int:
+        elapsed = now - self.start
+        index = 0
+        for i, (at, _) in enumerate(self.schedule):
+            if at > elapsed:
+                break
+            index = i
+        return index
+
+    def send(self, size: int, now: float) -> List[float]:
+        # times a datagram of `size` bytes sent at `now` is delivered at,
+        # none when it is lost, two when duplicated
+        if self.start is None:
+            self.start = self._token_time = now
+            self._tokens = float(self.profile_at(now).burst)
+        self.stats["sent"] += 1
+        step = self._step_at(now)
+        profile = self.schedule[step][1]
+        if profile.loss is not None:
+            lost, self._bad[step] = profile.loss.lost(self._rng, self._bad.get(step, False))
+            if lost:
+                self.stats["lost"] += 1
+                return []
+        copies = 1
+        if profile.duplicate and self._rng.random() < profile.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+        deliveries = []
+        for _ in range(copies):
+            departure = self._depart(profile, size, now)
+            if departure is None:
+                self.stats["dropped"] += 1
+                continue
+            deliveries.append(self._deliver(profile, departure))
+        return deliveries
+
+    def _depart(self, profile: Profile, size: int, now: float) -> Optional[float]:
+        # when the datagram is through the bottleneck, None when the queue
+        # in front of it is already too long
+        if profile.rate is None:
+            return now
+        departure = max(now, self._last_departure)
+        tokens = min(profile.burst, self._tokens + profile.rate * (departure - self._token_time))
+        if tokens < size:
+            departure += (size - tokens) / profile.rate
+            tokens = size
+        if departure - now > profile.queue:
+            return None
+        self._tokens = tokens - size
+        self._token_time = self._last_departure = departure
+        return departure
+
+    def _deliver(self, profile: Profile, departure: float) -> float:
+        delay = profile.delay
+        if profile.jitter:
+            delay += self._rng.uniform(-profile.jitter, profile.jitter)
+        delivery = departure + max(0.0, delay)
+        if profile.reorder and self._rng.random() < profile.reorder:
+            # overtaken by the ones after, which don't wait for it
+            self.stats["reordered"] += 1
+            return max(delivery, self._last_delivery) + profile.reorder_delay
+        delivery = max(delivery, self._last_delivery)
+        self._last_delivery = delivery
+        return delivery
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    # the impairments as command line options, see schedule_from_arguments()
+    parser.add_argument("--loss", type=float, default=0, help="Probability of losing a datagram")
+    parser.add_argument(
+        "--gilbert-elliott",
+        type=str,
+        default=None,
+        metavar="P,R[,GOOD,BAD]",
+        help="Bursty loss instead: probabilities to enter and leave the bad state, and of loss in each state",
+    )
+    parser.add_argument("--delay", type=float, default=0, help="One-way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Delay variation in ms, either way")
+    parser.add_argument("--reorder", type=float, default=0, help="Probability of holding a datagram back")
+    parser.add_argument("--duplicate", type=float, default=0, help="Probability of delivering a datagram twice")
+    parser.add_argument("--rate", type=float, default=None, help="Bandwidth cap in kbit/s")
+    parser.add_argument("--burst", type=int, default=15000, help="Bytes sent at once after idling")
+    parser.add_argument("--queue", type=float, default=200, help="Longest wait for the bandwidth in ms")
+    parser.add_argument(
+        "--profile", type=str, default=None, help="JSON script of impairments changing over time (see utils/impairment.py)"
+    )
+
+
+def schedule_from_arguments(args: argparse.Namespace) -> Union[Profile, Schedule]:
+    if args.profile is not None:
+        return load_schedule(args.profile)
+    values = dict(vars(args))
+    if args.gilbert_elliott is not None:
+        values["gilbert_elliott"] = [float(value) for value in args.gilbert_elliott.split(",")]
+    return Profile.from_dict(values)
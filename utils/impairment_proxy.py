@@ -0,0 +1,285 @@
+"""
+An RTSP proxy impairing the media on its way, so that a client and a server
+on the same machine see a network with loss, delay and a bandwidth cap (see
+utils/impairment.py). The client connects to the proxy instead of the
+server; the proxy relays RTSP and rewrites the ports of SETUP so that RTP
+(server to client) and RTCP (client to server) go through its own UDP
+sockets:
+
+    client --RTSP--> proxy --RTSP--> server
+    client <--RTP--- proxy <--RTP--- server     downlink impairments
+    client --RTCP--> proxy --RTCP--> server     uplink impairments, if any
+
+Interleaved media stays on the RTSP connection and multicast goes to its
+group directly, neither is impaired.
+"""
+import socket
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import List, Optional, Tuple, Union
+
+from utils.clock import EventQueue
+from utils.datagram import MAX_DGRAM, SOCKET_BUFFER_SIZE, set_socket_buffers
+from utils.impairment import Link, Profile, Schedule
+from utils.interleaved import InterleavedDemuxer, frame_header
+from utils.rtsp_parser import RTSPMessage, transport_params
+
+
+def format_message(message: RTSPMessage) -> bytes:
+    # header names come lower-cased from the parser, RTSP ignores their case
+    lines = [message.start_line]
+    for name, value in message.headers.items():
+        lines.append(f"{'-'.join(part.capitalize() for part in name.split('-'))}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + message.body
+
+
+def rewrite_transport(transport: str, name: str, port: int) -> Tuple[str, Optional[int]]:
+    # the Transport header with the port `name` replaced, and the port it
+    # replaced, None when it had none
+    spec, params = transport_params(transport)
+    if params.get(name) is None:
+        return transport, None
+    replaced = int(params[name].split("-")[0])
+    params[name] = str(port)
+    return spec + "".join(f";{key}" if value is None else f";{key}={value}" for key, value in params.items()), replaced
+
+
+class ImpairmentProxy:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        server_host: str,
+        server_port: int,
+        downlink: Union[Profile, Schedule],
+        uplink: Union[None, Profile, Schedule] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.server_host = server_host
+        self.server_port = server_port
+        self.downlink = downlink
+        self.uplink = uplink
+        self.seed = seed
+        self._relay_numbers = count()
+        self._listener: Union[None, socket.socket] = None
+        self._relays: List[ImpairmentProxy.Relay] = []
+        self._relays_lock = Lock()
+        # datagrams of every relay on their way, sent by a single thread
+        self._deliveries = EventQueue()
+        self._deliveries_changed = Condition()
+        self._closed = False
+        self._delivery_thread: Union[None, Thread] = None
+
+    def _link(self, schedule: Union[None, Profile, Schedule], number: int) -> Link:
+        # each session its own seed, the same from one run to the next
+        seed = None if self.seed is None else self.seed + number
+        return Link(Profile() if schedule is None else schedule, seed)
+
+    def serve_forever(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, self.port))
+        self._listener.listen(5)
+        self._delivery_thread = Thread(target=self._deliver, name="impairment_delivery")
+        self._delivery_thread.setDaemon(True)
+        self._delivery_thread.start()
+        print(f"Relaying {self.host}:{self.port} to {self.server_host}:{self.server_port}...")
+        while not self._closed:
+            try:
+                connection, address = self._listener.accept()
+            except OSError:
+                return
+            try:
+                server_connection = socket.create_connection((self.server_host, self.server_port))
+            except OSError as e:
+                print(f"[PROXY] Server unreachable: {e}")
+                connection.close()
+                continue
+            number = next(self._relay_numbers)
+            relay = self.Relay(
+                self,
+                connection,
+                server_connection,
+                self._link(self.downlink, 2 * number),
+                self._link(self.uplink, 2 * number + 1),
+            )
+            with self._relays_lock:
+                self._relays.append(relay)
+            relay.start()
+            print(f"[PROXY] Relaying {address[0]}:{address[1]}")
+
+    def close(self):
+        self._closed = True
+        if self._listener is not None:
+            self._listener.close()
+        with self._relays_lock:
+            relays = list(self._relays)
+        for relay in relays:
+            relay.close()
+        with self._deliveries_changed:
+            self._deliveries_changed.notify()
+
+    def _forward(self, link: Link, sock: socket.socket, datagram: bytes, address: Tuple[str, int]):
+        # receive threads
+        with self._deliveries_changed:
+            for delivery in link.send(len(datagram), monotonic()):
+                self._deliveries.push(delivery, (sock, datagram, address))
+            self._deliveries_changed.notify()
+
+    def _deliver(self):
+        while True:
+            with self._deliveries_changed:
+                while not self._closed:
+                    next_time = self._deliveries.next_time()
+                    if next_time is not None and next_time <= monotonic():
+                        break
+                    self._deliveries_changed.wait(
+                        None if next_time is None else next_time - monotonic()
+                    )
+                if self._closed:
+                    return
+                due = self._deliveries.pop_due(monotonic())
+            for sock, datagram, address in due:
+                try:
+                    sock.sendto(datagram, address)
+                except OSError:
+                    # the session is gone
+                    pass
+
+    def _remove(self, relay: "ImpairmentProxy.Relay"):
+        with self._relays_lock:
+            if relay in self._relays:
+                self._relays.remove(relay)
+
+    # ===========================
+    # One RTSP connection and the media of its session
+    # ===========================
+    class Relay:
+        def __init__(
+            self,
+            proxy: "ImpairmentProxy",
+            client_connection: socket.socket,
+            server_connection: socket.socket,
+            downlink: Link,
+            uplink: Link,
+        ) -> None:
+            self.proxy = proxy
+            self.client_connection = client_connection
+            self.server_connection = server_connection
+            self.downlink = downlink
+            self.uplink = uplink
+            # RTP from the server arrives where the server sees the proxy,
+            # RTCP from the client where the client reached it
+            self.rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.rtp_socket.bind((server_connection.getsockname()[0], 0))
+            self.rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.rtcp_socket.bind((client_connection.getsockname()[0], 0))
+            for sock in (self.rtp_socket, self.rtcp_socket):
+                set_socket_buffers(sock, sndbuf=SOCKET_BUFFER_SIZE, rcvbuf=SOCKET_BUFFER_SIZE)
+            # where the media goes once SETUP told
+            self.client_rtp_address: Union[None, Tuple[str, int]] = None
+            self.server_rtcp_address: Union[None, Tuple[str, int]] = None
+            self._closed = False
+            self._close_lock = Lock()
+
+        def start(self):
+            for target, name in (
+                (self._relay_requests, "proxy_rtsp_up"),
+                (self._relay_responses, "proxy_rtsp_down"),
+                (self._relay_rtp, "proxy_rtp"),
+                (self._relay_rtcp, "proxy_rtcp"),
+            ):
+                thread = Thread(target=target, name=name)
+                thread.setDaemon(True)
+                thread.start()
+
+        def close(self):
+            with self._close_lock:
+                if self._closed:
+                    return
+                self._closed = True
+            for connection in (self.client_connection, self.server_connection):
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                connection.close()
+            for sock in (self.rtp_socket, self.rtcp_socket):
+                # an empty datagram wakes the thread blocked in recvfrom()
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.sendto(b"", sock.getsockname())
+            self.proxy._remove(self)
+            for direction, link in (("downlink", self.downlink), ("uplink", self.uplink)):
+                print(f"[PROXY] {direction}: " + ", ".join(f"{value} {key}" for key, value in link.stats.items()))
+
+        def _relay_rtsp(self, source: socket.socket, destination: socket.socket, rewrite):
+            demuxer = InterleavedDemuxer()
+            try:
+                while True:
+                    data = source.recv(MAX_DGRAM)
+                    if not data:
+                        break
+                    demuxer.feed(data)
+                    item = demuxer.next()
+                    while item is not None:
+                        if isinstance(item, tuple):
+                            channel, payload = item
+                            destination.sendall(frame_header(channel, len(payload)) + payload)
+                        else:
+                            destination.sendall(format_message(rewrite(item)))
+                        item = demuxer.next()
+            except OSError:
+                pass
+            self.close()
+
+        def _relay_requests(self):
+            self._relay_rtsp(self.client_connection, self.server_connection, self._rewrite_request)
+
+        def _relay_responses(self):
+            self._relay_rtsp(self.server_connection, self.client_connection, self._rewrite_response)
+
+        def _rewrite_request(self, message: RTSPMessage) -> RTSPMessage:
+            # the server sends RTP to the proxy
+            transport = message.header("Transport")
+            if message.start_line.startswith("SETUP") and transport is not None:
+                transport, client_port = rewrite_transport(
+                    transport, "client_port", self.rtp_socket.getsockname()[1]
+                )
+                if client_port is not None:
+                    self.client_rtp_address = self.client_connection.getpeername()[0], client_port
+                    message.headers["transport"] = transport
+            return message
+
+        def _rewrite_response(self, message: RTSPMessage) -> RTSPMessage:
+            # the client sends RTCP to the proxy
+            transport = message.header("Transport")
+            if transport is not None:
+                transport, server_port = rewrite_transport(
+                    transport, "server_port", self.rtcp_socket.getsockname()[1]
+                )
+                if server_port is not None:
+                    self.server_rtcp_address = self.server_connection.getpeername()[0], server_port
+                    message.headers["transport"] = transport
+            return message
+
+        def _relay_datagrams(self, sock: socket.socket, link: Link, destination):
+            while True:
+                try:
+                    datagram, _ = sock.recvfrom(MAX_DGRAM)
+                except OSError:
+                    return
+                if self._closed:
+                    sock.close()
+                    return
+                address = destination()
+                if datagram and address is not None:
+                    self.proxy._forward(link, sock, datagram, address)
+
+        def _relay_rtp(self):
+            self._relay_datagrams(self.rtp_socket, self.downlink, lambda: self.client_rtp_address)
+
+        def _relay_rtcp(self):
+            self._relay_datagrams(self.rtcp_socket, self.uplink, lambda: self.server_rtcp_address)
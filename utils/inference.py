@@ -4,7 +4,8 @@ import cv2
 import numpy as np
 import sys
 import time
-from threading import Thread
+from threading import Lock, Thread
+from typing import List, Tuple
 import importlib.util
 
 MODEL_NAME = "utils/Sample_TFLite_model"
@@ -42,11 +43,16 @@ input_std = 127.5
 frame_rate_calc = 1
 freq = cv2.getTickFrequency()
 
+# the interpreter is shared, server read-ahead threads detect concurrently
+_interpreter_lock = Lock()
 
-def inference(frame):
-    t1 = cv2.getTickCount()
-    imH, imW = frame.size
-    frame = np.array(frame)
+# ((xmin, ymin, xmax, ymax) in pixels, label, score)
+Detection = Tuple[Tuple[int, int, int, int], str, float]
+
+
+def detect(frame: np.ndarray) -> List[Detection]:
+    # objects found in a BGR frame with a score above `min_conf_threshold`
+    imH, imW = frame.shape[:2]
     frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     frame_resized = cv2.resize(frame_rgb, (width, height))
     input_data = np.expand_dims(frame_resized, axis=0)
@@ -55,65 +61,71 @@ def inference(frame):
     if floating_model:
         input_data = (np.float32(input_data) - input_mean) / input_std
 
-    # Perform the actual detection by running the model with the image as input
-    interpreter.set_tensor(input_details[0]["index"], input_data)
-    interpreter.invoke()
-
-    # Retrieve detection results
-    boxes = interpreter.get_tensor(output_details[0]["index"])[
-        0
-    ]  # Bounding box coordinates of detected objects
-    classes = interpreter.get_tensor(output_details[1]["index"])[
-        0
-    ]  # Class index of detected objects
-    scores = interpreter.get_tensor(output_details[2]["index"])[
-        0
-    ]  # Confidence of detected objects
+    with _interpreter_lock:
+        # Perform the actual detection by running the model with the image as input
+        interpreter.set_tensor(input_details[0]["index"], input_data)
+        interpreter.invoke()
+
+        # Retrieve detection results
+        boxes = interpreter.get_tensor(output_details[0]["index"])[
+            0
+        ]  # Bounding box coordinates of detected objects
+        classes = interpreter.get_tensor(output_details[1]["index"])[
+            0
+        ]  # Class index of detected objects
+        scores = interpreter.get_tensor(output_details[2]["index"])[
+            0
+        ]  # Confidence of detected objects
     # num = interpreter.get_tensor(output_details[3]['index'])[0]  # Total number of detected objects (inaccurate and not needed)
 
-    # Loop over all detections and draw detection box if confidence is above minimum threshold
+    detections = []
     for i in range(len(scores)):
         if (scores[i] > min_conf_threshold) and (scores[i] <= 1.0):
-
-            # Get bounding box coordinates and draw box
             # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image using max() and min()
             ymin = int(max(1, (boxes[i][0] * imH)))
             xmin = int(max(1, (boxes[i][1] * imW)))
             ymax = int(min(imH, (boxes[i][2] * imH)))
             xmax = int(min(imW, (boxes[i][3] * imW)))
+            detections.append(((xmin, ymin, xmax, ymax), labels[int(classes[i])], float(scores[i])))
+    return detections
+
+
+def inference(frame):
+    t1 = cv2.getTickCount()
+    # frames come from the client as RGB images
+    frame = np.array(frame)
 
-            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (10, 255, 0), 2)
-
-            # Draw label
-            object_name = labels[
-                int(classes[i])
-            ]  # Look up object name from "labels" array using class index
-            label = "%s: %d%%" % (
-                object_name,
-                int(scores[i] * 100),
-            )  # Example: 'person: 72%'
-            labelSize, baseLine = cv2.getTextSize(
-                label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2
-            )  # Get font size
-            label_ymin = max(
-                ymin, labelSize[1] + 10
-            )  # Make sure not to draw label too close to top of window
-            cv2.rectangle(
-                frame,
-                (xmin, label_ymin - labelSize[1] - 10),
-                (xmin + labelSize[0], label_ymin + baseLine - 10),
-                (255, 255, 255),
-                cv2.FILLED,
-            )  # Draw white box to put label text in
-            cv2.putText(
-                frame,
-                label,
-                (xmin, label_ymin - 7),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.7,
-                (0, 0, 0),
-                2,
-            )  # Draw label text
+    # Loop over all detections and draw detection box
+    for (xmin, ymin, xmax, ymax), object_name, score in detect(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)):
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (10, 255, 0), 2)
+
+        # Draw label
+        label = "%s: %d%%" % (
+            object_name,
+            int(score * 100),
+        )  # Example: 'person: 72%'
+        labelSize, baseLine = cv2.getTextSize(
+            label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2
+        )  # Get font size
+        label_ymin = max(
+            ymin, labelSize[1] + 10
+        )  # Make sure not to draw label too close to top of window
+        cv2.rectangle(
+            frame,
+            (xmin, label_ymin - labelSize[1] - 10),
+            (xmin + labelSize[0], label_ymin + baseLine - 10),
+            (255, 255, 255),
+            cv2.FILLED,
+        )  # Draw white box to put label text in
+        cv2.putText(
+            frame,
+            label,
+            (xmin, label_ymin - 7),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (0, 0, 0),
+            2,
+        )  # Draw label text
 
     # Draw framerate in corner of frame
     t2 = cv2.getTickCount()
@@ -0,0 +1,80 @@
+"""
+Interleaved binary data on the RTSP connection (per RFC 2326, section 10.12):
+
+        0               1               2               3
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+       |    '$' 0x24   |    channel    |            length             |
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+       |                    data (RTP or RTCP) ...                     |
+
+An RTP packet larger than 0xFFFF bytes is split into fragments exactly as on
+UDP (see utils/datagram.py), one fragment per interleaved frame. RTSP
+messages on the same connection are framed as usual (see utils/rtsp_parser.py),
+a '$' where a message would start opens a frame.
+"""
+import socket
+import struct
+from threading import Lock
+from typing import List, Optional, Tuple, Union
+
+from utils.rtsp_parser import RTSPMessage, RTSPParser
+
+
+MAGIC = 0x24  # '$'
+HEADER_FORMAT = "!BBH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_FRAME_DATA = 0xFFFF
+
+RTP_CHANNEL = 0
+RTCP_CHANNEL = 1
+
+
+def frame_header(channel: int, length: int) -> bytes:
+    return struct.pack(HEADER_FORMAT, MAGIC, channel, length)
+
+
+def frame_buffers(channel: int, chunks: List[bytes]) -> List[bytes]:
+    # header and data of every frame as separate buffers, for vectored writes
+    buffers = []
+    for chunk in chunks:
+        buffers.append(frame_header(channel, len(chunk)))
+        buffers.append(chunk)
+    return buffers
+
+
+def send_interleaved(
+    sock: socket.socket, channel: int, chunks: List[bytes], lock: Lock
+):
+    # all frames of one packet leave in a single vectored write, and the lock
+    # keeps RTSP responses from landing in the middle of them
+    buffers = frame_buffers(channel, chunks)
+    with lock:
+        while buffers:
+            sent = sock.sendmsg(buffers)
+            # drop whatever went out, a partial write leaves the tail of
+            # one buffer in front
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class InterleavedDemuxer(RTSPParser):
+    # splits the bytes read from an RTSP connection into RTSP messages and
+    # interleaved frames, whatever the TCP segmentation
+
+    def next(self) -> Optional[Union[RTSPMessage, Tuple[int, bytes]]]:
+        # returns an RTSP message, an interleaved frame as (channel, data),
+        # or None until more data has been fed
+        if self._pending is None and self._buffer and self._buffer[0] == MAGIC:
+            if len(self._buffer) < HEADER_SIZE:
+                return None
+            _, channel, length = struct.unpack_from(HEADER_FORMAT, self._buffer)
+            end = HEADER_SIZE + length
+            if len(self._buffer) < end:
+                return None
+            data = bytes(self._buffer[HEADER_SIZE:end])
+            del self._buffer[:end]
+            return channel, data
+        return super().next()
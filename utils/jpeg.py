@@ -0,0 +1,55 @@
+"""
+JPEG frames taken as they are from an MJPEG container or camera. Motion-JPEG
+may leave out the Huffman tables (AVI1 style: decoders are expected to use
+the standard ones), a stand-alone JPEG decoder then rejects the frame, so the
+standard tables are put back in front of the scan.
+"""
+import cv2
+import numpy as np
+
+
+SOI = b"\xff\xd8"
+DHT = 0xC4
+SOS = 0xDA
+
+
+def _header_segments(jpeg: bytes):
+    # (marker, start, end) of each segment from SOI up to and including SOS
+    pos = len(SOI)
+    while pos + 4 <= len(jpeg) and jpeg[pos] == 0xFF:
+        marker = jpeg[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        end = pos + 2 + int.from_bytes(jpeg[pos + 2:pos + 4], "big")
+        yield marker, pos, end
+        if marker == SOS:
+            return
+        pos = end
+
+
+def _standard_huffman_tables() -> bytes:
+    # libjpeg writes the tables of ITU T.81 Annex K.3 unless asked to
+    # optimize them, both the luminance and chrominance ones for colour
+    jpeg = cv2.imencode(".jpg", np.zeros((8, 8, 3), np.uint8))[1].tobytes()
+    return b"".join(
+        jpeg[start:end] for marker, start, end in _header_segments(jpeg) if marker == DHT
+    )
+
+
+STANDARD_HUFFMAN_TABLES = _standard_huffman_tables()
+
+
+def is_jpeg(data: bytes) -> bool:
+    return data.startswith(SOI)
+
+
+def with_huffman_tables(jpeg: bytes) -> bytes:
+    # the frame itself when it has its tables, else with the standard ones
+    for marker, start, _ in _header_segments(jpeg):
+        if marker == DHT:
+            return jpeg
+        if marker == SOS:
+            return jpeg[:start] + STANDARD_HUFFMAN_TABLES + jpeg[start:]
+    return jpeg
@@ -0,0 +1,81 @@
+"""
+Multicast delivery: every member of a group binds the group's RTP port (and
+the RTCP port right above it) and joins the group address on the interface
+facing the server. The server sends each fragment once to the group.
+
+    SETUP request:   Transport: RTP/AVP;multicast
+    SETUP response:  Transport: RTP/AVP;multicast;destination=<GROUP>;port=<RTP>-<RTCP>;ttl=<TTL>;ssrc=<SSRC>
+"""
+import ipaddress
+import socket
+import sys
+from typing import Tuple
+
+
+GROUP_NETWORK = "239.255.42.0/24"  # organization-local scope, RFC 2365
+GROUP_BASE_PORT = 5004  # RTP on even ports, RTCP on the following odd port
+DEFAULT_TTL = 1  # stay on the local network
+
+# linux/in.h, not exported by the socket module
+_IP_MULTICAST_ALL = 49
+
+
+def group_addresses(network: str = GROUP_NETWORK, base_port: int = GROUP_BASE_PORT):
+    # (group address, RTP port) pairs handed out to new groups; the ports
+    # differ too, so that members on systems delivering by port alone don't
+    # get each other's groups
+    hosts = ipaddress.ip_network(network).hosts()
+    for i, address in enumerate(hosts):
+        yield str(address), base_port + 2 * i
+
+
+def _membership(group: str, interface: str) -> bytes:
+    return socket.inet_aton(group) + socket.inet_aton(interface)
+
+
+def open_group_socket(
+    group: str, port: int, interface: str = "0.0.0.0", ttl: int = DEFAULT_TTL
+) -> socket.socket:
+    # receives what is sent to (group, port), and can send to it as well
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # several members (and the server) may listen on the same host
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if sys.platform.startswith("linux"):
+        # only receive the groups joined through this very socket, leaving
+        # a group must stop its traffic even if other local members remain
+        sock.setsockopt(socket.IPPROTO_IP, _IP_MULTICAST_ALL, 0)
+    sock.bind((group, port))
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _membership(group, interface)
+    )
+    set_multicast_sender(sock, interface, ttl)
+    return sock
+
+
+def set_multicast_sender(sock: socket.socket, interface: str = "0.0.0.0", ttl: int = DEFAULT_TTL):
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    # members on the sending host must see the datagrams too
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+    )
+
+
+def join_group(sock: socket.socket, group: str, interface: str = "0.0.0.0"):
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _membership(group, interface)
+    )
+
+
+def leave_group(sock: socket.socket, group: str, interface: str = "0.0.0.0"):
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, _membership(group, interface)
+    )
+
+
+def wake_local_listeners(address: Tuple[str, int], interface: str = "0.0.0.0"):
+    # an empty datagram unblocks the recvfrom() of this host's sockets bound
+    # to the group; a TTL of 0 keeps it from leaving the host
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        set_multicast_sender(s, interface, ttl=0)
+        s.sendto(b"", address)
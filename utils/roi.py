@@ -0,0 +1,78 @@
+"""
+Region-of-interest encoding: the people and vehicles found by the object
+detector (utils/inference.py) keep their detail while the background is
+smoothed, so that the encoder spends few bytes on it. The frame stays an
+ordinary image in the session's codec, clients need nothing new.
+
+Detection runs every few frames only, the boxes found are kept in between,
+grown by a margin for the objects moving meanwhile.
+"""
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# (xmin, ymin, xmax, ymax) in pixels
+Box = Tuple[int, int, int, int]
+
+
+class RoiFilter:
+    # labels of the detector's model worth the bytes
+    DEFAULT_LABELS = ("person", "bicycle", "car", "motorcycle", "bus", "truck")
+    DETECT_EVERY = 6  # frames between two detections, 4 a second at 24 fps
+    MARGIN = 0.15  # share of a box's size added on every side
+    MAX_LEVEL = 4
+
+    def __init__(
+        self,
+        labels: Iterable[str] = DEFAULT_LABELS,
+        detect_every: int = DETECT_EVERY,
+        detector: Optional[Callable[[np.ndarray], List[Tuple[Box, str, float]]]] = None,
+    ) -> None:
+        if detector is None:
+            # loads the model: only servers encoding regions of interest
+            # need TensorFlow
+            from utils.inference import detect as detector
+        self._detect = detector
+        self.labels = set(labels)
+        self.detect_every = max(1, detect_every)
+        self.boxes: List[Box] = []
+        self._frames = 0
+
+    def reset(self):
+        # the next frame filtered is detected again
+        self._frames = 0
+
+    def regions(self, image: np.ndarray) -> List[Box]:
+        # boxes of the objects of interest, detected again every
+        # `detect_every` frames
+        if self._frames % self.detect_every == 0:
+            height, width = image.shape[:2]
+            self.boxes = [
+                self._grow(box, width, height)
+                for box, label, _ in self._detect(image)
+                if label in self.labels
+            ]
+        self._frames += 1
+        return self.boxes
+
+    def _grow(self, box: Box, width: int, height: int) -> Box:
+        xmin, ymin, xmax, ymax = box
+        dx, dy = int((xmax - xmin) * self.MARGIN), int((ymax - ymin) * self.MARGIN)
+        return max(0, xmin - dx), max(0, ymin - dy), min(width, xmax + dx), min(height, ymax + dy)
+
+    def apply(self, image: np.ndarray, level: int) -> np.ndarray:
+        # the background at 1/2, 1/4... of the resolution as the level rises,
+        # scaled back up, the regions of interest untouched
+        if level <= 0:
+            return image
+        boxes = self.regions(image)
+        factor = 2 ** min(level, self.MAX_LEVEL)
+        height, width = image.shape[:2]
+        small = cv2.resize(
+            image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA
+        )
+        filtered = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+        for xmin, ymin, xmax, ymax in boxes:
+            filtered[ymin:ymax, xmin:xmax] = image[ymin:ymax, xmin:xmax]
+        return filtered
@@ -8,9 +8,11 @@ header |V=2|P|    RC   |   PT=RR=201   |             length            |
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
        |                     SSRC of packet sender                     |
        +=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+
-report |                           fraction lost                       |
+report |                 SSRC_1 (SSRC of first source)                 |
 block  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-  1    |              cumulative number of packets lost                |
+  1    |                           fraction lost                       |
+       +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+       |              cumulative number of packets lost                |
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
        |           extended highest sequence number received           |
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
@@ -20,10 +22,55 @@ block  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
        |                   delay since last SR (DLSR)                  |
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+The server demultiplexes reports arriving on its single RTCP socket by SSRC_1,
+the SSRC of the RTP session being reported on.
+
+Receivers of a multicast group also send their reports to the group, and
+space them with `rtcp_interval()` so that the feedback traffic stays a fixed
+share of the session bandwidth whatever the number of members.
 """
 
 
-from struct import pack, unpack
+import math
+import random
+from struct import calcsize, pack, unpack
+
+
+# RFC 3550, section 6.2 and appendix A.7
+RTCP_BANDWIDTH_FRACTION = 0.05  # of the session bandwidth
+RTCP_SENDER_BW_FRACTION = 0.25
+RTCP_RCVR_BW_FRACTION = 1 - RTCP_SENDER_BW_FRACTION
+RTCP_MIN_TIME = 5.0  # seconds
+COMPENSATION = math.e - 1.5  # for the "timer reconsideration" randomization
+
+
+def rtcp_interval(
+    members: int,
+    senders: int,
+    rtcp_bw: float,
+    we_sent: bool,
+    avg_rtcp_size: float,
+    initial: bool = False,
+    min_time: float = RTCP_MIN_TIME,
+) -> float:
+    # seconds until the next report, per RFC 3550 appendix A.7. `rtcp_bw` is
+    # in bytes/s; `min_time` may be scaled down from the recommended 5s, the
+    # congestion controller here needs feedback several times a second
+    if initial:
+        min_time /= 2
+    n = members
+    if senders <= members * RTCP_SENDER_BW_FRACTION:
+        if we_sent:
+            rtcp_bw *= RTCP_SENDER_BW_FRACTION
+            n = senders
+        else:
+            rtcp_bw *= RTCP_RCVR_BW_FRACTION
+            n -= senders
+    t = avg_rtcp_size * n / rtcp_bw if rtcp_bw > 0 else 0
+    t = max(t, min_time)
+    # randomized so that the members don't report in lockstep
+    return t * (random.random() + 0.5) / COMPENSATION
 
 
 class InvalidRequest(Exception):
@@ -44,8 +91,15 @@ class RTCPPacket:
     SSRC = 0x00000000  # 32 bits -> Synchronization source identifier
 
     def __init__(
-        self, fraction_lost: float = None, cum_lost: int = None, highest_rcv: int = None
+        self,
+        fraction_lost: float = None,
+        cum_lost: int = None,
+        highest_rcv: int = None,
+        ssrc: int = SSRC,
+        source_ssrc: int = SSRC,
     ):
+        self.ssrc = ssrc  # SSRC of the receiver sending this report
+        self.source_ssrc = source_ssrc  # SSRC of the RTP stream being reported on
         self.fraction_lost = fraction_lost  # The fraction of RTP data pkt from sender lost since the previous RR packet was sent
         self.cum_lost = cum_lost  # The total number of RTP data packets from sender that have been lost since the beginning of reception
         self.highest_rcv = highest_rcv  # Highest sequence number received
@@ -55,19 +109,27 @@ class RTCPPacket:
         header[1] = self.PT & 0xFF
         header[2] = self.LENGTH >> 8
         header[3] = self.LENGTH & 0xFF
-        header[4] = self.SSRC >> 24
-        header[5] = self.SSRC >> 16
-        header[6] = self.SSRC >> 8
-        header[7] = self.SSRC & 0xFF
+        header[4] = (self.ssrc >> 24) & 0xFF
+        header[5] = (self.ssrc >> 16) & 0xFF
+        header[6] = (self.ssrc >> 8) & 0xFF
+        header[7] = self.ssrc & 0xFF
 
         self.header = bytes(header)
-        self.body = pack("fII", fraction_lost, cum_lost, highest_rcv)
+        self.body = pack("IfII", source_ssrc, fraction_lost, cum_lost, highest_rcv)
 
     @classmethod
     def from_bitstream(cls, data: bytes):
+        if len(data) != cls.HEADER_SIZE + calcsize("IfII"):
+            raise InvalidRequest(f"[Invalid RTCP packet]: {repr(data)}")
+        (ssrc,) = unpack("!I", data[4 : cls.HEADER_SIZE])
         body = data[cls.HEADER_SIZE :]
-        fraction_lost, cum_lost, highest_rcv = unpack("fII", body)
-        return cls(fraction_lost, cum_lost, highest_rcv)
+        source_ssrc, fraction_lost, cum_lost, highest_rcv = unpack("IfII", body)
+        return cls(fraction_lost, cum_lost, highest_rcv, ssrc, source_ssrc)
+
+    @staticmethod
+    def new_ssrc() -> int:
+        # zero is kept for "unset"
+        return random.randint(1, 0xFFFFFFFF)
 
     def __len__(self):
         return self.BODY_SIZE + self.HEADER_SIZE
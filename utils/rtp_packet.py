@@ -29,7 +29,14 @@ RTP Packet format is defined as: (per RFC 3550, section 5.1)
 	  = 12 + 60 + 4 + 0xFFFF
 	  = 76 + 0xFFFF
 	  = 65611 (0x1004B) bytes
+
+	Extensions use the one-byte header of RFC 8285: profile 0xBEDE, then per
+	element ID (4 bits) | length - 1 (4 bits) | data, padded to 32 bits.
 """
+import struct
+from typing import Dict, Optional
+
+
 class InvalidPacketException(Exception):
     pass
 
@@ -43,25 +50,40 @@ class RTPPacket:
     MARKER = 0b0       # 1 bit
     SSRC = 0x00000000  # 32 bits
 
+    # RFC 8285 one-byte header extensions
+    ONE_BYTE_PROFILE = 0xBEDE
+    # width and height (u16 each) of the full frame, sent when the payload
+    # was downscaled: the client scales it back for display
+    EXTENSION_FRAME_SIZE = 1
+
     class TYPE:
         MJPEG = 26
+        JPEG_TILES = 96  # dynamic, frames cut in tiles (utils/tiles.py)
+        WEBP = 97  # dynamic, see utils/codecs.py
+        PNG = 98  # dynamic
 
     def __init__(
             self,
             payload_type: int = None,
             sequence_number: int = None,
             timestamp: int = None,
-            payload: bytes = None
+            payload: bytes = None,
+            ssrc: int = SSRC,
+            extensions: Optional[Dict[int, bytes]] = None
         ):
 
         self.payload = payload
         self.payload_type = payload_type
         self.sequence_number = sequence_number
         self.timestamp = timestamp
+        self.ssrc = ssrc
+        # element ID -> data, 1 to 16 bytes each
+        self.extensions = extensions or {}
 
 
+        extension = 0b1 if self.extensions else self.EXTENSION
         header = [None] * self.HEADER_SIZE
-        header[0]  = (self.VERSION << 6) | (self.PADDING << 5) | (self.EXTENSION << 4) | self.CC
+        header[0]  = (self.VERSION << 6) | (self.PADDING << 5) | (extension << 4) | self.CC
         header[1]  = (self.MARKER << 7) | self.payload_type
         header[2]  = self.sequence_number >> 8
         header[3]  = self.sequence_number & 0xFF
@@ -69,13 +91,47 @@ class RTPPacket:
         header[5]  = (self.timestamp >> 16) & 0xFF
         header[6]  = (self.timestamp >>  8) & 0xFF
         header[7]  = (self.timestamp >>  0) & 0xFF
-        header[8]  = (self.SSRC >> 24) & 0xFF
-        header[9]  = (self.SSRC >> 16) & 0xFF
-        header[10] = (self.SSRC >>  8) & 0xFF
-        header[11] = (self.SSRC >>  0) & 0xFF
+        header[8]  = (self.ssrc >> 24) & 0xFF
+        header[9]  = (self.ssrc >> 16) & 0xFF
+        header[10] = (self.ssrc >>  8) & 0xFF
+        header[11] = (self.ssrc >>  0) & 0xFF
 
 
-        self.header = bytes(header)
+        self.header = bytes(header) + self._pack_extensions()
+
+    def _pack_extensions(self) -> bytes:
+        if not self.extensions:
+            return b""
+        elements = b"".join(
+            bytes([(element_id << 4) | (len(data) - 1)]) + data
+            for element_id, data in self.extensions.items()
+        )
+        elements += bytes(-len(elements) % 4)
+        return struct.pack("!HH", self.ONE_BYTE_PROFILE, len(elements) // 4) + elements
+
+    @classmethod
+    def _parse_extensions(cls, packet: bytes, offset: int):
+        # (extensions, offset of the payload); elements of other profiles
+        # are skipped
+        if len(packet) < offset + 4:
+            raise InvalidPacketException(f"[Invalid extension]: {repr(packet[:offset])}")
+        profile, length = struct.unpack_from("!HH", packet, offset)
+        start, end = offset + 4, offset + 4 + length * 4
+        if len(packet) < end:
+            raise InvalidPacketException(f"[Truncated extension]: {repr(packet[:offset])}")
+        extensions = {}
+        pos = start
+        while profile == cls.ONE_BYTE_PROFILE and pos < end:
+            element_id, size = packet[pos] >> 4, (packet[pos] & 0x0F) + 1
+            if element_id == 0:
+                # padding
+                pos += 1
+                continue
+            if element_id == 15:
+                break
+            extensions[element_id] = packet[pos + 1:pos + 1 + size]
+            pos += 1 + size
+        return extensions, end
 
 
     @classmethod
@@ -84,7 +140,12 @@ class RTPPacket:
             raise InvalidPacketException(f"[Invalid packet]: {repr(packet)}")
 
         header = packet[:cls.HEADER_SIZE]
-        payload = packet[cls.HEADER_SIZE:]
+        # CSRCs are not kept, only skipped
+        offset = cls.HEADER_SIZE + (header[0] & 0x0F) * 4
+        extensions = {}
+        if header[0] & 0x10:
+            extensions, offset = cls._parse_extensions(packet, offset)
+        payload = packet[offset:]
 
         payload_type = header[1] & 0x7F
         
@@ -92,12 +153,16 @@ class RTPPacket:
         
         timestamp = header[4] << 24 | header[5] << 16 | header[6] << 8 | header[7] << 0
 
+        ssrc = header[8] << 24 | header[9] << 16 | header[10] << 8 | header[11] << 0
+
 
         return cls(
             payload_type,
             sequence_number,
             timestamp,
-            payload
+            payload,
+            ssrc,
+            extensions
         )
 
     def get_packet(self) -> bytes:
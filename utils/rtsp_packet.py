@@ -1,64 +1,117 @@
-from typing import Optional
-
-
-def KMP_String(pattern, text):
-    a = len(text)
-    b = len(pattern)
-    prefix_arr = get_prefix_arr(pattern, b)
-  
-    initial_point = []
-    m = 0
-    n = 0
-  
-    while m != a:
-       
-        if text[m] == pattern[n]:
-            m += 1
-            n += 1
-      
-        else:
-            n = prefix_arr[n-1]
-       
-        if n == b:
-            initial_point.append(m-n)
-            n = prefix_arr[n-1]
-        elif n == 0:
-            m += 1
-   
-    return initial_point
-def get_prefix_arr(pattern, b):
-    prefix_arr = [0] * b
-    n = 0
-    m = 1
-    while m != b:
-        if pattern[m] == pattern[n]:
-            n += 1
-            prefix_arr[m] = n
-            m += 1
-        elif n != 0:
-                n = prefix_arr[n-1]
-        else:
-            prefix_arr[m] = 0
-            m += 1
-    return prefix_arr
+from typing import List, Optional, Tuple, Union
 
+from utils.rtsp_parser import InvalidRTSPMessage, RTSPMessage, parse_message, transport_params
 
 
+# PLAY range in seconds: (start, end), start None for "now", end None for
+# the end of the stream
+NptRange = Tuple[Optional[float], Optional[float]]
+# simulcast layer: (downscale, SSRC, (group, RTP port))
+SimulcastLayer = Tuple[int, int, Tuple[str, int]]
+
+
+def _parse_channels(channels: Optional[str]) -> Optional[Tuple[int, int]]:
+    # "<rtp>-<rtcp>", None when the parameter is absent
+    if channels is None:
+        return None
+    rtp_channel, rtcp_channel = channels.split("-")
+    return int(rtp_channel), int(rtcp_channel)
+
+
+def _parse_npt_range(value: Optional[str]) -> Optional[NptRange]:
+    # "npt=<start>-[<end>]" in seconds, start None for "now"
+    if value is None:
+        return None
+    units, _, times = value.partition("=")
+    if units.strip() != "npt":
+        raise ValueError(f"unsupported range units: {value!r}")
+    start, _, end = times.partition("-")
+    start, end = start.strip(), end.strip()
+    return (None if start == "now" else float(start)), (float(end) if end else None)
+
+
+def _format_npt_range(npt_range: NptRange) -> str:
+    start, end = npt_range
+    start = "now" if start is None else f"{start:.3f}"
+    return f"npt={start}-" + ("" if end is None else f"{end:.3f}")
+
+
+def _parse_codecs(value: Optional[str]) -> Optional[List[str]]:
+    # "WEBP;quality=70, JPEG" -> ["WEBP;quality=70", "JPEG"]
+    if value is None:
+        return None
+    return [codec.strip() for codec in value.split(",") if codec.strip()]
+
+
+def _parse_layers(value: Optional[str]) -> Optional[List[SimulcastLayer]]:
+    # "1;ssrc=<SSRC>;destination=<GROUP>;port=<RTP_PORT>, 2;ssrc=..."
+    if value is None:
+        return None
+    layers = []
+    for layer in value.split(","):
+        downscale, params = transport_params(layer.strip())
+        layers.append(
+            (int(downscale), int(params["ssrc"], 16), (params["destination"], int(params["port"])))
+        )
+    return layers
+
+
+def _format_layers(layers: List[SimulcastLayer]) -> str:
+    return ", ".join(
+        f"{downscale};ssrc={ssrc:08X};destination={group};port={port}"
+        for downscale, ssrc, (group, port) in layers
+    )
+
+
+def _parse_play_headers(message: RTSPMessage) -> Tuple[Optional[NptRange], Optional[float]]:
+    scale = message.header("Scale")
+    return _parse_npt_range(message.header("Range")), None if scale is None else float(scale)
 
 
 class InvalidRTSPRequest(Exception):
     pass
 
 
+class RTSPStatusError(Exception):
+    # the server answered with something else than 200 OK
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(f"{status_code} {reason}")
+        self.status_code = status_code
+        self.reason = reason
+
+
 class RTSPPacket:
     RTSP_VERSION = 'RTSP/1.0'
 
     INVALID = -1
+    OPTIONS = 'OPTIONS'
+    DESCRIBE = 'DESCRIBE'
     SETUP = 'SETUP'
     PLAY = 'PLAY'
     PAUSE = 'PAUSE'
     TEARDOWN = 'TEARDOWN'
+    GET_PARAMETER = 'GET_PARAMETER'  # keep-alive
     RESPONSE = 'RESPONSE'
+    # methods the server implements, listed in the OPTIONS response
+    METHODS = [OPTIONS, DESCRIBE, SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER]
+
+    OK = 200
+    UNSUPPORTED_MEDIA_TYPE = 415
+    NOT_ENOUGH_BANDWIDTH = 453
+    SESSION_NOT_FOUND = 454
+    SERVICE_UNAVAILABLE = 503
+    REASONS = {
+        OK: 'OK',
+        UNSUPPORTED_MEDIA_TYPE: 'Unsupported Media Type',
+        NOT_ENOUGH_BANDWIDTH: 'Not Enough Bandwidth',
+        SESSION_NOT_FOUND: 'Session Not Found',
+        SERVICE_UNAVAILABLE: 'Service Unavailable',
+    }
+
+    # lower transports selectable in SETUP
+    TRANSPORT_UDP = 'RTP/UDP'
+    TRANSPORT_TCP = 'RTP/AVP/TCP'
+    TRANSPORT_MULTICAST = 'RTP/AVP;multicast'
 
     def __init__(
             self,
@@ -66,7 +119,24 @@ class RTSPPacket:
             video_file_path: Optional[str] = None,
             sequence_number: Optional[int] = None,
             dst_port: Optional[int] = None,
-            session_id: Optional[str] = None
+            session_id: Optional[str] = None,
+            blocksize: Optional[int] = None,
+            ssrc: Optional[int] = None,
+            server_port: Optional[int] = None,
+            interleaved: Optional[Tuple[int, int]] = None,
+            multicast: bool = False,
+            destination: Optional[Tuple[str, int]] = None,
+            ttl: Optional[int] = None,
+            status_code: int = OK,
+            timeout: Optional[int] = None,
+            public: Optional[List[str]] = None,
+            content_type: Optional[str] = None,
+            body: Optional[str] = None,
+            npt_range: Optional[NptRange] = None,
+            scale: Optional[float] = None,
+            tile_size: Optional[int] = None,
+            codecs: Optional[List[str]] = None,
+            layers: Optional[List[SimulcastLayer]] = None
         ):
         self.request_type = request_type
         self.video_file_path = video_file_path
@@ -75,6 +145,45 @@ class RTSPPacket:
 
         # if request_type SETUP
         self.rtp_dst_port = dst_port
+        # maximum RTP datagram size, asked for by the client in SETUP
+        # and answered with the size the server settled on
+        self.blocksize = blocksize
+        # if request_type RESPONSE to SETUP: SSRC of the session's RTP stream
+        # and the server port expecting its RTCP reports
+        self.ssrc = ssrc
+        self.server_port = server_port
+        # RTP and RTCP channels when media is interleaved on the RTSP connection
+        self.interleaved = interleaved
+        # multicast delivery: the group address and RTP port (RTCP on the next
+        # port) and its TTL are given in the response
+        self.multicast = multicast
+        self.destination = destination
+        self.ttl = ttl
+        # if request_type RESPONSE: status, and seconds the session survives
+        # without any request or RTCP report from the client
+        self.status_code = status_code
+        self.timeout = timeout
+        # if request_type RESPONSE to OPTIONS: the methods supported, and to
+        # DESCRIBE: the session description
+        self.public = public
+        self.content_type = content_type
+        self.body = body
+        # if request_type PLAY: where to play from and up to, in seconds, and
+        # the speed (negative plays backwards); in its response: what the
+        # server actually does
+        self.npt_range = npt_range
+        self.scale = scale
+        # SETUP asking for tiled frames (see utils/tiles.py) and its response
+        # when the server agreed: the tile size, in pixels
+        self.tile_size = tile_size
+        # SETUP: the payload codecs the client accepts, by preference, as
+        # "<NAME>[;<PARAM>=<VALUE>]" (see utils/codecs.py); its response:
+        # those the server agreed to, the first one streamed
+        self.codecs = codecs
+        # RESPONSE to a multicast SETUP when the group is simulcast: every
+        # layer of the stream, the full size one first, each on its own
+        # group with its own SSRC (see server/multicast.py)
+        self.layers = layers
 
     def __str__(self):
         return (f"RTSPPacket({self.request_type}, "
@@ -84,119 +193,273 @@ class RTSPPacket:
                 f"{self.session_id})")
 
     @classmethod
-    def from_response(cls, response: bytes):
+    def from_response(cls, response: Union[bytes, RTSPMessage]):
         # only response format implemented, taken from server class:
         # """
-        #   <RTSP_VERSION> 200 OK\r\n
+        #   <RTSP_VERSION> <STATUS_CODE> <REASON>\r\n
         #   CSeq: <SEQUENCE_NUMBER>\r\n
-        #   Session: <SESSION_ID>\r\n
+        #   Session: <SESSION_ID>[;timeout=<SECONDS>]\r\n
+        #   [Blocksize: <DATAGRAM_SIZE>\r\n]
+        #   [X-Tiles: <TILE_SIZE>\r\n]
+        #   [X-Codecs: <CODEC>[, <CODEC>...]\r\n]
+        #   [X-Simulcast: <DOWNSCALE>;ssrc=<SSRC>;destination=<GROUP>;port=<RTP_PORT>[, ...]\r\n]
+        #   [Transport: RTP/UDP;client_port=<RTP_PORT>;server_port=<RTCP_PORT>;ssrc=<SSRC>\r\n]
+        #   [Transport: RTP/AVP/TCP;interleaved=<RTP_CHANNEL>-<RTCP_CHANNEL>;ssrc=<SSRC>\r\n]
+        #   [Transport: RTP/AVP;multicast;destination=<GROUP>;port=<RTP_PORT>-<RTCP_PORT>;ttl=<TTL>;ssrc=<SSRC>\r\n]
+        #   [Public: <METHOD>, <METHOD>, ...\r\n]
+        #   [Range: npt=<START>-[<END>]\r\n]
+        #   [Scale: <SCALE>\r\n]
+        #   [Content-Type: <TYPE>\r\n
+        #    Content-Length: <LENGTH>\r\n]
+        #   \r\n
+        #   [<BODY>]
         # """
+        try:
+            message = response if isinstance(response, RTSPMessage) else parse_message(response)
+        except InvalidRTSPMessage as e:
+            raise Exception(f"[RTSP response] parsing fail: {e}")
 
-        
-        RTSP_index =  KMP_String(b"RTSP", response) 
-        status_index =  KMP_String(b"200 OK\r\n", response)
-        CSeq_index =  KMP_String(b"CSeq: ", response)
-        CSeq_end_index = KMP_String(b"\r\nSession: ", response)
-
-        Session_index =  KMP_String(b"Session: ", response) 
-        Sessionend_index =  KMP_String(b"\r\n", response) 
-
-        if (len(RTSP_index) * len(status_index) * len(CSeq_index) * len(Session_index) == 0 ):
-            raise Exception(f"[RTSP response] parsing fail: {response}")
+        version, _, status = message.start_line.partition(" ")
+        sequence_number = message.header("CSeq")
+        session = message.header("Session")
+        if version != cls.RTSP_VERSION or sequence_number is None or session is None:
+            raise Exception(f"[RTSP response] parsing fail: {message}")
 
-    
-        sequence_number = response[CSeq_index[0]+6 : CSeq_end_index[0]].decode()
-        session_id = response[Session_index[0]+9 : Sessionend_index[len(Sessionend_index)-1]].decode()
+        try:
+            status_code = int(status.partition(" ")[0])
+        except ValueError:
+            raise Exception(f"[status code] parsing fail: {message}")
+        session_id, _, session_params = session.partition(";")
+        timeout = None
+        if session_params.startswith("timeout="):
+            try:
+                timeout = int(session_params[8:])
+            except ValueError:
+                raise Exception(f"[session timeout] parsing fail: {message}")
 
+        blocksize = message.header("Blocksize")
+        if blocksize is not None:
+            try:
+                blocksize = int(blocksize)
+            except ValueError:
+                raise Exception(f"[blocksize] parsing fail: {message}")
 
+        tile_size = message.header("X-Tiles")
+        if tile_size is not None:
+            try:
+                tile_size = int(tile_size)
+            except ValueError:
+                raise Exception(f"[tile size] parsing fail: {message}")
 
+        codecs = _parse_codecs(message.header("X-Codecs"))
 
+        try:
+            layers = _parse_layers(message.header("X-Simulcast"))
+        except (KeyError, ValueError):
+            raise Exception(f"[simulcast] parsing fail: {message}")
+
+        ssrc = None
+        server_port = None
+        interleaved = None
+        multicast = False
+        destination = None
+        ttl = None
+        transport = message.header("Transport")
+        if transport is not None:
+            _, params = transport_params(transport)
+            multicast = "multicast" in params
+            try:
+                if params.get("ssrc") is not None:
+                    ssrc = int(params["ssrc"], 16)
+                if params.get("server_port") is not None:
+                    server_port = int(params["server_port"])
+                interleaved = _parse_channels(params.get("interleaved"))
+                if multicast and params.get("destination") and params.get("port"):
+                    destination = params["destination"], int(params["port"].split("-")[0])
+                if params.get("ttl") is not None:
+                    ttl = int(params["ttl"])
+            except ValueError:
+                raise Exception(f"[transport] parsing fail: {message}")
 
         try:
             sequence_number = int(sequence_number)
-        except (ValueError, TypeError):
-            raise Exception(f"[sequence number] parsing fail: {response}")
+        except ValueError:
+            raise Exception(f"[sequence number] parsing fail: {message}")
 
-        if session_id is None:
-            raise Exception(f"[session id] parsing fail: {response}")
+        public = message.header("Public")
+        if public is not None:
+            public = [method.strip() for method in public.split(",")]
+
+        try:
+            npt_range, scale = _parse_play_headers(message)
+        except ValueError:
+            raise Exception(f"[range/scale] parsing fail: {message}")
 
         return cls(
             request_type=RTSPPacket.RESPONSE,
             sequence_number=sequence_number,
-            session_id=session_id
+            session_id=session_id,
+            blocksize=blocksize,
+            ssrc=ssrc,
+            server_port=server_port,
+            interleaved=interleaved,
+            multicast=multicast,
+            destination=destination,
+            ttl=ttl,
+            status_code=status_code,
+            timeout=timeout,
+            public=public,
+            content_type=message.header("Content-Type"),
+            body=message.body.decode() if message.body else None,
+            npt_range=npt_range,
+            scale=scale,
+            tile_size=tile_size,
+            codecs=codecs,
+            layers=layers
         )
 
     @classmethod
-    def build_response(cls, sequence_number: int, session_id: str):
-        response = '\r\n'.join((
-            f"{cls.RTSP_VERSION} 200 OK",
+    def build_response(
+            cls,
+            sequence_number: int,
+            session_id: str,
+            blocksize: Optional[int] = None,
+            client_port: Optional[int] = None,
+            server_port: Optional[int] = None,
+            ssrc: Optional[int] = None,
+            interleaved: Optional[Tuple[int, int]] = None,
+            destination: Optional[Tuple[str, int]] = None,
+            ttl: Optional[int] = None,
+            status_code: int = OK,
+            timeout: Optional[int] = None,
+            public: Optional[List[str]] = None,
+            content_type: Optional[str] = None,
+            body: Optional[str] = None,
+            npt_range: Optional[NptRange] = None,
+            scale: Optional[float] = None,
+            tile_size: Optional[int] = None,
+            codecs: Optional[List[str]] = None,
+            layers: Optional[List[SimulcastLayer]] = None
+        ):
+        session = session_id if timeout is None else f"{session_id};timeout={timeout}"
+        response_lines = [
+            f"{cls.RTSP_VERSION} {status_code} {cls.REASONS[status_code]}",
             f"CSeq: {sequence_number}",
-            f"Session: {session_id}",
-        )) + '\r\n'
+            f"Session: {session}",
+        ]
+        if blocksize is not None:
+            response_lines.append(f"Blocksize: {blocksize}")
+        if tile_size is not None:
+            response_lines.append(f"X-Tiles: {tile_size}")
+        if codecs:
+            response_lines.append(f"X-Codecs: {', '.join(codecs)}")
+        if layers:
+            response_lines.append(f"X-Simulcast: {_format_layers(layers)}")
+        if ssrc is not None and interleaved is not None:
+            response_lines.append(
+                f"Transport: {cls.TRANSPORT_TCP};interleaved={interleaved[0]}-{interleaved[1]};ssrc={ssrc:08X}"
+            )
+        elif ssrc is not None and destination is not None:
+            group, port = destination
+            response_lines.append(
+                f"Transport: {cls.TRANSPORT_MULTICAST};destination={group};port={port}-{port + 1};ttl={ttl};ssrc={ssrc:08X}"
+            )
+        elif ssrc is not None:
+            response_lines.append(
+                f"Transport: {cls.TRANSPORT_UDP};client_port={client_port};server_port={server_port};ssrc={ssrc:08X}"
+            )
+        if public is not None:
+            response_lines.append(f"Public: {', '.join(public)}")
+        if npt_range is not None:
+            response_lines.append(f"Range: {_format_npt_range(npt_range)}")
+        if scale is not None:
+            response_lines.append(f"Scale: {scale:g}")
+        if body is not None:
+            response_lines.append(f"Content-Type: {content_type}")
+            response_lines.append(f"Content-Length: {len(body.encode())}")
+        # the empty line ends the head, media may follow on the connection
+        response = '\r\n'.join(response_lines) + '\r\n\r\n' + (body or '')
         return response
 
     @classmethod
-    def from_request(cls, request: bytes):
-
-        request_type_endindex =  KMP_String(b" rtsp://", request)      
-        RTSP_index =  KMP_String(b"RTSP", request)  
-        CSeq_index =  KMP_String(b"CSeq: ", request) 
-        endindex = KMP_String(b"\r\n", request)
-
-        if (len(request_type_endindex) * len(RTSP_index) * len(CSeq_index) * len(endindex) == 0 ):
-            raise InvalidRTSPRequest(f"[request] parsing fail: {request}")
-
-        request_type = request[    : request_type_endindex[0] ].decode()
-
-
-        if request_type not in (RTSPPacket.SETUP,
-                                RTSPPacket.PLAY,
-                                RTSPPacket.PAUSE,
-                                RTSPPacket.TEARDOWN):
-            raise InvalidRTSPRequest(f"[invalid request type]: {request}")
-
-
-        video_file_path = request[request_type_endindex[0]+8 : RTSP_index[0] -1 ].decode()
-        sequence_number = request[CSeq_index[0]+6 : endindex[1] ].decode()
-
-        
+    def from_request(cls, request: Union[bytes, RTSPMessage]):
+        try:
+            message = request if isinstance(request, RTSPMessage) else parse_message(request)
+        except InvalidRTSPMessage as e:
+            raise InvalidRTSPRequest(f"[request] parsing fail: {e}")
+
+        request_line = message.start_line.split(" ")
+        sequence_number = message.header("CSeq")
+        if (len(request_line) != 3 or not request_line[1].startswith("rtsp://")
+                or not request_line[2].startswith("RTSP") or sequence_number is None):
+            raise InvalidRTSPRequest(f"[request] parsing fail: {message}")
+
+        request_type, url, _ = request_line
+        if request_type not in RTSPPacket.METHODS:
+            raise InvalidRTSPRequest(f"[invalid request type]: {message}")
+        video_file_path = url[len("rtsp://"):]
+        session_id = message.header("Session")
+
+        blocksize = message.header("Blocksize")
+        if blocksize is not None:
+            try:
+                blocksize = int(blocksize)
+            except ValueError:
+                raise InvalidRTSPRequest(f"[blocksize] parsing fail: {message}")
 
-        Session_index =  KMP_String(b"Session: ", request)
-        client_port_index = KMP_String(b"client_port", request)
+        tile_size = message.header("X-Tiles")
+        if tile_size is not None:
+            try:
+                tile_size = int(tile_size)
+            except ValueError:
+                raise InvalidRTSPRequest(f"[tile size] parsing fail: {message}")
 
-    
+        codecs = _parse_codecs(message.header("X-Codecs"))
 
-        session_id = None
         dst_port = None
-
-        if ( len(Session_index) != 0):
-            session_id = request[ Session_index[0]+9 : endindex[2] ].decode()
-        if ( len(client_port_index) != 0):
-            dst_port = request[ client_port_index[0]+12 : endindex[2] ].decode()
-
-
-
-
-
-
-
-
-        if request_type == RTSPPacket.SETUP:
+        interleaved = None
+        multicast = False
+        transport = message.header("Transport")
+        if transport is not None:
+            spec, params = transport_params(transport)
+            multicast = "multicast" in params
+            try:
+                interleaved = _parse_channels(params.get("interleaved"))
+            except ValueError:
+                raise InvalidRTSPRequest(f"[interleaved channels] parsing fail: {message}")
+            if request_type == RTSPPacket.SETUP and spec == cls.TRANSPORT_TCP:
+                if interleaved is None:
+                    raise InvalidRTSPRequest(f"[interleaved channels] missing: {message}")
+            elif request_type == RTSPPacket.SETUP and not multicast:
+                dst_port = params.get("client_port")
+        if request_type == RTSPPacket.SETUP and interleaved is None and not multicast:
             try:
                 dst_port = int(dst_port)
             except (ValueError, TypeError):
                 raise InvalidRTSPRequest(f"[RTP port] parsing fail")
         try:
             sequence_number = int(sequence_number)
-        except (ValueError, TypeError):
-            raise InvalidRTSPRequest(f"[sequence number] parsing fail: {request}")
+        except ValueError:
+            raise InvalidRTSPRequest(f"[sequence number] parsing fail: {message}")
+
+        try:
+            npt_range, scale = _parse_play_headers(message)
+        except ValueError:
+            raise InvalidRTSPRequest(f"[range/scale] parsing fail: {message}")
 
         return cls(
             request_type,
             video_file_path,
             sequence_number,
             dst_port,
-            session_id
+            session_id,
+            blocksize,
+            interleaved=interleaved,
+            multicast=multicast,
+            npt_range=npt_range,
+            scale=scale,
+            tile_size=tile_size,
+            codecs=codecs
         )
 
     def to_request(self) -> bytes:
@@ -214,14 +477,50 @@ class RTSPPacket:
             f"CSeq: {self.sequence_number}",
         ]
         if self.request_type == self.SETUP:
-            if self.rtp_dst_port is None:
+            if self.interleaved is not None:
+                request_lines.append(
+                    f"Transport: {self.TRANSPORT_TCP};interleaved={self.interleaved[0]}-{self.interleaved[1]}"
+                )
+            elif self.multicast:
+                request_lines.append(
+                    f"Transport: {self.TRANSPORT_MULTICAST}"
+                )
+            elif self.rtp_dst_port is None:
                 raise InvalidRTSPRequest(f"[RTP destination port missing]: {self}")
+            else:
+                request_lines.append(
+                    f"Transport: {self.TRANSPORT_UDP};client_port={self.rtp_dst_port}"
+                )
+            if self.blocksize is not None:
+                request_lines.append(
+                    f"Blocksize: {self.blocksize}"
+                )
+            if self.tile_size is not None:
+                request_lines.append(
+                    f"X-Tiles: {self.tile_size}"
+                )
+            if self.codecs:
+                request_lines.append(
+                    f"X-Codecs: {', '.join(self.codecs)}"
+                )
+        elif self.session_id:
+            # none before SETUP, nor in a PLAY pipelined behind it: the
+            # server keeps a single session per connection
             request_lines.append(
-                f"Transport: RTP/UDP;client_port={self.rtp_dst_port}"
+                f"Session: {self.session_id}"
             )
-        else:
+        if self.request_type == self.PLAY and self.npt_range is not None:
             request_lines.append(
-                f"Session: {self.session_id}"
+                f"Range: {_format_npt_range(self.npt_range)}"
+            )
+        if self.request_type == self.PLAY and self.scale is not None:
+            request_lines.append(
+                f"Scale: {self.scale:g}"
+            )
+        if self.request_type == self.DESCRIBE:
+            request_lines.append(
+                "Accept: application/sdp"
             )
-        request = '\r\n'.join(request_lines) + '\r\n'
+        # the empty line ends the message, media may follow on the connection
+        request = '\r\n'.join(request_lines) + '\r\n\r\n'
         return request.encode()
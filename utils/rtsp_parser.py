@@ -0,0 +1,125 @@
+"""
+Incremental RTSP message framing and parsing (RFC 2326, section 4):
+
+    <start line>\r\n
+    <Header>: <value>\r\n
+    ...
+    \r\n
+    [<Content-Length> bytes of body]
+
+Bytes are fed as they come off the connection, whatever the TCP segmentation:
+a message may arrive in several pieces, and several (pipelined) messages may
+arrive in one. Each head is decoded and split into its headers in one pass.
+"""
+from typing import Dict, Optional, Tuple
+
+
+MESSAGE_END = b"\r\n\r\n"
+# a head that long without its empty line is not RTSP
+MAX_HEAD_SIZE = 16384
+
+
+class InvalidRTSPMessage(Exception):
+    pass
+
+
+class RTSPMessage:
+    __slots__ = ("start_line", "headers", "body")
+
+    def __init__(self, start_line: str, headers: Dict[str, str], body: bytes = b"") -> None:
+        self.start_line = start_line
+        # header names are case-insensitive, keys are lower-cased
+        self.headers = headers
+        self.body = body
+
+    def header(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.headers.get(name.lower(), default)
+
+    def __repr__(self):
+        return f"RTSPMessage({self.start_line!r}, {self.headers!r}, {len(self.body)} bytes)"
+
+
+def parse_head(head: bytes) -> Tuple[str, Dict[str, str]]:
+    # the head without its empty line: start line and headers
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise InvalidRTSPMessage(f"[header] parsing fail: {line!r}")
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def parse_message(data: bytes) -> RTSPMessage:
+    # a single complete message
+    parser = RTSPParser()
+    parser.feed(data)
+    message = parser.next()
+    if message is None:
+        raise InvalidRTSPMessage(f"[message] incomplete: {data!r}")
+    return message
+
+
+def transport_params(transport: str) -> Tuple[str, Dict[str, Optional[str]]]:
+    # "RTP/AVP;multicast;ttl=1" -> ("RTP/AVP", {"multicast": None, "ttl": "1"})
+    spec, *params = transport.split(";")
+    values = {}
+    for param in params:
+        name, sep, value = param.partition("=")
+        values[name.strip()] = value.strip() if sep else None
+    return spec.strip(), values
+
+
+class RTSPParser:
+    # frames the bytes read from an RTSP connection into messages
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        # head of a message still waiting for its body
+        self._pending: Optional[RTSPMessage] = None
+        self._body_length = 0
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+    def next(self) -> Optional[RTSPMessage]:
+        # the next complete message, None until more data has been fed
+        if self._pending is None and not self._parse_head():
+            return None
+        if len(self._buffer) < self._body_length:
+            return None
+        message, self._pending = self._pending, None
+        if self._body_length:
+            message.body = bytes(self._buffer[:self._body_length])
+            del self._buffer[:self._body_length]
+        return message
+
+    def __iter__(self):
+        # every complete message buffered so far
+        message = self.next()
+        while message is not None:
+            yield message
+            message = self.next()
+
+    def _parse_head(self) -> bool:
+        # empty lines between messages are allowed
+        start = 0
+        while self._buffer.startswith(b"\r\n", start):
+            start += 2
+        end = self._buffer.find(MESSAGE_END, start)
+        if end == -1:
+            del self._buffer[:start]
+            if len(self._buffer) > MAX_HEAD_SIZE:
+                raise InvalidRTSPMessage(f"[message] no end within {MAX_HEAD_SIZE} bytes")
+            return False
+        start_line, headers = parse_head(bytes(self._buffer[start:end]))
+        del self._buffer[:end + len(MESSAGE_END)]
+        try:
+            self._body_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise InvalidRTSPMessage(f"[content length] parsing fail: {headers}")
+        if self._body_length < 0:
+            raise InvalidRTSPMessage(f"[content length] negative: {headers}")
+        self._pending = RTSPMessage(start_line, headers)
+        return True
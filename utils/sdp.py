@@ -0,0 +1,100 @@
+"""
+Session description answered to DESCRIBE (RFC 4566), limited to what this
+server streams: a single video track, in the codec streamed by default and
+the other ones a client may ask for in SETUP (utils/codecs.py).
+
+    v=0
+    o=- <SESSION_ID> 1 IN IP4 <HOST>
+    s=<SOURCE>
+    t=0 0
+    a=range:npt=0-<DURATION>       (npt=now- for a live source)
+    m=video 0 RTP/AVP <PAYLOAD_TYPE> [<PAYLOAD_TYPE>...]
+    a=rtpmap:<PAYLOAD_TYPE> <CODEC>/<CLOCK_RATE>      (for each payload type)
+    a=framerate:<FPS>
+    a=x-dimensions:<WIDTH>,<HEIGHT>
+"""
+from typing import Dict, Optional
+
+
+class MediaDescription:
+    CONTENT_TYPE = "application/sdp"
+
+    def __init__(
+        self,
+        codec: str,
+        payload_type: int,
+        clock_rate: int,
+        width: int,
+        height: int,
+        fps: float,
+        duration: Optional[float] = None,
+        title: str = "-",
+        formats: Optional[Dict[int, str]] = None,
+    ):
+        self.codec = codec
+        self.payload_type = payload_type
+        # every codec of the track by payload type, the default one first
+        self.formats = {payload_type: codec}
+        self.formats.update(formats or {})
+        self.clock_rate = clock_rate
+        self.width = width
+        self.height = height
+        self.fps = fps
+        # seconds, None for a live source
+        self.duration = duration
+        self.title = title
+
+    def __str__(self):
+        return (f"MediaDescription({self.codec}, "
+                f"{self.width}x{self.height}, "
+                f"{self.fps} fps, "
+                f"{'live' if self.duration is None else f'{self.duration:.3f} s'})")
+
+    def to_sdp(self, session_id: str, host: str) -> str:
+        npt = "now-" if self.duration is None else f"0-{self.duration:.3f}"
+        lines = [
+            "v=0",
+            f"o=- {session_id} 1 IN IP4 {host}",
+            f"s={self.title}",
+            "t=0 0",
+            f"a=range:npt={npt}",
+            f"m=video 0 RTP/AVP {' '.join(str(pt) for pt in self.formats)}",
+            *(f"a=rtpmap:{pt} {codec}/{self.clock_rate}" for pt, codec in self.formats.items()),
+            f"a=framerate:{self.fps:g}",
+            f"a=x-dimensions:{self.width},{self.height}",
+        ]
+        return "\r\n".join(lines) + "\r\n"
+
+    @classmethod
+    def from_sdp(cls, sdp: str):
+        fields = {"title": "-", "duration": None}
+        formats = {}
+        for line in sdp.splitlines():
+            kind, _, value = line.partition("=")
+            if kind == "s":
+                fields["title"] = value
+            elif kind == "m":
+                fields["payload_type"] = int(value.split()[3])
+            elif kind == "a":
+                name, _, value = value.partition(":")
+                if name == "rtpmap":
+                    payload_type, encoding = value.split()[:2]
+                    codec, clock_rate = encoding.split("/")[:2]
+                    formats[int(payload_type)] = codec
+                    fields["clock_rate"] = int(clock_rate)
+                elif name == "framerate":
+                    fields["fps"] = float(value)
+                elif name == "x-dimensions":
+                    width, height = value.split(",")
+                    fields["width"], fields["height"] = int(width), int(height)
+                elif name == "range" and value.startswith("npt="):
+                    start, _, end = value[4:].partition("-")
+                    if start != "now" and end:
+                        fields["duration"] = float(end) - float(start)
+        if fields.get("payload_type") in formats:
+            fields["codec"] = formats[fields["payload_type"]]
+            fields["formats"] = formats
+        missing = {"codec", "payload_type", "clock_rate", "width", "height", "fps"} - fields.keys()
+        if missing:
+            raise ValueError(f"[SDP] missing {', '.join(sorted(missing))}: {sdp!r}")
+        return cls(**fields)
@@ -0,0 +1,68 @@
+from threading import Condition
+from typing import Optional
+
+
+class InvalidStateTransition(Exception):
+    pass
+
+
+# ===========================
+# RTSP session state shared by the threads of one session. Workers block on
+# it instead of polling, and every transition wakes them up immediately.
+# ===========================
+class SessionState:
+    INIT = 0
+    PAUSED = 1
+    PLAYING = 2
+    FINISHED = 3
+    TEARDOWN = 4
+
+    NAMES = {
+        INIT: "INIT",
+        PAUSED: "PAUSED",
+        PLAYING: "PLAYING",
+        FINISHED: "FINISHED",
+        TEARDOWN: "TEARDOWN",
+    }
+
+    TRANSITIONS = {
+        INIT: {PAUSED, TEARDOWN},
+        PAUSED: {PLAYING, TEARDOWN},
+        PLAYING: {PAUSED, FINISHED, TEARDOWN},
+        FINISHED: {PAUSED, PLAYING, TEARDOWN},
+        TEARDOWN: set(),
+    }
+
+    def __init__(self) -> None:
+        self._state = self.INIT
+        self._condition = Condition()
+
+    @property
+    def state(self) -> int:
+        return self._state
+
+    def set(self, state: int) -> bool:
+        # returns False when the session already is in `state`
+        with self._condition:
+            if state == self._state:
+                return False
+            if state not in self.TRANSITIONS[self._state]:
+                raise InvalidStateTransition(
+                    f"{self.NAMES[self._state]} -> {self.NAMES[state]}"
+                )
+            self._state = state
+            self._condition.notify_all()
+            return True
+
+    def wait_for(self, *states: int, timeout: Optional[float] = None) -> int:
+        # block until the session enters one of `states` (or `timeout` expires)
+        with self._condition:
+            self._condition.wait_for(lambda: self._state in states, timeout)
+            return self._state
+
+    def wait_while(self, state: int, timeout: Optional[float] = None) -> int:
+        # block while the session stays in `state`, at most `timeout` seconds;
+        # used as an interruptible sleep by the pacing loops
+        with self._condition:
+            self._condition.wait_for(lambda: self._state != state, timeout)
+            return self._state
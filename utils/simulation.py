@@ -0,0 +1,195 @@
+"""
+A server session and its client run against a simulated network on a
+virtual clock (see utils/clock.py and utils/impairment.py): no socket and
+no thread, the steps the send thread and the RTCP thread would take are
+events scheduled at the times they would happen, and the datagrams between
+the two go through a `Link` each way. Time jumps from one event to the
+next, so a session plays out as fast as the frames are encoded, and the
+same seed always gives the same reports, congestion levels and send
+delays:
+
+    simulation = Simulation("video.mp4", Profile(loss=Bernoulli(0.05)), seed=1)
+    simulation.run(600)  # ten minutes of the session
+    simulation.timeline  # one sample per second
+
+Frames are still read and encoded for real, by the read-ahead, which only
+reads when a frame is about to be sent; their encode times are measured on
+the wall clock and take no virtual time. With
+more than one codec, switching codecs depends on them: only sessions with
+a single codec are fully reproducible.
+"""
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Union
+
+from client.client import Client
+from server.server import Server
+from utils.clock import VirtualClock
+from utils.codecs import negotiate
+from utils.impairment import Link, Profile, Schedule
+from utils.rtcp_packet import RTCPPacket, InvalidRequest
+from utils.rtp_packet import RTPPacket
+from utils.session_state import SessionState
+
+CLIENT_ADDRESS = ("127.0.0.1", 5000)  # never sent to
+
+
+class SimulatedTransport:
+    # stands in for the server's RtpTransport: datagrams go to the downlink
+    def __init__(self, simulation: "Simulation") -> None:
+        self.simulation = simulation
+        self._sessions: Dict[int, Server] = {}
+
+    def register(self, session: Server) -> int:
+        ssrc = RTCPPacket.new_ssrc()
+        while ssrc in self._sessions:
+            ssrc = RTCPPacket.new_ssrc()
+        self._sessions[ssrc] = session
+        return ssrc
+
+    def unregister(self, ssrc: int):
+        self._sessions.pop(ssrc, None)
+
+    def sendto(self, datagram: bytes, address: Tuple[str, int]) -> int:
+        self.simulation._send_rtp_datagram(datagram)
+        return len(datagram)
+
+    def close(self):
+        pass
+
+
+class Simulation:
+    SAMPLE_PERIOD = 1.0  # seconds of the timeline between two samples
+
+    def __init__(
+        self,
+        video_file_path: str,
+        downlink: Union[Profile, Schedule],
+        uplink: Union[None, Profile, Schedule] = None,
+        seed: Optional[int] = None,
+        codecs: Optional[List[str]] = None,
+        blocksize: Optional[int] = None,
+        loop: bool = True,
+    ) -> None:
+        self.clock = VirtualClock()
+        # the same seeds as the impairment proxy gives its first session
+        self.downlink = Link(downlink, None if seed is None else seed)
+        self.uplink = Link(Profile() if uplink is None else uplink, None if seed is None else seed + 1)
+        self.loop = loop  # from the start again at the end of the source
+
+        self.server = Server(
+            "127.0.0.1", 0, "simulation", transport=SimulatedTransport(self), clock=self.clock
+        )
+        self.server._client_address = CLIENT_ADDRESS
+        if codecs:
+            self.server.codecs = negotiate(codecs, self.server.allowed_codecs)
+        self.server._setup_rtcp()
+        self.server._prepare_rtp(video_file_path, blocksize)
+        # frames are read and encoded in `_send_frame()` only, with the
+        # rendition the events before it left
+        self.server._video_stream.read_on_demand()
+        self.server.server_state = Server.STATE.PAUSED
+
+        self.client = Client(
+            video_file_path, *CLIENT_ADDRESS, CLIENT_ADDRESS[1], on_frame=self._on_frame, clock=self.clock
+        )
+        self.client.remote_ssrc = self.server.ssrc
+        self.client._rtcp_sender = self.client.RtcpSender(self.client, self.client.RTCP_PERIOD / 1000.0)
+        self.client._state.set(SessionState.PAUSED)
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.reports = 0
+        self.timeline: List[Dict] = []
+        self._sample_frames = 0
+        self._sample_bytes = 0
+        self._started = False
+        self.wall_time = 0.0  # seconds run() took
+
+    def run(self, duration: float) -> List[Dict]:
+        # plays `duration` more seconds of the session, returns the timeline
+        if not self._started:
+            self._started = True
+            self.server.server_state = Server.STATE.PLAYING
+            self.client._state.set(SessionState.PLAYING)
+            self.client.stat_start_time = round(self.clock.time() * 1000)
+            self.clock.call_later(0, self._send_frame, self.clock.monotonic())
+            self.clock.call_later(self.client._rtcp_sender._interval(), self._send_report)
+            self.clock.call_later(self.SAMPLE_PERIOD, self._sample)
+        start = perf_counter()
+        self.clock.run(until=self.clock.monotonic() + duration)
+        self.wall_time += perf_counter() - start
+        return self.timeline
+
+    def close(self):
+        self.server.server_state = Server.STATE.TEARDOWN
+        self.server._close_source()
+
+    # server to client
+    def _send_frame(self, deadline: float):
+        # what the send thread does for a frame, `_pace()` waiting included
+        server = self.server
+        if server.server_state != Server.STATE.PLAYING:
+            return
+        server._video_stream.fill()
+        if server._is_end_of_stream():
+            if not self.loop:
+                server.server_state = Server.STATE.FINISHED
+                return
+            server._video_stream.seek(0)
+            server._video_stream.fill()
+        packet = server._next_rtp_packet()
+        if packet is not None:
+            server._send_rtp_packet(packet)
+        self.frames_sent += 1
+        deadline += server.send_delay / 1000.0
+        self.clock.call_at(deadline, self._send_frame, deadline)
+
+    def _send_rtp_datagram(self, datagram: bytes):
+        for delivery in self.downlink.send(len(datagram), self.clock.monotonic()):
+            self.clock.call_at(delivery, self._receive_rtp_datagram, datagram)
+
+    def _receive_rtp_datagram(self, datagram: bytes):
+        packet = self.client._reassemble(datagram)
+        if packet is not None:
+            self.client._handle_rtp_packet(packet)
+
+    def _on_frame(self, packet: RTPPacket):
+        # counted, never decoded
+        self.frames_received += 1
+        self.bytes_received += len(packet.payload)
+        self._sample_frames += 1
+        self._sample_bytes += len(packet.payload)
+
+    # client to server
+    def _send_report(self):
+        sender = self.client._rtcp_sender
+        datagram = sender._build_rtcp_packet().get_packet()
+        for delivery in self.uplink.send(len(datagram), self.clock.monotonic()):
+            self.clock.call_at(delivery, self._receive_report, datagram)
+        self.clock.call_later(sender._interval(), self._send_report)
+
+    def _receive_report(self, datagram: bytes):
+        try:
+            report = RTCPPacket.from_bitstream(datagram)
+        except InvalidRequest:
+            return
+        self.reports += 1
+        self.server._rtcp_receiver.handle_packet(report)
+
+    def _sample(self):
+        server = self.server
+        self.timeline.append(
+            {
+                "time": round(self.clock.monotonic(), 3),
+                "congestion_level": server.congestion_level,
+                "compression_level": server.compression_level,
+                "send_delay_ms": server.send_delay,
+                "fraction_lost": self.client._rtcp_sender.last_fraction_lost,
+                "fps": self._sample_frames / self.SAMPLE_PERIOD,
+                "bytes_per_second": self._sample_bytes / self.SAMPLE_PERIOD,
+                "datagram_size": server._datagram_sizer.size,
+            }
+        )
+        self._sample_frames = self._sample_bytes = 0
+        self.clock.call_later(self.SAMPLE_PERIOD, self._sample)
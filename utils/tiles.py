@@ -0,0 +1,175 @@
+"""
+Tiled frames: a frame is cut in square tiles and only the tiles that changed
+since the client last got them are sent, laid side by side in one image (an
+image per tile would spend more on its headers than on the tile), in the
+payload codec of the session (utils/codecs.py). The client
+paints them over the frame it shows. Mostly static scenes (surveillance)
+then cost a fraction of full frames.
+
+RTP payload (payload type 96), big-endian:
+
+    kind (u8) | codec payload type (u8) | width (u16) | height (u16) | tile size (u16)
+    FULL:     <image of the whole frame>
+    TILES:    count (u16) | count x (column (u16) | row (u16)) | <image of the tiles>
+    REPEAT:   nothing more, the frame did not change
+
+Full frames come back every REFRESH_INTERVAL frames, and after a loss is
+reported: a tile that never arrived stays wrong until then.
+"""
+import struct
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from utils.codecs import CODECS, DEFAULT_CODEC, Codec, by_payload_type
+
+
+FULL = 0
+TILES = 1
+REPEAT = 2
+
+_HEADER = struct.Struct("!BBHHH")
+_COUNT = struct.Struct("!H")
+_POSITION = struct.Struct("!HH")
+# tiles by row of the image carrying them, in the order of their positions
+MOSAIC_WIDTH = 4096
+
+
+class TileEncoder:
+    DEFAULT_TILE_SIZE = 64
+    MIN_TILE_SIZE = 16
+    MAX_TILE_SIZE = 256
+    REFRESH_INTERVAL = 240  # frames between two full frames
+    # a pixel changed when a channel moved by more than this, which leaves
+    # sensor and compression noise out
+    PIXEL_THRESHOLD = 24
+    # and a tile when more than that many of its pixels changed
+    MIN_CHANGED_PIXELS = 4
+    # past this share of changed tiles, a full frame is cheaper
+    FULL_FRAME_SHARE = 0.5
+
+    def __init__(self, tile_size: int = DEFAULT_TILE_SIZE, refresh_interval: int = REFRESH_INTERVAL):
+        self.tile_size = self.clamp_tile_size(tile_size)
+        self.refresh_interval = refresh_interval
+        # the frame as the client shows it: pixels of the tiles last sent
+        self._reference: Optional[np.ndarray] = None
+        self._last_source: Optional[bytes] = None
+        self._since_refresh = 0
+        # frames sent of each kind
+        self.counts = {FULL: 0, TILES: 0, REPEAT: 0}
+
+    @classmethod
+    def clamp_tile_size(cls, tile_size: int) -> int:
+        # whole JPEG and WebP blocks (16x16 with chroma subsampling)
+        tile_size = min(max(tile_size, cls.MIN_TILE_SIZE), cls.MAX_TILE_SIZE)
+        return tile_size - tile_size % 16
+
+    def refresh(self):
+        # the next frame goes out whole
+        self._reference = None
+
+    def encode(
+        self, frame: bytes, codec: Codec = CODECS[DEFAULT_CODEC], quality: Optional[int] = None
+    ) -> bytes:
+        # the payload for the source `frame`, encoded in `codec`; with
+        # `quality` None, full frames are the source frame itself
+        refresh_due = self._reference is None or self._since_refresh >= self.refresh_interval
+        if frame == self._last_source and not refresh_due:
+            # a duplicate frame: no decode at all
+            return self._pack(REPEAT, codec, *self._reference.shape[:2])
+        self._last_source = frame
+        image = codec.decode(frame)
+        height, width = image.shape[:2]
+        if refresh_due or self._reference.shape != image.shape:
+            return self._full(frame, image, codec, quality)
+
+        changed = self._changed_tiles(image)
+        if not changed.any():
+            return self._pack(REPEAT, codec, height, width)
+        if changed.mean() > self.FULL_FRAME_SHARE:
+            return self._full(frame, image, codec, quality)
+
+        size = self.tile_size
+        rows, columns = np.nonzero(changed)
+        per_row = max(1, MOSAIC_WIDTH // size)
+        count = len(rows)
+        mosaic = np.zeros(
+            (-(-count // per_row) * size, min(count, per_row) * size, 3), dtype=np.uint8
+        )
+        positions = [_COUNT.pack(count)]
+        for i, (row, column) in enumerate(zip(rows.tolist(), columns.tolist())):
+            area = slice(row * size, (row + 1) * size), slice(column * size, (column + 1) * size)
+            tile = image[area]
+            y, x = i // per_row * size, i % per_row * size
+            # tiles on the right and bottom edges may be smaller
+            mosaic[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            self._reference[area] = tile
+            positions.append(_POSITION.pack(column, row))
+        tiles = codec.encode(mosaic, quality)
+        if quality is None and len(tiles) >= len(frame):
+            # busy tiles compress worse than the frame they are cut from
+            return self._full(frame, image, codec, quality)
+        self._since_refresh += 1
+        self.counts[TILES] += 1
+        return self._pack(TILES, codec, height, width) + b"".join(positions) + tiles
+
+    def _changed_tiles(self, image: np.ndarray) -> np.ndarray:
+        # rows x columns of booleans
+        blue, green, red = cv2.split(cv2.absdiff(image, self._reference))
+        changed_pixels = cv2.max(cv2.max(blue, green), red) > self.PIXEL_THRESHOLD
+        height, width = changed_pixels.shape
+        size = self.tile_size
+        rows, columns = -(-height // size), -(-width // size)
+        padded = np.zeros((rows * size, columns * size), dtype=np.float32)
+        padded[:height, :width] = changed_pixels
+        # the area average of whole tiles: the share of their pixels changed
+        share = cv2.resize(padded, (columns, rows), interpolation=cv2.INTER_AREA)
+        return share * (size * size) > self.MIN_CHANGED_PIXELS
+
+    def _full(self, frame: bytes, image: np.ndarray, codec: Codec, quality: Optional[int]) -> bytes:
+        self._reference = image
+        self._since_refresh = 0
+        self.counts[FULL] += 1
+        if quality is not None:
+            frame = codec.encode(image, quality)
+        return self._pack(FULL, codec, *image.shape[:2]) + frame
+
+    def _pack(self, kind: int, codec: Codec, height: int, width: int) -> bytes:
+        if kind == REPEAT:
+            self._since_refresh += 1
+            self.counts[REPEAT] += 1
+        return _HEADER.pack(kind, codec.payload_type, width, height, self.tile_size)
+
+
+class TileCompositor:
+    # client side: keeps the frame the tiles are painted on
+
+    def __init__(self) -> None:
+        self._framebuffer: Optional[np.ndarray] = None
+
+    def apply(self, payload: bytes) -> Optional[np.ndarray]:
+        # the frame after this payload (BGR), None until a full frame came
+        kind, payload_type, width, height, size = _HEADER.unpack_from(payload)
+        codec = by_payload_type(payload_type)
+        if codec is None:
+            return None
+        if kind == FULL:
+            self._framebuffer = codec.decode(payload[_HEADER.size:])
+            return self._framebuffer
+        if self._framebuffer is None or self._framebuffer.shape[:2] != (height, width):
+            return None
+        if kind == TILES:
+            count, = _COUNT.unpack_from(payload, _HEADER.size)
+            offset = _HEADER.size + _COUNT.size
+            positions = [
+                _POSITION.unpack_from(payload, offset + i * _POSITION.size) for i in range(count)
+            ]
+            mosaic = codec.decode(payload[offset + count * _POSITION.size:])
+            per_row = max(1, MOSAIC_WIDTH // size)
+            for i, (column, row) in enumerate(positions):
+                y, x = row * size, column * size
+                tile = self._framebuffer[y:y + size, x:x + size]
+                my, mx = i // per_row * size, i % per_row * size
+                tile[:] = mosaic[my:my + tile.shape[0], mx:mx + tile.shape[1]]
+        return self._framebuffer
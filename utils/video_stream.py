@@ -2,61 +2,394 @@ import cv2
 import numpy as np
 
 import os
+from collections import deque
+from threading import Condition, Thread, current_thread
+from time import monotonic
+from typing import Deque, List, Optional, Sequence, Tuple
+
+from utils.codecs import CODECS, DEFAULT_CODEC, Codec, Rendition, encode_renditions
+from utils.encode_pool import EncodePool
+from utils.frame_index import FrameIndex
+from utils.jpeg import is_jpeg, with_huffman_tables
+from utils.roi import RoiFilter
 
 
 class VideoStream:
     DEFAULT_IMAGE_SHAPE = (480, 640)
-    VIDEO_LENGTH = 500
     DEFAULT_FPS = 24
-
-
-    MAX_DGRAM = 2**12 ## 2**16 original
-    MAX_IMAGE_DGRAM = MAX_DGRAM - 64 # extract 64 bytes in case UDP frame overflown
-
-
-
-
-
-    def __init__(self, file_path: str):
-
-        if os.path.isfile(file_path):
-            self._stream = cv2.VideoCapture(file_path) 
-        else:    
+    # frames read and encoded ahead of the sender, for files
+    DEFAULT_READ_AHEAD = 8
+    # codecs whose frames are plain JPEG images
+    JPEG_FOURCCS = {"MJPG", "mjpg", "jpeg", "JPEG", "AVDJ", "dmb1"}
+    # (downscale, quality share): frames at full size and the codec's own
+    # quality, see `set_rendition()`
+    FULL_RENDITION = (1, None)
+
+
+    def __init__(
+        self,
+        file_path: str,
+        read_ahead: int = DEFAULT_READ_AHEAD,
+        encode_pool: Optional[EncodePool] = None,
+    ):
+
+        self.file_path = file_path
+        # a path that is not a file streams the camera
+        self.is_live = not os.path.isfile(file_path)
+        if not self.is_live:
+            self._stream = cv2.VideoCapture(file_path)
+        else:
             self._stream = cv2.VideoCapture(0)
+            # most cameras compress to MJPG themselves when asked to
+            self._stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+
+        # read once, the capture belongs to the producer thread afterwards
+        self.width = int(self._stream.get(cv2.CAP_PROP_FRAME_WIDTH)) or self.DEFAULT_IMAGE_SHAPE[1]
+        self.height = int(self._stream.get(cv2.CAP_PROP_FRAME_HEIGHT)) or self.DEFAULT_IMAGE_SHAPE[0]
+        # JPEG frames are taken undecoded from the container or camera and
+        # sent as they are, no decode and re-encode per frame, unless another
+        # codec is asked for
+        self.passthrough = self._fourcc() in self.JPEG_FOURCCS and self._read_undecoded()
+        if self.passthrough:
+            print(f"JPEG frames of {file_path} are passed through")
+        # timestamps and keyframes of a file, seeks and trick play go by it
+        self.index: Optional[FrameIndex] = None
+        if not self.is_live:
+            self.index = FrameIndex.load(file_path)
+        # frames in the source, None for a live source
+        self.frame_count: Optional[int] = None if self.index is None else len(self.index)
 
-        
         # frame number is zero-indexed
         # after first frame is sent, this is set to zero
         self.current_frame_number = -1
+        # payload codec of the frames, and the one of the frame last taken
+        self.codec: Codec = CODECS[DEFAULT_CODEC]
+        self.current_codec = self.codec
+        # rendition of the frames, and the one of the frame last taken
+        self.rendition: Rendition = self.FULL_RENDITION
+        self.current_rendition = self.rendition
+        # further renditions of every frame for simulcast, encoded in the
+        # same pass, and their payloads for the frame last taken
+        self.layers: Tuple[Rendition, ...] = ()
+        self.current_layers: List[bytes] = []
+        # region-of-interest filter, and the level it smooths the background
+        # at, 0 leaving frames untouched, and the level of the frame last taken
+        self.roi: Optional[RoiFilter] = None
+        self.roi_level = 0
+        self.current_roi_level = 0
+        # seconds spent reading and encoding the frame last read
+        self.encode_time: Optional[float] = None
+
+        # ===========================
+        # Read-ahead: a producer thread reads and encodes frames into a
+        # bounded buffer, so disk seeks, camera latency and encode spikes
+        # stay out of the send loop. A camera can't be read ahead, only its
+        # latest frame is kept: a stale frame is worse than a skipped one.
+        # ===========================
+        self.capacity = 1 if self.is_live else max(1, read_ahead)
+        # encoder processes shared with the other streams, the producer
+        # thread encodes itself if None
+        self._encode_pool = encode_pool
+        self._frames: Deque[Tuple[int, Codec, Rendition, int, List[bytes]]] = deque()
+        self._condition = Condition()
+        self._producer: Optional[Thread] = None
+        self._closed = False
+        self._exhausted = False  # the producer reached the end of the source
+        # the producer only reads within fill(), see `read_on_demand()`
+        self._on_demand = False
+        self._filling = False
+        # why the producer stopped early, a codec or a detector error: the
+        # stream ends there, seeking doesn't bring it back
+        self.error: Optional[Exception] = None
+        # where the producer reads next; a seek or a trick-play step moves
+        # the capture, and frames read before a seek are thrown away
+        self._position = 0
+        self._stop = self.frame_count
+        self._step = 1
+        self._seek_pending = False
+        self._generation = 0
+        self.stalls = 0  # times the sender found no frame ready
+        self.dropped = 0  # live frames replaced before being sent
+
+    @property
+    def fill_level(self) -> float:
+        # fraction of the read-ahead buffer in use
+        return len(self._frames) / self.capacity
 
     def close(self):
-        
-        cv2.destroyAllWindows()
-        #self._stream.close()
+        # sessions come and go on a long-running server, so give the
+        # capture back instead of leaking it
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._producer is not None and self._producer is not current_thread():
+            # the capture must not be released under a read
+            self._producer.join()
+        self._stream.release()
+
+    def _fourcc(self) -> str:
+        fourcc = int(self._stream.get(cv2.CAP_PROP_FOURCC))
+        return fourcc.to_bytes(4, "little").decode("latin-1")
+
+    def _read_undecoded(self) -> bool:
+        # frames are then read as one row of bytes
+        if self.is_live:
+            return self._stream.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        return self._stream.set(cv2.CAP_PROP_FORMAT, -1)
+
+    def _encode(
+        self, videoframe: np.ndarray, codec: Codec, renditions: Sequence[Rendition], roi_level: int = 0
+    ) -> List[bytes]:
+        # one payload per rendition, from a single read and decode
+        passthrough = None
+        if self.passthrough and videoframe.ndim == 2 and videoframe.shape[0] == 1:
+            data = videoframe.tobytes()
+            if is_jpeg(data):
+                passthrough = with_huffman_tables(data)
+        if self.roi is not None and roi_level > 0:
+            if passthrough is not None:
+                videoframe = cv2.imdecode(np.frombuffer(passthrough, dtype=np.uint8), cv2.IMREAD_COLOR)
+                passthrough = None
+            videoframe = self.roi.apply(videoframe, roi_level)
+        payloads: List[Optional[bytes]] = []
+        pending = []
+        for rendition in renditions:
+            if (passthrough is not None and rendition == self.FULL_RENDITION
+                    and codec.name == "JPEG" and codec.quality == codec.default_quality):
+                payloads.append(passthrough)
+            else:
+                payloads.append(None)
+                pending.append(rendition)
+        if pending:
+            source = videoframe if passthrough is None else passthrough
+            if self._encode_pool is not None:
+                encoded = iter(self._encode_pool.encode(source, codec, pending))
+            else:
+                encoded = iter(encode_renditions(source, codec, pending))
+            payloads = [next(encoded) if payload is None else payload for payload in payloads]
+        return payloads
+
+    def set_rendition(self, downscale: int, quality_share: Optional[float] = None):
+        # frames are divided in size by `downscale` and encoded at
+        # `quality_share` of the codec's quality range (None for the codec's
+        # own quality); applies from the next frame read, frames already
+        # read ahead keep theirs rather than being read again on every
+        # congestion change
+        with self._condition:
+            self.rendition = max(1, downscale), quality_share
+
+    def set_roi(self, roi: Optional[RoiFilter]):
+        with self._condition:
+            self.roi = roi
+
+    def set_roi_level(self, level: int):
+        # the background of frames read next is smoothed more at each level
+        # (see utils/roi.py), the regions of interest keep their detail
+        with self._condition:
+            if level > 0 and self.roi_level == 0 and self.roi is not None:
+                self.roi.reset()
+            self.roi_level = max(0, level)
+
+    def set_codec(self, codec: Codec):
+        # frames taken next are in `codec`; those read ahead in the previous
+        # one are thrown away and read again
+        with self._condition:
+            if codec == self.codec:
+                return
+            self.codec = codec
+            self._flush()
+
+    def set_layers(self, renditions: Sequence[Rendition]):
+        # every frame is also encoded at `renditions`, for simulcast, from
+        # the same read and decode; frames read ahead without them are
+        # thrown away and read again
+        with self._condition:
+            if tuple(renditions) == self.layers:
+                return
+            self.layers = tuple(renditions)
+            self._flush()
+
+    def _flush(self):
+        # holding the condition: frames read ahead are read again
+        self._frames.clear()
+        self._generation += 1
+        if not self.is_live:
+            self._position = self.resume_point
+            self._seek_pending = True
+            self._exhausted = self._past_stop()
+        self._condition.notify_all()
+
+    def _start(self):
+        if self._producer is None:
+            self._producer = Thread(target=self._produce, name="capture")
+            self._producer.setDaemon(True)
+            self._producer.start()
+
+    def _produce(self):
+        condition = self._condition
+        while True:
+            with condition:
+                condition.wait_for(
+                    lambda: self._closed or self.is_live
+                    or (not self._exhausted and len(self._frames) < self.capacity
+                        and (self._filling or not self._on_demand))
+                )
+                if self._closed:
+                    return
+                generation, frame_number = self._generation, self._position
+                codec, renditions = self.codec, (self.rendition, *self.layers)
+                roi_level = self.roi_level
+                seek, self._seek_pending = self._seek_pending, False
+            if seek:
+                # the backend decodes forward from the preceding keyframe
+                self._stream.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            start = monotonic()
+            try:
+                grabbed, videoframe = self._stream.read()
+                if self.is_live:
+                    # a camera read waits for the next frame, only encoding counts
+                    start = monotonic()
+                if grabbed:
+                    payloads = self._encode(videoframe, codec, renditions, roi_level)
+            except Exception as e:
+                # whoever waits for a frame must learn none will come
+                print(f"Reading {self.file_path} failed: {type(e).__name__}: {e}")
+                with condition:
+                    self.error = e
+                    self._exhausted = True
+                    condition.notify_all()
+                return
+            with condition:
+                if generation != self._generation:
+                    # seeked or switched codec or layers meanwhile, the
+                    # frame is from the old position or in the old codec
+                    continue
+                if not grabbed:
+                    self._exhausted = True
+                    condition.notify_all()
+                    if self.is_live:
+                        return
+                    continue
+                if self.is_live and self._frames:
+                    self._frames.popleft()
+                    self.dropped += 1
+                self.encode_time = monotonic() - start
+                self._frames.append((frame_number, codec, renditions[0], roi_level, payloads))
+                if not self.is_live:
+                    self._advance()
+                condition.notify_all()
+
+    def _advance(self):
+        # holding the condition: moves past the frame just read
+        if self._step == 1:
+            self._position += 1
+        else:
+            # trick play only sends keyframes, no decoding in between
+            position = self.index.next_keyframe(self._position, self._step)
+            if position is None:
+                self._exhausted = True
+                return
+            self._position = position
+            self._seek_pending = True
+        self._exhausted = self._past_stop()
+
+    def _past_stop(self) -> bool:
+        if self._step > 0:
+            return self._position >= self._stop
+        return self._position <= self._stop
+
+    def seek(self, frame_number: int, stop: Optional[int] = None, scale: float = 1.0) -> float:
+        # the next frame taken is `frame_number`, the stream ends at `stop`
+        # (excluded, the end of the file by default); returns the scale
+        # applied, only whole steps are supported: 2 sends every other frame
+        # and -1 plays backwards
+        if self.is_live:
+            raise ValueError(f"{self.file_path} is live, it can't be seeked")
+        step = int(round(scale)) or (1 if scale >= 0 else -1)
+        with self._condition:
+            self._frames.clear()
+            self._generation += 1
+            self._step = step
+            if step > 0:
+                self._position = max(frame_number, 0)
+                self._stop = self.frame_count if stop is None else min(stop, self.frame_count)
+            else:
+                self._position = min(frame_number, self.frame_count - 1)
+                self._stop = -1 if stop is None else max(stop, -1)
+            self._seek_pending = True
+            self._exhausted = self._past_stop()
+            self._condition.notify_all()
+        return float(step)
+
+    @property
+    def resume_point(self) -> int:
+        # the frame after the last one taken
+        return self.current_frame_number + self._step if self.current_frame_number >= 0 else 0
+
+    def _wait_for_frame(self):
+        # holding the condition: until a frame is buffered or none will come
+        if not self._frames and not self._exhausted:
+            self.stalls += 1
+        self._condition.wait_for(
+            lambda: self._frames or self._exhausted or self._closed or self.error is not None
+        )
+
+    def prefetch(self):
+        # starts reading ahead and waits for the first frame, so that the
+        # first frame after PLAY doesn't wait for the capture
+        self._start()
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._frames or self._exhausted or self._closed or self.error is not None
+            )
+
+    def read_on_demand(self):
+        # from now on the producer only reads within fill(): a rendition or
+        # codec changed between two fills applies from the frames read by
+        # the next, never from wherever the producer got meanwhile
+        with self._condition:
+            self._on_demand = True
+
+    def fill(self):
+        # waits until as many frames as the read-ahead holds are read, so
+        # that how many keep their rendition on a change doesn't depend on
+        # how far the producer got: a simulated session runs far ahead of it
+        self._start()
+        with self._condition:
+            self._filling = True
+            self._condition.notify_all()
+            try:
+                self._condition.wait_for(
+                    lambda: len(self._frames) >= self.capacity or self._exhausted
+                    or self._closed or self.is_live or self.error is not None
+                )
+            finally:
+                self._filling = False
+
+    def at_end(self) -> bool:
+        # True once every frame of the source has been taken, waits for the
+        # producer when nothing is buffered yet
+        self._start()
+        with self._condition:
+            self._wait_for_frame()
+            return not self._frames
 
     def get_next_frame(self) -> bytes:
 
-        videoframe = self._stream.read()[1]
-
-        videoframe = cv2.imencode('.jpg',   videoframe )[1]
-        videoframe = videoframe.tobytes()
-        
-        #videoframe = videoframe.tobytes()
-
-        self.current_frame_number += 1
-
-        return videoframe
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        self._start()
+        with self._condition:
+            self._wait_for_frame()
+            if not self._frames:
+                raise EOFError(f"end of video stream {self.file_path}") from self.error
+            frame_number, codec, rendition, roi_level, payloads = self._frames.popleft()
+            self.current_codec, self.current_rendition = codec, rendition
+            self.current_roi_level = roi_level
+            self.current_layers = payloads[1:]
+            self._condition.notify_all()
+
+        if self.is_live:
+            self.current_frame_number += 1
+        else:
+            self.current_frame_number = frame_number
+
+        return payloads[0]